@@ -0,0 +1,311 @@
+# week09/example-2/backend/order_service/app/aggregates.py
+
+import argparse
+import asyncio
+import logging
+from collections import defaultdict
+from datetime import date, datetime, time, timezone
+from decimal import Decimal
+from typing import Iterable, List, Optional, Tuple
+
+from sqlalchemy import delete, distinct, func, insert, select, text, union_all
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from .models import (
+    Order,
+    OrderDailyProductRollup,
+    OrderDailyStatusRollup,
+    OrderItem,
+    OrderProductRollupDelta,
+    OrderStatusRollupDelta,
+)
+
+logger = logging.getLogger(__name__)
+
+# Columns summed by the status and product rollups
+STATUS_TOTALS = ("order_count", "total_amount")
+PRODUCT_TOTALS = ("units_sold", "revenue", "order_count")
+# Each rollup with the table its pending deltas are appended to, its key and its totals
+ROLLUPS = (
+    (OrderDailyStatusRollup, OrderStatusRollupDelta, ("day", "status"), STATUS_TOTALS),
+    (OrderDailyProductRollup, OrderProductRollupDelta, ("day", "product_id"), PRODUCT_TOTALS),
+)
+
+
+def order_day(order_date: datetime) -> date:
+    # Rollup days are UTC calendar days
+    return order_date.astimezone(timezone.utc).date()
+
+
+def _add_to_rollup(model, keys: Tuple[str, ...], totals: Tuple[str, ...], rows: List[dict]):
+    """
+    Adds each row's totals to the rollup row with the same keys, creating it if needed.
+    Rows are sorted by key so concurrent transactions lock rollup rows in the same order.
+    """
+    rows = sorted(rows, key=lambda row: tuple(row[key] for key in keys))
+    statement = pg_insert(model).values(rows)
+    return statement.on_conflict_do_update(
+        index_elements=list(keys),
+        set_={total: getattr(model, total) + getattr(statement.excluded, total) for total in totals},
+    )
+
+
+async def record_order(db, order: Order, items: Iterable[OrderItem], sign: int = 1):
+    """
+    Adds an order (sign=1) to the rollups, or takes it out again (sign=-1, when it is
+    deleted), in the session's transaction. Only appends deltas, so concurrent orders of
+    the same day lock no shared rows; fold_rollup_deltas adds them to the rollups later.
+    """
+    day = order_day(order.order_date)
+    products = defaultdict(lambda: {"units_sold": 0, "revenue": Decimal("0")})
+    for item in items:
+        products[item.product_id]["units_sold"] += item.quantity
+        products[item.product_id]["revenue"] += item.item_total
+    await db.execute(
+        insert(OrderStatusRollupDelta).values(
+            day=day, status=order.status, order_count=sign, total_amount=sign * order.total_amount
+        )
+    )
+    if products:
+        await db.execute(
+            insert(OrderProductRollupDelta).values(
+                [
+                    {
+                        "day": day,
+                        "product_id": product_id,
+                        "units_sold": sign * totals["units_sold"],
+                        "revenue": sign * totals["revenue"],
+                        "order_count": sign,
+                    }
+                    for product_id, totals in products.items()
+                ]
+            )
+        )
+
+
+async def record_status_change(db, order: Order, old_status: str):
+    """Moves an order from old_status to its current status in the status rollup, as deltas."""
+    if order.status == old_status:
+        return
+    day = order_day(order.order_date)
+    await db.execute(
+        insert(OrderStatusRollupDelta).values(
+            [
+                {"day": day, "status": old_status, "order_count": -1, "total_amount": -order.total_amount},
+                {"day": day, "status": order.status, "order_count": 1, "total_amount": order.total_amount},
+            ]
+        )
+    )
+
+
+async def _fold_deltas(db, rollup, delta, keys: Tuple[str, ...], totals: Tuple[str, ...], batch_size: int) -> int:
+    batch = select(delta.delta_id).order_by(delta.delta_id).limit(batch_size).with_for_update(skip_locked=True)
+    moved = (
+        await db.execute(
+            delete(delta)
+            .where(delta.delta_id.in_(batch))
+            .returning(*(getattr(delta, column) for column in (*keys, *totals)))
+        )
+    ).all()
+    sums = defaultdict(lambda: dict.fromkeys(totals, 0))
+    for row in moved:
+        key_totals = sums[tuple(getattr(row, key) for key in keys)]
+        for total in totals:
+            key_totals[total] += getattr(row, total)
+    if sums:
+        await db.execute(
+            _add_to_rollup(rollup, keys, totals, [{**dict(zip(keys, key)), **key_totals} for key, key_totals in sums.items()])
+        )
+    return len(moved)
+
+
+async def fold_rollup_deltas(db, batch_size: int) -> int:
+    """
+    Adds up to batch_size pending deltas of each rollup to it, one upsert per rollup row
+    they touch, and commits. Returns the number of deltas folded.
+    """
+    folded = 0
+    for rollup, delta, keys, totals in ROLLUPS:
+        folded += await _fold_deltas(db, rollup, delta, keys, totals, batch_size)
+    await db.commit()
+    return folded
+
+
+async def run_rollup_fold(session_factory, interval_seconds: float, batch_size: int):
+    """Folds pending rollup deltas every interval_seconds, in batches, until cancelled."""
+    while True:
+        try:
+            async with session_factory() as db:
+                while await fold_rollup_deltas(db, batch_size) >= batch_size:
+                    pass
+        except Exception as e:
+            logger.error(f"Order Service: Folding order rollup deltas failed: {e}", exc_info=True)
+        await asyncio.sleep(interval_seconds)
+
+
+def _with_deltas(rollup, delta, columns: Tuple[str, ...]):
+    """The rollup's rows followed by its pending deltas, for totals that include both."""
+    return union_all(
+        select(*(getattr(rollup, column) for column in columns)),
+        select(*(getattr(delta, column) for column in columns)),
+    ).subquery()
+
+
+def _day_range(model, start: Optional[date], end: Optional[date]) -> list:
+    filters = []
+    if start:
+        filters.append(model.day >= start)
+    if end:
+        filters.append(model.day < end)
+    return filters
+
+
+def _utc_midnight(day: date) -> datetime:
+    return datetime.combine(day, time(), tzinfo=timezone.utc)
+
+
+async def rebuild_rollups(db, start: Optional[date] = None, end: Optional[date] = None) -> Tuple[int, int]:
+    """
+    Recomputes the rollups for the days in [start, end) (all days by default) from the
+    orders table, in the session's transaction; the caller commits. Returns the number
+    of status and product rollup rows written.
+
+    The rollup and delta tables are locked against writes first, so order changes made
+    meanwhile wait and are added on top of the rebuilt rows instead of being lost or
+    counted twice. Pending deltas of the rebuilt days are dropped, as the rebuild covers them.
+    """
+    tables = ", ".join(model.__tablename__ for rollup, delta, _, _ in ROLLUPS for model in (rollup, delta))
+    await db.execute(text(f"LOCK TABLE {tables} IN EXCLUSIVE MODE"))
+    day = func.date(func.timezone("UTC", Order.order_date))
+    order_filters = []
+    if start:
+        order_filters.append(Order.order_date >= _utc_midnight(start))
+    if end:
+        order_filters.append(Order.order_date < _utc_midnight(end))
+
+    for rollup, delta, _, _ in ROLLUPS:
+        await db.execute(delete(rollup).where(*_day_range(rollup, start, end)))
+        await db.execute(delete(delta).where(*_day_range(delta, start, end)))
+    status_rows = await db.execute(
+        pg_insert(OrderDailyStatusRollup).from_select(
+            ["day", "status", *STATUS_TOTALS],
+            select(day, Order.status, func.count(), func.sum(Order.total_amount))
+            .where(*order_filters)
+            .group_by(day, Order.status),
+        )
+    )
+    product_rows = await db.execute(
+        pg_insert(OrderDailyProductRollup).from_select(
+            ["day", "product_id", *PRODUCT_TOTALS],
+            select(
+                day,
+                OrderItem.product_id,
+                func.sum(OrderItem.quantity),
+                func.sum(OrderItem.item_total),
+                func.count(distinct(Order.order_id)),
+            )
+            .join(OrderItem, OrderItem.order_id == Order.order_id)
+            .where(*order_filters)
+            .group_by(day, OrderItem.product_id),
+        )
+    )
+    return status_rows.rowcount, product_rows.rowcount
+
+
+def _status_rows():
+    return _with_deltas(OrderDailyStatusRollup, OrderStatusRollupDelta, ("day", "status", *STATUS_TOTALS))
+
+
+def _product_rows():
+    return _with_deltas(OrderDailyProductRollup, OrderProductRollupDelta, ("day", "product_id", *PRODUCT_TOTALS))
+
+
+async def daily_totals(db, start: Optional[date], end: Optional[date], status: Optional[str]):
+    """Orders and revenue per day in [start, end), over all statuses or one."""
+    rows = _status_rows()
+    filters = _day_range(rows.c, start, end)
+    if status:
+        filters.append(rows.c.status == status)
+    order_count = func.sum(rows.c.order_count)
+    query = (
+        select(
+            rows.c.day,
+            order_count.label("order_count"),
+            func.sum(rows.c.total_amount).label("total_amount"),
+        )
+        .where(*filters)
+        .group_by(rows.c.day)
+        .having(order_count > 0)
+        .order_by(rows.c.day)
+    )
+    return (await db.execute(query)).all()
+
+
+async def status_totals(db, start: Optional[date], end: Optional[date]):
+    """Orders and revenue per current status over the days in [start, end)."""
+    rows = _status_rows()
+    order_count = func.sum(rows.c.order_count)
+    query = (
+        select(
+            rows.c.status,
+            order_count.label("order_count"),
+            func.sum(rows.c.total_amount).label("total_amount"),
+        )
+        .where(*_day_range(rows.c, start, end))
+        .group_by(rows.c.status)
+        .having(order_count > 0)
+        .order_by(rows.c.status)
+    )
+    return (await db.execute(query)).all()
+
+
+async def product_totals(
+    db, start: Optional[date], end: Optional[date], product_id: Optional[int], limit: int
+):
+    """Units sold, revenue and orders per product over [start, end), best sellers first."""
+    rows = _product_rows()
+    filters = _day_range(rows.c, start, end)
+    if product_id:
+        filters.append(rows.c.product_id == product_id)
+    units_sold = func.sum(rows.c.units_sold)
+    query = (
+        select(
+            rows.c.product_id,
+            units_sold.label("units_sold"),
+            func.sum(rows.c.revenue).label("revenue"),
+            func.sum(rows.c.order_count).label("order_count"),
+        )
+        .where(*filters)
+        .group_by(rows.c.product_id)
+        .having(units_sold > 0)
+        .order_by(units_sold.desc(), rows.c.product_id)
+        .limit(limit)
+    )
+    return (await db.execute(query)).all()
+
+
+async def run_rebuild(start: Optional[date], end: Optional[date]):
+    from .db import SessionLocal, engine
+
+    try:
+        async with SessionLocal() as db:
+            status_rows, product_rows = await rebuild_rollups(db, start, end)
+            await db.commit()
+        logger.info(
+            f"Order Service: Rebuilt order rollups for [{start or 'first day'}, {end or 'last day'}): "
+            f"{status_rows} status rows, {product_rows} product rows."
+        )
+    finally:
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    # python -m app.aggregates rebuild [--start 2024-01-01] [--end 2024-02-01]
+    parser = argparse.ArgumentParser(description="Maintain the order rollup tables behind GET /orders/stats/*.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    rebuild = commands.add_parser("rebuild", help="Recompute the rollups from the orders table.")
+    rebuild.add_argument("--start", type=date.fromisoformat, help="First day to rebuild (UTC).")
+    rebuild.add_argument("--end", type=date.fromisoformat, help="Day after the last one to rebuild (UTC).")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(run_rebuild(args.start, args.end))
@@ -1,10 +1,15 @@
 # week09/example-2/backend/order_service/app/db.py
 
 import os
+import time
+import uuid
+from typing import Callable, Optional, Type
 
-from sqlalchemy import create_engine
+from sqlalchemy import event, exc
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import NullPool, Pool
 
 POSTGRES_USER = os.getenv("POSTGRES_USER", "postgres")
 POSTGRES_PASSWORD = os.getenv("POSTGRES_PASSWORD", "postgres")
@@ -13,18 +18,158 @@ POSTGRES_HOST = os.getenv("POSTGRES_HOST", "localhost")
 POSTGRES_PORT = os.getenv("POSTGRES_PORT", "5432")
 
 DATABASE_URL = (
-    f"postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}@"
+    f"postgresql+asyncpg://{POSTGRES_USER}:{POSTGRES_PASSWORD}@"
     f"{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}"
 )
 
-engine = create_engine(DATABASE_URL, pool_pre_ping=True)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Connection pool. Every worker process has its own pool, so one replica can open up to
+# workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW) connections; keep that, summed over all
+# replicas, below the server's max_connections (or put PgBouncer in between, see DB_POOLER).
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+# Seconds a request waits for a free connection before failing
+DB_POOL_TIMEOUT_SECONDS = float(os.getenv("DB_POOL_TIMEOUT_SECONDS", "30"))
+# Connections older than this are replaced when checked out (-1 never replaces them)
+DB_POOL_RECYCLE_SECONDS = int(os.getenv("DB_POOL_RECYCLE_SECONDS", "1800"))
+# true: test every connection with a round trip when it is checked out. false: rely on
+# recycling, and on SQLAlchemy invalidating the pool once a query hits a dropped connection.
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "false").lower() == "true"
+# "direct": POSTGRES_HOST is the database server. "pgbouncer": POSTGRES_HOST is a PgBouncer
+# in transaction pooling mode, which hands every transaction to any server connection, so
+# prepared statements are neither cached nor reused by name.
+DB_POOLER = os.getenv("DB_POOLER", "direct")
+# "queue" keeps up to DB_POOL_SIZE + DB_MAX_OVERFLOW connections open per process. "null"
+# opens a connection for every checkout and closes it afterwards, leaving pooling to
+# PgBouncer; the default behind PgBouncer.
+DB_POOL_CLASS = os.getenv("DB_POOL_CLASS", "null" if DB_POOLER == "pgbouncer" else "queue")
+
+
+class PoolStats:
+    """
+    Connections of an engine's pool, followed through the public pool events so every
+    pool class reports alike, and the time sessions wait for one. Reports to optional
+    callbacks: on_change(stats) whenever a connection is opened, closed, checked out or
+    checked in; on_checkout(seconds) once a session has its connection, timed from the
+    start of its transaction and including any wait for a free one; on_timeout() for
+    each request that failed because no connection was free in time.
+    """
+
+    on_change: Optional[Callable[["PoolStats"], None]] = None
+    on_checkout: Optional[Callable[[float], None]] = None
+    on_timeout: Optional[Callable[[], None]] = None
+
+    def __init__(self, pool: Pool, session_class: Type[Session]):
+        # Connection records, so a checkin without a checkout (after a failed
+        # pre-ping) or a connection closed while checked out cannot skew the counts
+        self._open = set()
+        self._checked_out = set()
+        # engine.dispose() replaces the pool; the new one keeps these listeners
+        event.listen(pool, "connect", self._opened)
+        event.listen(pool, "close", self._closed)
+        event.listen(pool, "detach", self._closed)
+        event.listen(pool, "checkout", self._checked_out_record)
+        event.listen(pool, "checkin", self._checked_in_record)
+        event.listen(session_class, "after_transaction_create", self._transaction_created)
+        event.listen(session_class, "after_begin", self._transaction_begun)
+
+    @property
+    def opened(self) -> int:
+        return len(self._open)
+
+    @property
+    def checked_out(self) -> int:
+        return len(self._checked_out)
+
+    @property
+    def idle(self) -> int:
+        return len(self._open - self._checked_out)
+
+    def record_error(self, error: Optional[BaseException]):
+        """Reports a request that failed on a checkout timeout, raised directly or as the cause of its error."""
+        seen = set()
+        while error is not None and id(error) not in seen:
+            if isinstance(error, exc.TimeoutError):
+                if self.on_timeout:
+                    self.on_timeout()
+                return
+            seen.add(id(error))
+            error = error.__cause__ or error.__context__
+
+    def _changed(self):
+        if self.on_change:
+            self.on_change(self)
+
+    def _opened(self, dbapi_connection, record):
+        self._open.add(record)
+        self._changed()
+
+    def _closed(self, dbapi_connection, record):
+        self._open.discard(record)
+        self._checked_out.discard(record)
+        self._changed()
+
+    def _checked_out_record(self, dbapi_connection, record, proxy):
+        self._checked_out.add(record)
+        self._changed()
+
+    def _checked_in_record(self, dbapi_connection, record):
+        self._checked_out.discard(record)
+        self._changed()
+
+    def _transaction_created(self, session, transaction):
+        # A session checks out its connection when its outermost transaction first needs one
+        if transaction.parent is None:
+            session.info["pool_checkout_started"] = time.perf_counter()
+
+    def _transaction_begun(self, session, transaction, connection):
+        started = session.info.pop("pool_checkout_started", None)
+        if started is not None and self.on_checkout:
+            self.on_checkout(time.perf_counter() - started)
+
+
+def make_engine(url: str = DATABASE_URL, pooler: str = DB_POOLER, pool_class: str = DB_POOL_CLASS):
+    """Creates an async engine for the given pooler ("direct" or "pgbouncer") and pool class."""
+    options = {"pool_pre_ping": DB_POOL_PRE_PING}
+    if pool_class == "null":
+        options["poolclass"] = NullPool
+    else:
+        options.update(
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_timeout=DB_POOL_TIMEOUT_SECONDS,
+            pool_recycle=DB_POOL_RECYCLE_SECONDS,
+        )
+    if pooler == "pgbouncer":
+        # A statement prepared on one server connection may be missing on the next, or its
+        # name may already be taken there: disable both statement caches and name each
+        # statement uniquely
+        options["connect_args"] = {
+            "statement_cache_size": 0,
+            "prepared_statement_cache_size": 0,
+            "prepared_statement_name_func": lambda: f"__asyncpg_{uuid.uuid4()}__",
+        }
+    return create_async_engine(url, **options)
+
+
+engine = make_engine()
+# expire_on_commit=False keeps loaded attributes usable after commit without an implicit
+# (and, under asyncio, impossible) lazy refresh when the response is serialized.
+# Session events are registered on the sync Session subclass behind it.
+class PooledSession(Session):
+    """The sync session behind SessionLocal; carries the PoolStats session listeners."""
+
+
+SessionLocal = async_sessionmaker(
+    bind=engine, autoflush=False, expire_on_commit=False, sync_session_class=PooledSession
+)
+pool_stats = PoolStats(engine.sync_engine.pool, PooledSession)
 Base = declarative_base()
 
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+async def get_db():
+    async with SessionLocal() as db:
+        try:
+            yield db
+        except Exception as e:
+            pool_stats.record_error(e)
+            raise
@@ -0,0 +1,92 @@
+# week09/example-2/backend/order_service/app/export.py
+
+import json
+from datetime import datetime
+from decimal import Decimal
+from typing import AsyncIterator, Optional
+
+from sqlalchemy import select
+
+from .models import Order, OrderItem
+
+# Fields of each exported order and of its items, as in OrderResponse
+ORDER_FIELDS = (
+    "order_id", "user_id", "order_date", "status", "total_amount",
+    "shipping_address", "created_at", "updated_at",
+)
+ITEM_FIELDS = (
+    "order_item_id", "product_id", "quantity", "price_at_purchase", "item_total",
+    "created_at", "updated_at",
+)
+
+
+def _json_default(value):
+    # Amounts are numbers in NDJSON, as in OrderResponse
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Cannot export {type(value).__name__} as JSON")
+
+
+def export_query(start: Optional[datetime], end: Optional[datetime], status: Optional[str]):
+    """
+    Orders joined to their items, ordered by (order_date, order_id) so each order's rows
+    are adjacent. The date range is looked up in the (order_date, order_id) index, or in
+    (status, order_date, order_id) when filtering by status, instead of scanning orders.
+    """
+    query = (
+        select(
+            *(getattr(Order, field) for field in ORDER_FIELDS),
+            *(getattr(OrderItem, field).label(f"item_{field}") for field in ITEM_FIELDS),
+        )
+        .outerjoin(OrderItem, OrderItem.order_id == Order.order_id)
+        .order_by(Order.order_date, Order.order_id, OrderItem.order_item_id)
+    )
+    if start:
+        query = query.filter(Order.order_date >= start)
+    if end:
+        query = query.filter(Order.order_date < end)
+    if status:
+        query = query.filter(Order.status == status)
+    return query
+
+
+async def export_orders(
+    session_factory,
+    batch_size: int,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    status: Optional[str] = None,
+) -> AsyncIterator[bytes]:
+    """
+    Streams the orders placed in [start, end), optionally with one status, as NDJSON:
+    one line per order with its items nested, oldest first. A single query is read
+    through a server-side cursor batch_size rows at a time, so memory use does not
+    grow with the number of orders exported.
+    """
+    query = export_query(start, end, status).execution_options(yield_per=batch_size)
+    # Rows are read by position: order columns first (order_id leading), then the item's
+    split = len(ORDER_FIELDS)
+    current, current_id = None, None
+    async with session_factory() as db:
+        connection = await db.connection()
+        result = await connection.stream(query)
+        async for rows in result.partitions():
+            lines = []
+            for row in rows:
+                if row[0] != current_id:
+                    # An order's rows may span two batches; it is written once complete
+                    if current is not None:
+                        lines.append(json.dumps(current, default=_json_default))
+                    current_id = row[0]
+                    current = dict(zip(ORDER_FIELDS, row[:split]))
+                    current["items"] = []
+                if row[split] is not None:
+                    item = dict(zip(ITEM_FIELDS, row[split:]))
+                    item["order_id"] = current_id
+                    current["items"].append(item)
+            if lines:
+                yield ("\n".join(lines) + "\n").encode()
+    if current is not None:
+        yield (json.dumps(current, default=_json_default) + "\n").encode()
@@ -0,0 +1,166 @@
+# week09/example-2/backend/order_service/app/idempotency.py
+
+import asyncio
+import hashlib
+import json
+import logging
+from datetime import timedelta
+from typing import Optional
+
+from fastapi import HTTPException, Response, status
+from sqlalchemy import delete, func, select, tuple_, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from .models import IdempotencyKey
+
+logger = logging.getLogger(__name__)
+
+# Request header naming the client's key, and the response header marking a replay
+IDEMPOTENCY_KEY_HEADER = "Idempotency-Key"
+IDEMPOTENT_REPLAYED_HEADER = "Idempotent-Replayed"
+
+
+def request_fingerprint(**params) -> str:
+    """
+    Hashes the parameters that define a request, so a key reused for a different
+    request can be told apart from a retry.
+    """
+    raw = json.dumps(params, sort_keys=True, separators=(",", ":"), default=str).encode()
+    return hashlib.sha256(raw).hexdigest()
+
+
+def _live_key(scope: str, key: str):
+    return select(IdempotencyKey).filter(
+        IdempotencyKey.scope == scope,
+        IdempotencyKey.idempotency_key == key,
+        IdempotencyKey.expires_at > func.now(),
+    )
+
+
+async def claim_idempotency_key(
+    db, scope: str, key: str, fingerprint: str, ttl_seconds: float
+) -> Optional[IdempotencyKey]:
+    """
+    Returns the stored record if a request with this key already completed; the caller
+    replays it. Otherwise inserts a claim on the key, valid for ttl_seconds, and
+    returns None. The caller commits the claim before doing its work, then calls
+    store_idempotent_response (with the longer replay TTL) and commits again. If the
+    work fails, the caller releases the claim with release_idempotency_key so the
+    client can retry; a claim left by an attempt that died is taken over once expired.
+
+    A replay costs one primary-key lookup. A request with the same key arriving while
+    the claim is held gets a 409 HTTPException; one sent with different parameters
+    gets a 422.
+    """
+    record = (await db.execute(_live_key(scope, key))).scalars().first()
+    if record is None:
+        expires_at = func.now() + timedelta(seconds=ttl_seconds)
+        claimed = await db.execute(
+            pg_insert(IdempotencyKey)
+            .values(scope=scope, idempotency_key=key, request_hash=fingerprint, expires_at=expires_at)
+            # An expired key that has not been purged yet is taken over
+            .on_conflict_do_update(
+                index_elements=[IdempotencyKey.scope, IdempotencyKey.idempotency_key],
+                set_={
+                    "request_hash": fingerprint,
+                    "status_code": None,
+                    "response_body": None,
+                    "created_at": func.now(),
+                    "expires_at": expires_at,
+                },
+                where=IdempotencyKey.expires_at <= func.now(),
+            )
+            .returning(IdempotencyKey.scope)
+        )
+        if claimed.first():
+            return None
+        # Another request committed this key while we waited on it
+        record = (await db.execute(_live_key(scope, key))).scalars().first()
+
+    if record is None or record.status_code is None:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="A request with this Idempotency-Key is still in progress. Retry later.",
+        )
+    if record.request_hash != fingerprint:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="Idempotency-Key was already used for a different request.",
+        )
+    return record
+
+
+async def store_idempotent_response(
+    db, scope: str, key: str, status_code: int, body: bytes, ttl_seconds: Optional[float] = None
+):
+    """
+    Saves the response for a claimed key; it commits with the caller's transaction.
+    With ttl_seconds, the key is kept that long from now instead of until the claim's expiry.
+    """
+    values = {"status_code": status_code, "response_body": body.decode()}
+    if ttl_seconds is not None:
+        values["expires_at"] = func.now() + timedelta(seconds=ttl_seconds)
+    await db.execute(
+        update(IdempotencyKey)
+        .where(IdempotencyKey.scope == scope, IdempotencyKey.idempotency_key == key)
+        .values(**values)
+    )
+
+
+async def release_idempotency_key(db, scope: str, key: str):
+    """
+    Deletes a committed claim whose request failed without storing a response, and
+    commits, so the client can retry with the same key.
+    """
+    await db.execute(
+        delete(IdempotencyKey).where(
+            IdempotencyKey.scope == scope,
+            IdempotencyKey.idempotency_key == key,
+            IdempotencyKey.status_code.is_(None),
+        )
+    )
+    await db.commit()
+
+
+def replay_response(record: IdempotencyKey) -> Response:
+    return Response(
+        content=record.response_body,
+        status_code=record.status_code,
+        media_type="application/json",
+        headers={IDEMPOTENT_REPLAYED_HEADER: "true"},
+    )
+
+
+async def purge_expired_idempotency_keys(db, batch_size: int) -> int:
+    """Deletes up to batch_size expired keys and commits. Returns the number deleted."""
+    expired = (
+        select(IdempotencyKey.scope, IdempotencyKey.idempotency_key)
+        .filter(IdempotencyKey.expires_at <= func.now())
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+    )
+    result = await db.execute(
+        delete(IdempotencyKey).where(
+            tuple_(IdempotencyKey.scope, IdempotencyKey.idempotency_key).in_(expired)
+        )
+    )
+    await db.commit()
+    return result.rowcount
+
+
+async def run_idempotency_key_purge(session_factory, interval_seconds: float, batch_size: int):
+    """Purges expired keys every interval_seconds, in batches, until cancelled."""
+    while True:
+        try:
+            purged = 0
+            async with session_factory() as db:
+                while True:
+                    deleted = await purge_expired_idempotency_keys(db, batch_size)
+                    purged += deleted
+                    if deleted < batch_size:
+                        break
+            if purged:
+                logger.info(f"Order Service: Purged {purged} expired idempotency keys.")
+        except Exception as e:
+            logger.error(f"Order Service: Idempotency key purge failed: {e}", exc_info=True)
+        await asyncio.sleep(interval_seconds)
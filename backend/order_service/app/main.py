@@ -1,26 +1,72 @@
 # week09/example-2/backend/order_service/app/main.py
 
+import asyncio
+import json
 import logging
 import os
 import sys
 import time
+import uuid
+from datetime import date, datetime
 from decimal import Decimal
 from typing import List, Optional
 
 import httpx
-from fastapi import Depends, FastAPI, HTTPException, Query, Response, status, Request
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Response, status, Request
 from fastapi.middleware.cors import CORSMiddleware
+from sqlalchemy import select, tuple_
 from sqlalchemy.exc import OperationalError
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
 
 # --- Prometheus client imports ---
-from prometheus_client import Counter, Histogram, Gauge, generate_latest
+from prometheus_client import Counter, Histogram, Gauge, generate_latest, multiprocess
 from prometheus_client.core import CollectorRegistry
-from starlette.responses import PlainTextResponse # Required for /metrics endpoint
-
-from .db import Base, engine, get_db
-from .models import Order, OrderItem
-from .schemas import OrderCreate, OrderItemResponse, OrderResponse, OrderUpdate
+from starlette.responses import PlainTextResponse, StreamingResponse # PlainTextResponse is required for /metrics
+
+from .aggregates import (
+    daily_totals,
+    product_totals,
+    record_order,
+    record_status_change,
+    run_rollup_fold,
+    status_totals,
+)
+from .db import (
+    DB_MAX_OVERFLOW,
+    DB_POOL_CLASS,
+    DB_POOL_SIZE,
+    SessionLocal,
+    engine,
+    get_db,
+    pool_stats,
+)
+from .export import export_orders
+from .idempotency import (
+    IDEMPOTENCY_KEY_HEADER,
+    IDEMPOTENT_REPLAYED_HEADER,
+    claim_idempotency_key,
+    release_idempotency_key,
+    replay_response,
+    request_fingerprint,
+    run_idempotency_key_purge,
+    store_idempotent_response,
+)
+from .metrics_labels import LabelGuard, route_template
+from .migrate import upgrade_schema
+from .models import Order, OrderItem, StockOutbox
+from .outbox import StockOutboxDispatcher
+from .pagination import NEXT_CURSOR_HEADER, decode_cursor, encode_cursor
+from .schemas import (
+    DailyOrderStats,
+    OrderCreate,
+    OrderItemCreate,
+    OrderItemResponse,
+    OrderResponse,
+    OrderUpdate,
+    ProductSalesStats,
+    StatusOrderStats,
+)
 
 # --- Standard Logging Configuration ---
 logging.basicConfig(
@@ -38,11 +84,66 @@ PRODUCT_SERVICE_URL = os.getenv("PRODUCT_SERVICE_URL", "http://localhost:8000")
 logger.info(
     f"Order Service: Configured to communicate with Product Service at: {PRODUCT_SERVICE_URL}"
 )
+# Product Service endpoints; the templates double as the target_endpoint metric label
+RESERVE_STOCK_ENDPOINT = "/products/stock/reserve"
+ADD_STOCK_ENDPOINT = "/products/{product_id}/add-stock"
+RELEASE_STOCK_ENDPOINT = "/products/stock/release"
+
+# Connection pool settings for the shared Product Service HTTP client.
+# The client only talks to the Product Service, so the pool-wide connection cap is also the per-host cap.
+PRODUCT_SERVICE_MAX_CONNECTIONS = int(os.getenv("PRODUCT_SERVICE_MAX_CONNECTIONS", "100"))
+PRODUCT_SERVICE_MAX_KEEPALIVE_CONNECTIONS = int(
+    os.getenv("PRODUCT_SERVICE_MAX_KEEPALIVE_CONNECTIONS", "20")
+)
+PRODUCT_SERVICE_KEEPALIVE_EXPIRY_SECONDS = float(
+    os.getenv("PRODUCT_SERVICE_KEEPALIVE_EXPIRY_SECONDS", "30")
+)
+# HTTP/2 is negotiated via ALPN, so it only takes effect when PRODUCT_SERVICE_URL is https://
+PRODUCT_SERVICE_HTTP2 = os.getenv("PRODUCT_SERVICE_HTTP2", "false").lower() == "true"
+# Most Product Service calls a single request may have in flight at once (e.g. restocking an order's items)
+PRODUCT_SERVICE_MAX_CONCURRENT_CALLS = int(os.getenv("PRODUCT_SERVICE_MAX_CONCURRENT_CALLS", "10"))
+
+# Stock outbox: compensating stock releases are queued in the orders database and delivered
+# in the background. Set OUTBOX_DISPATCHER_ENABLED=false to deliver from a separate
+# `python -m app.outbox` process instead of the API process.
+OUTBOX_DISPATCHER_ENABLED = os.getenv("OUTBOX_DISPATCHER_ENABLED", "true").lower() == "true"
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "50"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "10"))
+OUTBOX_RETRY_BASE_SECONDS = float(os.getenv("OUTBOX_RETRY_BASE_SECONDS", "1"))
+OUTBOX_RETRY_MAX_SECONDS = float(os.getenv("OUTBOX_RETRY_MAX_SECONDS", "300"))
+OUTBOX_POLL_INTERVAL_SECONDS = float(os.getenv("OUTBOX_POLL_INTERVAL_SECONDS", "2"))
+# A claimed batch is due again after this long if its dispatcher never records the outcome;
+# keep it well above the 10 s release request timeout
+OUTBOX_LEASE_SECONDS = float(os.getenv("OUTBOX_LEASE_SECONDS", "60"))
+
+# Responses to orders created with an Idempotency-Key are kept this long for replay
+IDEMPOTENCY_KEY_TTL_SECONDS = float(os.getenv("IDEMPOTENCY_KEY_TTL_SECONDS", "86400"))
+# A key claimed by an order still being created is taken over by a retry after this long,
+# in case the attempt holding it died; keep it above the stock reservation timeout
+IDEMPOTENCY_CLAIM_LEASE_SECONDS = float(os.getenv("IDEMPOTENCY_CLAIM_LEASE_SECONDS", "60"))
+# Expired keys are deleted in the background this often (0 disables the purge), in batches
+IDEMPOTENCY_PURGE_INTERVAL_SECONDS = float(os.getenv("IDEMPOTENCY_PURGE_INTERVAL_SECONDS", "300"))
+IDEMPOTENCY_PURGE_BATCH_SIZE = int(os.getenv("IDEMPOTENCY_PURGE_BATCH_SIZE", "1000"))
+CREATE_ORDER_SCOPE = "POST /orders/"
+
+# Order changes append rollup deltas; they are folded into the rollups this often (0 disables
+# it in this process), at most this many per rollup and transaction
+ROLLUP_FOLD_INTERVAL_SECONDS = float(os.getenv("ROLLUP_FOLD_INTERVAL_SECONDS", "5"))
+ROLLUP_FOLD_BATCH_SIZE = int(os.getenv("ROLLUP_FOLD_BATCH_SIZE", "5000"))
+
+# GET /orders/export reads this many order item rows per fetch from its server-side cursor
+ORDER_EXPORT_BATCH_SIZE = int(os.getenv("ORDER_EXPORT_BATCH_SIZE", "2000"))
+NDJSON_CONTENT_TYPE = "application/x-ndjson"
 
 # --- Prometheus Metrics Initialization ---
 # Create a custom registry specific to this application instance
 registry = CollectorRegistry()
 APP_NAME = "order_service" # Unique identifier for this service in metrics
+# Set (by gunicorn.conf.py) when several worker processes serve the app. Each worker then
+# writes its metric values to files in this directory and /metrics aggregates all of them.
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+# Cardinality guard for the endpoint label of the HTTP metrics
+METRICS_MAX_ENDPOINT_LABELS = int(os.getenv("METRICS_MAX_ENDPOINT_LABELS", "200"))
 
 # Define Prometheus metrics (Basic HTTP Metrics)
 REQUEST_COUNT = Counter(
@@ -55,7 +156,8 @@ REQUEST_DURATION = Histogram(
 )
 REQUESTS_IN_PROGRESS = Gauge(
     'http_requests_in_progress', 'Number of HTTP requests in progress',
-    ['app_name', 'method', 'endpoint'], registry=registry
+    ['app_name', 'method', 'endpoint'], registry=registry,
+    multiprocess_mode='livesum',  # Summed over live workers in multiprocess mode
 )
 
 # Custom Metrics specific to Order Service business logic
@@ -71,6 +173,14 @@ ORDER_TOTAL_AMOUNT = Histogram(
     'order_total_amount_dollars', 'Total amount of orders in dollars',
     ['app_name'], registry=registry # This will provide buckets for order value distribution
 )
+STOCK_OUTBOX_TOTAL = Counter(
+    'stock_outbox_adjustments_total', 'Stock outbox adjustments by outcome (enqueued, delivered, retry, failed)',
+    ['app_name', 'result'], registry=registry
+)
+IDEMPOTENT_REQUESTS_TOTAL = Counter(
+    'idempotent_requests_total', 'Requests sent with an Idempotency-Key, by endpoint and result (stored or replayed)',
+    ['app_name', 'endpoint', 'result'], registry=registry
+)
 ORDER_STATUS_UPDATE_TOTAL = Counter(
     'order_status_update_total', 'Total order status updates',
     ['app_name', 'status'], registry=registry # status: success, not_found, db_error
@@ -84,6 +194,133 @@ PRODUCT_SERVICE_CALL_DURATION = Histogram(
     'product_service_call_duration_seconds', 'Duration of calls from Order Service to Product Service',
     ['app_name', 'target_endpoint', 'method', 'status_code'], registry=registry
 )
+# Metrics for the shared Product Service HTTP client connection pool
+PRODUCT_SERVICE_POOL_CONNECTIONS = Gauge(
+    'product_service_pool_connections', 'Connections held by the Product Service HTTP client pool',
+    ['app_name', 'state'], registry=registry # state: idle, active
+)
+PRODUCT_SERVICE_POOL_WAIT_DURATION = Histogram(
+    'product_service_pool_wait_seconds', 'Time a Product Service call waited for a pooled connection',
+    ['app_name'], registry=registry,
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+)
+# Metrics for the database connection pool, reported by app.db.pool_stats
+DB_POOL_CONNECTIONS = Gauge(
+    'db_pool_connections', 'Database connections held by the pool, by state (checked_out, idle)',
+    ['app_name', 'state'], registry=registry, multiprocess_mode='livesum'
+)
+DB_POOL_OVERFLOW = Gauge(
+    'db_pool_overflow_connections', 'Checked-out database connections beyond DB_POOL_SIZE',
+    ['app_name'], registry=registry, multiprocess_mode='livesum'
+)
+DB_POOL_CAPACITY = Gauge(
+    'db_pool_capacity_connections', 'Most database connections the pool may open (DB_POOL_SIZE + DB_MAX_OVERFLOW)',
+    ['app_name'], registry=registry, multiprocess_mode='livesum'
+)
+DB_POOL_CHECKOUT_DURATION = Histogram(
+    'db_pool_checkout_duration_seconds', 'Time for a session to check out its database connection, including waiting for a free one',
+    ['app_name'], registry=registry,
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+)
+DB_POOL_CHECKOUT_TIMEOUTS_TOTAL = Counter(
+    'db_pool_checkout_timeouts_total', 'Requests that failed waiting DB_POOL_TIMEOUT_SECONDS for a free database connection',
+    ['app_name'], registry=registry
+)
+
+
+def _observe_db_pool(stats):
+    DB_POOL_CONNECTIONS.labels(app_name=APP_NAME, state="checked_out").set(stats.checked_out)
+    DB_POOL_CONNECTIONS.labels(app_name=APP_NAME, state="idle").set(stats.idle)
+    # A null pool (DB_POOL_CLASS=null) opens every connection on demand and never overflows
+    overflow = max(stats.opened - DB_POOL_SIZE, 0) if DB_POOL_CLASS == "queue" else 0
+    DB_POOL_OVERFLOW.labels(app_name=APP_NAME).set(overflow)
+
+
+def _observe_db_pool_checkout(seconds: float):
+    DB_POOL_CHECKOUT_DURATION.labels(app_name=APP_NAME).observe(seconds)
+
+
+def _observe_db_pool_timeout():
+    DB_POOL_CHECKOUT_TIMEOUTS_TOTAL.labels(app_name=APP_NAME).inc()
+
+
+# A null pool has no limit of its own
+if DB_POOL_CLASS == "queue":
+    DB_POOL_CAPACITY.labels(app_name=APP_NAME).set(DB_POOL_SIZE + DB_MAX_OVERFLOW)
+pool_stats.on_change = _observe_db_pool
+pool_stats.on_checkout = _observe_db_pool_checkout
+pool_stats.on_timeout = _observe_db_pool_timeout
+
+
+class ProductServiceTransport(httpx.AsyncHTTPTransport):
+    """
+    Pooled transport for Product Service calls that records how long each request
+    waits for a connection and reports how many pooled connections are idle or active.
+    Both are followed through the trace events of each request; a trace callback the
+    caller set on the request still receives every event.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Sockets of the connections opened, dropped once closed
+        self._sockets = set()
+        # Requests holding a connection, from when the pool hands it over until the response is closed
+        self._active_requests = 0
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        queued_at = time.perf_counter()
+        caller_trace = request.extensions.get("trace")
+        connection_acquired = False
+        holding_connection = False
+
+        def release_connection():
+            nonlocal holding_connection
+            if holding_connection:
+                holding_connection = False
+                self._active_requests -= 1
+
+        async def trace(event_name: str, info: dict) -> None:
+            nonlocal connection_acquired, holding_connection
+            # The first connection-level event fires as soon as the pool hands a connection to this request
+            if not connection_acquired and event_name.endswith(".started"):
+                connection_acquired = holding_connection = True
+                self._active_requests += 1
+                PRODUCT_SERVICE_POOL_WAIT_DURATION.labels(app_name=APP_NAME).observe(time.perf_counter() - queued_at)
+            elif event_name.endswith("connect_tcp.complete"):
+                self._drop_closed_sockets()
+                self._sockets.add(info["return_value"].get_extra_info("socket"))
+            elif event_name.endswith(("response_closed.complete", "response_closed.failed")):
+                release_connection()
+            if caller_trace is not None:
+                await caller_trace(event_name, info)
+
+        request.extensions = {**request.extensions, "trace": trace}
+        try:
+            return await super().handle_async_request(request)
+        except BaseException:
+            release_connection()
+            raise
+
+    def _drop_closed_sockets(self):
+        self._sockets = {sock for sock in self._sockets if sock is not None and sock.fileno() != -1}
+
+    def connection_count(self, state: str) -> int:
+        self._drop_closed_sockets()
+        opened = len(self._sockets)
+        # Under HTTP/2 several requests share one connection
+        active = min(self._active_requests, opened)
+        return opened - active if state == "idle" else active
+
+
+def create_product_service_transport() -> ProductServiceTransport:
+    return ProductServiceTransport(
+        http2=PRODUCT_SERVICE_HTTP2,
+        limits=httpx.Limits(
+            max_connections=PRODUCT_SERVICE_MAX_CONNECTIONS,
+            max_keepalive_connections=PRODUCT_SERVICE_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=PRODUCT_SERVICE_KEEPALIVE_EXPIRY_SECONDS,
+        ),
+    )
 
 
 # --- FastAPI Application Setup ---
@@ -100,9 +337,13 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[NEXT_CURSOR_HEADER, IDEMPOTENT_REPLAYED_HEADER],
 )
 
 # --- Middleware for Prometheus Metrics ---
+# Upper bound on distinct endpoint label values; further ones are reported as "__other__"
+endpoint_label_guard = LabelGuard(METRICS_MAX_ENDPOINT_LABELS)
+
 @app.middleware("http")
 async def add_process_time_header(request: Request, call_next):
     # Exclude the /metrics endpoint itself from being tracked
@@ -111,7 +352,8 @@ async def add_process_time_header(request: Request, call_next):
         return response
 
     method = request.method
-    endpoint = request.url.path
+    # Label by route template, not the raw path, to keep one series per route
+    endpoint = endpoint_label_guard(route_template(request))
 
     # Increment requests in progress
     REQUESTS_IN_PROGRESS.labels(app_name=APP_NAME, method=method, endpoint=endpoint).inc()
@@ -132,11 +374,153 @@ async def add_process_time_header(request: Request, call_next):
     return response
 
 # --- Prometheus Metrics Endpoint ---
+def _metrics_registry() -> CollectorRegistry:
+    """
+    The registry to expose: this process's own, or in multiprocess mode one that
+    aggregates the metric files written by every worker.
+    """
+    if not PROMETHEUS_MULTIPROC_DIR:
+        return registry
+    aggregated = CollectorRegistry()
+    multiprocess.MultiProcessCollector(aggregated)
+    return aggregated
+
+
 # This is the endpoint Prometheus will scrape to collect metrics.
 @app.get("/metrics", response_class=PlainTextResponse, summary="Prometheus metrics endpoint")
 async def metrics():
     # generate_latest collects all metrics from the registry and formats them for Prometheus
-    return PlainTextResponse(generate_latest(registry))
+    return PlainTextResponse(generate_latest(_metrics_registry()))
+
+
+# --- Shared Product Service HTTP Client ---
+# A single pooled client lives for the lifetime of the application so keep-alive
+# connections to the Product Service are reused across requests.
+@app.on_event("startup")
+async def open_product_service_client():
+    app.state.product_service_transport = create_product_service_transport()
+    app.state.product_service_client = httpx.AsyncClient(
+        transport=app.state.product_service_transport
+    )
+    logger.info(
+        f"Order Service: Product Service HTTP client ready (max_connections={PRODUCT_SERVICE_MAX_CONNECTIONS}, max_keepalive_connections={PRODUCT_SERVICE_MAX_KEEPALIVE_CONNECTIONS}, keepalive_expiry={PRODUCT_SERVICE_KEEPALIVE_EXPIRY_SECONDS}s, http2={PRODUCT_SERVICE_HTTP2})."
+    )
+
+
+@app.on_event("shutdown")
+async def close_product_service_client():
+    await app.state.product_service_client.aclose()
+
+
+def create_stock_outbox_dispatcher(client: httpx.AsyncClient) -> StockOutboxDispatcher:
+    return StockOutboxDispatcher(
+        SessionLocal,
+        client,
+        f"{PRODUCT_SERVICE_URL}{RELEASE_STOCK_ENDPOINT}",
+        batch_size=OUTBOX_BATCH_SIZE,
+        max_attempts=OUTBOX_MAX_ATTEMPTS,
+        retry_base_seconds=OUTBOX_RETRY_BASE_SECONDS,
+        retry_max_seconds=OUTBOX_RETRY_MAX_SECONDS,
+        poll_interval_seconds=OUTBOX_POLL_INTERVAL_SECONDS,
+        lease_seconds=OUTBOX_LEASE_SECONDS,
+        on_result=lambda result, count: STOCK_OUTBOX_TOTAL.labels(app_name=APP_NAME, result=result).inc(count),
+    )
+
+
+# Registered after open_product_service_client, whose client it uses
+@app.on_event("startup")
+async def start_stock_outbox_dispatcher():
+    if not OUTBOX_DISPATCHER_ENABLED:
+        logger.info("Order Service: Stock outbox dispatcher disabled in this process.")
+        return
+    app.state.stock_outbox_dispatcher = create_stock_outbox_dispatcher(app.state.product_service_client)
+    app.state.stock_outbox_task = asyncio.create_task(app.state.stock_outbox_dispatcher.run())
+
+
+@app.on_event("shutdown")
+async def stop_stock_outbox_dispatcher():
+    task = getattr(app.state, "stock_outbox_task", None)
+    if task:
+        task.cancel()
+
+
+@app.on_event("startup")
+async def start_idempotency_key_purge():
+    if IDEMPOTENCY_PURGE_INTERVAL_SECONDS > 0:
+        app.state.idempotency_key_purge_task = asyncio.create_task(
+            run_idempotency_key_purge(
+                SessionLocal, IDEMPOTENCY_PURGE_INTERVAL_SECONDS, IDEMPOTENCY_PURGE_BATCH_SIZE
+            )
+        )
+
+
+@app.on_event("shutdown")
+async def stop_idempotency_key_purge():
+    task = getattr(app.state, "idempotency_key_purge_task", None)
+    if task:
+        task.cancel()
+
+
+@app.on_event("startup")
+async def start_rollup_fold():
+    if ROLLUP_FOLD_INTERVAL_SECONDS > 0:
+        app.state.rollup_fold_task = asyncio.create_task(
+            run_rollup_fold(SessionLocal, ROLLUP_FOLD_INTERVAL_SECONDS, ROLLUP_FOLD_BATCH_SIZE)
+        )
+
+
+@app.on_event("shutdown")
+async def stop_rollup_fold():
+    task = getattr(app.state, "rollup_fold_task", None)
+    if task:
+        task.cancel()
+
+
+def enqueue_stock_release(db: AsyncSession, items, reason: str, order_id: Optional[int] = None):
+    """
+    Adds outbox rows giving (product_id, quantity) stock back to the Product Service,
+    one per product. The caller commits them together with the change that caused them.
+    """
+    quantities = {}
+    for product_id, quantity in items:
+        quantities[product_id] = quantities.get(product_id, 0) + quantity
+    db.add_all(
+        StockOutbox(
+            idempotency_key=f"{reason}-{uuid.uuid4().hex}",
+            product_id=product_id,
+            quantity=quantity,
+            reason=reason,
+            order_id=order_id,
+        )
+        for product_id, quantity in quantities.items()
+    )
+    return len(quantities)
+
+
+def wake_stock_outbox_dispatcher():
+    dispatcher = getattr(app.state, "stock_outbox_dispatcher", None)
+    if dispatcher:
+        dispatcher.wake()
+
+
+def get_product_service_client(request: Request) -> httpx.AsyncClient:
+    return request.app.state.product_service_client
+
+
+def _pool_connection_count(state: str) -> int:
+    transport = getattr(app.state, "product_service_transport", None)
+    if transport is None:
+        return 0
+    return transport.connection_count(state)
+
+
+# Pool gauges are computed when /metrics is scraped. They describe a single process's pool,
+# so they are only exported when one process serves the app.
+if not PROMETHEUS_MULTIPROC_DIR:
+    for _state in ("idle", "active"):
+        PRODUCT_SERVICE_POOL_CONNECTIONS.labels(app_name=APP_NAME, state=_state).set_function(
+            lambda state=_state: _pool_connection_count(state)
+        )
 
 
 # --- FastAPI Event Handlers ---
@@ -147,20 +531,22 @@ async def startup_event():
     for i in range(max_retries):
         try:
             logger.info(
-                f"Order Service: Attempting to connect to PostgreSQL and create tables (attempt {i+1}/{max_retries})..."
+                f"Order Service: Attempting to connect to PostgreSQL and migrate the schema (attempt {i+1}/{max_retries})..."
             )
-            Base.metadata.create_all(bind=engine)
+            async with engine.begin() as conn:
+                # Applies pending Alembic migrations; one worker or replica at a time
+                await conn.run_sync(upgrade_schema)
             logger.info(
-                "Order Service: Successfully connected to PostgreSQL and ensured tables exist."
+                "Order Service: Successfully connected to PostgreSQL and migrated the schema."
             )
             break  # Exit loop if successful
-        except OperationalError as e:
+        except (OperationalError, OSError) as e:
             logger.warning(f"Order Service: Failed to connect to PostgreSQL: {e}")
             if i < max_retries - 1:
                 logger.info(
                     f"Order Service: Retrying in {retry_delay_seconds} seconds..."
                 )
-                time.sleep(retry_delay_seconds)
+                await asyncio.sleep(retry_delay_seconds)
             else:
                 logger.critical(
                     f"Order Service: Failed to connect to PostgreSQL after {max_retries} attempts. Exiting application."
@@ -191,7 +577,25 @@ async def health_check():
     status_code=status.HTTP_201_CREATED,
     summary="Create a new order",
 )
-async def create_order(order: OrderCreate, db: Session = Depends(get_db)):
+async def create_order(
+    order: OrderCreate,
+    db: AsyncSession = Depends(get_db),
+    client: httpx.AsyncClient = Depends(get_product_service_client),
+    idempotency_key: Optional[str] = Header(None, alias=IDEMPOTENCY_KEY_HEADER, min_length=1, max_length=255),
+):
+    """
+    Reserves stock for the items and saves the order.
+
+    With an Idempotency-Key header, the created order's response is stored with it and
+    a retry with the same key gets that response back without reserving stock again.
+    The key is claimed and committed before the reservation, so no transaction is held
+    open across the Product Service call; a retry that arrives meanwhile gets a 409.
+    The reservation is sent with a key derived from the order's, so a retry after a
+    reservation whose response was lost is answered by the Product Service without
+    reserving twice. Failed reservations release the key for a retry; an order that
+    could not be saved after its stock was reserved (and queued for release) stores
+    its 500 response, since replaying that reservation would not reserve stock again.
+    """
     if not order.items:
         ORDER_CREATION_TOTAL.labels(app_name=APP_NAME, status="no_items").inc()
         raise HTTPException(
@@ -199,138 +603,87 @@ async def create_order(order: OrderCreate, db: Session = Depends(get_db)):
             detail="Order must contain at least one item.",
         )
 
-    # List to store successfully deducted items in case of partial failures
-    successfully_deducted_items = []
     logger.info(f"Order Service: Creating new order for user_id: {order.user_id}")
 
-    order_overall_success = True # Flag to track if all items processed successfully
-
-    # Use an httpx client for synchronous calls to the Product Service
-    async with httpx.AsyncClient() as client:
-        for item in order.items:
-            product_id = item.product_id
-            quantity = item.quantity
-
-            # --- Metrics for Product Service Calls (GET product details) ---
-            product_detail_url = f"{PRODUCT_SERVICE_URL}/products/{product_id}"
-            product_detail_call_start = time.time()
-            product_detail_call_status = "unknown"
-
-            try:
-                # Get product details (needed for product_name and initial stock check)
-                product_response = await client.get(product_detail_url, timeout=5)
-                product_response.raise_for_status()
-                product_data = product_response.json()
-                product_detail_call_status = str(product_response.status_code)
-                logger.info(f"Order Service: Fetched product details for {product_id}.")
-
-            except httpx.RequestError as e:
-                logger.critical(f"Order Service: Network error getting product details from Product Service for product {product_id}: {e}")
-                order_overall_success = False
-                product_detail_call_status = "network_error"
-                raise HTTPException(
-                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
-                    detail=f"Product Service is currently unavailable for details lookup. Error: {e}",
-                )
-            except httpx.HTTPStatusError as e:
-                logger.error(f"Order Service: Product Service returned error for product details {product_id}: {e.response.status_code} - {e.response.text}")
-                order_overall_success = False
-                product_detail_call_status = str(e.response.status_code)
-                if e.response.status_code == status.HTTP_404_NOT_FOUND:
-                    raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Product {product_id} not found.")
-                raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Error fetching product details: {e.response.text}")
-            finally:
-                product_detail_call_duration = time.time() - product_detail_call_start
-                PRODUCT_SERVICE_CALL_TOTAL.labels(app_name=APP_NAME, target_endpoint=product_detail_url, method="GET", status_code=product_detail_call_status).inc()
-                PRODUCT_SERVICE_CALL_DURATION.labels(app_name=APP_NAME, target_endpoint=product_detail_url, method="GET", status_code=product_detail_call_status).observe(product_detail_call_duration)
-            
-            # --- Check stock and deduct (PATCH stock) ---
-            deduct_stock_url = f"{PRODUCT_SERVICE_URL}/products/{product_id}/deduct-stock"
-            deduct_stock_call_start = time.time()
-            deduct_stock_call_status = "unknown"
-
-            try:
-                # Check for insufficient stock before attempting to deduct
-                if product_data["stock_quantity"] < quantity:
-                    logger.warning(
-                        f"Order Service: Insufficient stock for product {product_data['name']} (ID: {product_id}). Requested {quantity}, available {product_data['stock_quantity']}."
-                    )
-                    order_overall_success = False # Mark order as failed due to stock
-                    deduct_stock_call_status = "insufficient_stock"
-                    # We still record the failed deduction attempt if an explicit error is raised below
-                    raise HTTPException(
-                        status_code=status.HTTP_400_BAD_REQUEST,
-                        detail=f"Insufficient stock for product '{product_data['name']}'. Only {product_data['stock_quantity']} available.",
-                    )
-
-                # Synchronous PATCH call to Product Service to deduct stock
-                response = await client.patch(
-                    deduct_stock_url,
-                    json={"quantity_to_deduct": quantity}, # Ensure this matches Product Service schema
-                    timeout=5,  # Set a timeout for the external API call
-                )
-                response.raise_for_status()  # Raise an exception for 4xx/5xx responses
-                deduct_stock_call_status = str(response.status_code)
+    if idempotency_key:
+        stored = await claim_idempotency_key(
+            db,
+            CREATE_ORDER_SCOPE,
+            idempotency_key,
+            request_fingerprint(order=order.model_dump(mode="json")),
+            IDEMPOTENCY_CLAIM_LEASE_SECONDS,
+        )
+        if stored:
+            logger.info(f"Order Service: Replaying stored order response for Idempotency-Key {idempotency_key}.")
+            IDEMPOTENT_REQUESTS_TOTAL.labels(app_name=APP_NAME, endpoint=CREATE_ORDER_SCOPE, result="replayed").inc()
+            return replay_response(stored)
+        await db.commit()
+
+    # --- Reserve stock for all items in a single call (POST stock/reserve) ---
+    # Product Service validates and deducts every item in one transaction (all-or-nothing),
+    # so a failure here leaves no partial deductions behind to roll back.
+    reserve_stock_url = f"{PRODUCT_SERVICE_URL}{RESERVE_STOCK_ENDPOINT}"
+    reserve_stock_call_start = time.time()
+    reserve_stock_call_status = "unknown"
 
-                logger.info(
-                    f"Order Service: Stock deduction successful for product {product_id}."
-                )
-                successfully_deducted_items.append(item)
-                ORDER_ITEM_COUNT.labels(app_name=APP_NAME, product_id=product_id).inc(quantity)
-
-            except httpx.HTTPStatusError as e:
-                # Handle specific HTTP errors from Product Service
-                error_detail = "Unknown error during stock deduction."
-                if e.response.status_code == status.HTTP_404_NOT_FOUND:
-                    error_detail = f"Product {product_id} not found."
-                elif e.response.status_code == status.HTTP_400_BAD_REQUEST:
-                    response_json = e.response.json()
-                    error_detail = response_json.get(
-                        "detail", "Insufficient stock or invalid request."
-                    )
-
-                logger.error(
-                    f"Order Service: Stock deduction failed for product {product_id}: {error_detail}. Status: {e.response.status_code}"
-                )
-                order_overall_success = False
-                deduct_stock_call_status = str(e.response.status_code)
-                # Rollback any previously successful deductions in case of failure
-                await _rollback_stock_deductions(client, successfully_deducted_items)
-                raise HTTPException(
-                    status_code=status.HTTP_400_BAD_REQUEST,  # Or appropriate status
-                    detail=f"Failed to deduct stock for product {product_id}: {error_detail}",
-                )
-            except httpx.RequestError as e:
-                # Handle network errors (e.g., Product Service is down)
-                logger.critical(
-                    f"Order Service: Network error communicating with Product Service for product {product_id} during deduction: {e}"
-                )
-                order_overall_success = False
-                deduct_stock_call_status = "network_error"
-                await _rollback_stock_deductions(client, successfully_deducted_items)
-                raise HTTPException(
-                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
-                    detail=f"Product Service is currently unavailable for stock deduction. Please try again later. Error: {e}",
-                )
-            except Exception as e:
-                # Catch any other unexpected errors during deduction
-                logger.error(
-                    f"Order Service: An unexpected error occurred during stock deduction for product {product_id}: {e}",
-                    exc_info=True,
-                )
-                order_overall_success = False
-                deduct_stock_call_status = "internal_error"
-                await _rollback_stock_deductions(client, successfully_deducted_items)
-                raise HTTPException(
-                    status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                    detail=f"An unexpected error occurred during order creation: {e}",
-                )
-            finally:
-                # Record metrics for the stock deduction call
-                deduct_stock_call_duration = time.time() - deduct_stock_call_start
-                PRODUCT_SERVICE_CALL_TOTAL.labels(app_name=APP_NAME, target_endpoint=deduct_stock_url, method="PATCH", status_code=deduct_stock_call_status).inc()
-                PRODUCT_SERVICE_CALL_DURATION.labels(app_name=APP_NAME, target_endpoint=deduct_stock_url, method="PATCH", status_code=deduct_stock_call_status).observe(deduct_stock_call_duration)
+    try:
+        response = await client.post(
+            reserve_stock_url,
+            json={
+                "items": [
+                    {"product_id": item.product_id, "quantity": item.quantity}
+                    for item in order.items
+                ]
+            },
+            headers={IDEMPOTENCY_KEY_HEADER: f"{idempotency_key}:reserve"} if idempotency_key else None,
+            timeout=5,  # Set a timeout for the external API call
+        )
+        response.raise_for_status()  # Raise an exception for 4xx/5xx responses
+        reserve_stock_call_status = str(response.status_code)
+        logger.info(
+            f"Order Service: Stock reservation successful for {len(order.items)} items."
+        )
 
+    except httpx.HTTPStatusError as e:
+        # Handle specific HTTP errors from Product Service
+        error_detail = "Unknown error during stock reservation."
+        if e.response.status_code in (
+            status.HTTP_404_NOT_FOUND,
+            status.HTTP_400_BAD_REQUEST,
+        ):
+            response_json = e.response.json()
+            error_detail = response_json.get(
+                "detail", "Product not found, insufficient stock or invalid request."
+            )
+
+        logger.error(
+            f"Order Service: Stock reservation failed: {error_detail}. Status: {e.response.status_code}"
+        )
+        reserve_stock_call_status = str(e.response.status_code)
+        await _release_order_key(db, idempotency_key)
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Failed to reserve stock: {error_detail}",
+        )
+    except httpx.RequestError as e:
+        # Handle network errors (e.g., Product Service is down)
+        logger.critical(
+            f"Order Service: Network error communicating with Product Service during stock reservation: {e}"
+        )
+        reserve_stock_call_status = "network_error"
+        await _release_order_key(db, idempotency_key)
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=f"Product Service is currently unavailable for stock reservation. Please try again later. Error: {e}",
+        )
+    finally:
+        # Record metrics for the stock reservation call
+        reserve_stock_call_duration = time.time() - reserve_stock_call_start
+        PRODUCT_SERVICE_CALL_TOTAL.labels(app_name=APP_NAME, target_endpoint=RESERVE_STOCK_ENDPOINT, method="POST", status_code=reserve_stock_call_status).inc()
+        PRODUCT_SERVICE_CALL_DURATION.labels(app_name=APP_NAME, target_endpoint=RESERVE_STOCK_ENDPOINT, method="POST", status_code=reserve_stock_call_status).observe(reserve_stock_call_duration)
+
+    for item in order.items:
+        ORDER_ITEM_COUNT.labels(app_name=APP_NAME, product_id=item.product_id).inc(item.quantity)
 
     # If all stock deductions are successful, proceed with order creation in DB
     logger.info(
@@ -339,7 +692,7 @@ async def create_order(order: OrderCreate, db: Session = Depends(get_db)):
 
     total_amount = sum(
         Decimal(str(item.quantity)) * Decimal(str(item.price_at_purchase))
-        for item in successfully_deducted_items # Use successfully deducted items for total amount
+        for item in order.items
     )
 
     db_order = Order(
@@ -350,9 +703,9 @@ async def create_order(order: OrderCreate, db: Session = Depends(get_db)):
     )
 
     db.add(db_order)
-    db.flush()  # Use flush to get order_id before committing, needed for order items
+    await db.flush()  # Use flush to get order_id before committing, needed for order items
 
-    for item in successfully_deducted_items: # Use successfully deducted items
+    for item in order.items:
         db_order_item = OrderItem(
             order_id=db_order.order_id,
             product_id=item.product_id,
@@ -366,77 +719,149 @@ async def create_order(order: OrderCreate, db: Session = Depends(get_db)):
     try:
         # After successful stock deductions and before final commit, update status to 'confirmed'
         db_order.status = "confirmed"  # Set status to confirmed here
-        db.commit()
-        db.refresh(db_order)
-        # Ensure order items are loaded for the response model
-        db.add(db_order)  # Re-add to session if detached by refresh or commit
-        db.refresh(db_order, attribute_names=["items"])
+        await db.flush()
+        await db.refresh(db_order)
+        # Ensure order items are loaded for the response model (no lazy loading under asyncio)
+        await db.refresh(db_order, attribute_names=["items"])
+        body = None
+        if idempotency_key:
+            # Stored in the order's transaction, so the order and its replayable response commit together
+            body = OrderResponse.model_validate(db_order).model_dump_json().encode()
+            await store_idempotent_response(
+                db, CREATE_ORDER_SCOPE, idempotency_key, status.HTTP_201_CREATED, body, IDEMPOTENCY_KEY_TTL_SECONDS
+            )
+        await record_order(db, db_order, db_order.items)
+        await db.commit()
         logger.info(
             f"Order Service: Order {db_order.order_id} created and confirmed successfully for user {db_order.user_id}."
         )
         ORDER_CREATION_TOTAL.labels(app_name=APP_NAME, status="success").inc()
         ORDER_TOTAL_AMOUNT.labels(app_name=APP_NAME).observe(float(total_amount)) # Record order total amount
+        if body is not None:
+            IDEMPOTENT_REQUESTS_TOTAL.labels(app_name=APP_NAME, endpoint=CREATE_ORDER_SCOPE, result="stored").inc()
+            return Response(content=body, status_code=status.HTTP_201_CREATED, media_type="application/json")
         return db_order
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         logger.error(
             f"Order Service: Error creating order after successful stock deductions: {e}",
             exc_info=True,
         )
         ORDER_CREATION_TOTAL.labels(app_name=APP_NAME, status="db_error").inc()
-        # CRITICAL: If DB commit fails here, you have a mismatch.
-        # In a real system, you'd likely need a compensation transaction or alerting.
-        # For this example, we log the severe error.
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="Order created but failed to save to database. Manual intervention required.",
-        )
+        detail = "Order created but failed to save to database. Manual intervention required."
+        if idempotency_key:
+            # Commits with the queued stock release below
+            await store_idempotent_response(
+                db,
+                CREATE_ORDER_SCOPE,
+                idempotency_key,
+                status.HTTP_500_INTERNAL_SERVER_ERROR,
+                json.dumps({"detail": detail}).encode(),
+                IDEMPOTENCY_KEY_TTL_SECONDS,
+            )
+        # Give the reserved stock back so Product Service does not drift from the orders table
+        await _rollback_stock_deductions(db, client, order.items)
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=detail)
 
 
-async def _rollback_stock_deductions(client: httpx.AsyncClient, items: List[OrderItem]):
-    if not items:
+async def _release_order_key(db: AsyncSession, idempotency_key: Optional[str]):
+    """Releases an order's Idempotency-Key after a failed reservation, so the client can retry with it."""
+    if not idempotency_key:
         return
+    try:
+        await release_idempotency_key(db, CREATE_ORDER_SCOPE, idempotency_key)
+    except Exception as e:
+        await db.rollback()
+        # The claim's lease still runs out, after which a retry takes the key over
+        logger.error(f"Order Service: Could not release Idempotency-Key {idempotency_key}: {e}", exc_info=True)
 
-    logger.warning(
-        "Order Service: Attempting to rollback stock deductions due to order creation failure or upstream error."
-    )
-    for item in items:
-        product_id = item.product_id
-        quantity = item.quantity
-        add_stock_url = f"{PRODUCT_SERVICE_URL}/products/{product_id}/add-stock" # Product Service has an explicit add-stock endpoint now
 
+async def _add_stock(
+    client: httpx.AsyncClient, product_id: int, quantity: int, action: str, semaphore: asyncio.Semaphore
+):
+    """Adds stock back for one product. Failures are logged and recorded, never raised."""
+    add_stock_url = f"{PRODUCT_SERVICE_URL}{ADD_STOCK_ENDPOINT.format(product_id=product_id)}"
+    async with semaphore:
         add_stock_call_start = time.time()
         add_stock_call_status = "unknown"
         try:
-            # Call Product Service to add stock back
             response = await client.patch(
                 add_stock_url,
                 json={"quantity_to_deduct": quantity}, # Use quantity_to_deduct as schema expects
                 timeout=5,
             )
             response.raise_for_status()
-            logger.info(f"Order Service: Successfully rolled back {quantity} stock for product {product_id}.")
+            logger.info(f"Order Service: Successfully completed stock {action} of {quantity} units for product {product_id}.")
             add_stock_call_status = str(response.status_code)
         except httpx.RequestError as e:
             logger.critical(
-                f"Order Service: CRITICAL: Failed to connect to Product Service for stock rollback for product {product_id}: {e}. Manual intervention required!"
+                f"Order Service: CRITICAL: Failed to connect to Product Service for stock {action} for product {product_id}: {e}. Manual intervention required!"
             )
             add_stock_call_status = "network_error"
         except httpx.HTTPStatusError as e:
             logger.critical(
-                f"Order Service: CRITICAL: Product Service returned error {e.response.status_code} for stock rollback for product {product_id}: {e.response.text}. Manual intervention required!"
+                f"Order Service: CRITICAL: Product Service returned error {e.response.status_code} for stock {action} for product {product_id}: {e.response.text}. Manual intervention required!"
             )
             add_stock_call_status = str(e.response.status_code)
         except Exception as e:
             logger.critical(
-                f"Order Service: CRITICAL: Unexpected error during stock rollback for product {product_id}: {e}. Manual intervention required!",
+                f"Order Service: CRITICAL: Unexpected error during stock {action} for product {product_id}: {e}. Manual intervention required!",
                 exc_info=True,
             )
             add_stock_call_status = "internal_error"
         finally:
             add_stock_call_duration = time.time() - add_stock_call_start
-            PRODUCT_SERVICE_CALL_TOTAL.labels(app_name=APP_NAME, target_endpoint=add_stock_url, method="PATCH", status_code=add_stock_call_status).inc()
-            PRODUCT_SERVICE_CALL_DURATION.labels(app_name=APP_NAME, target_endpoint=add_stock_url, method="PATCH", status_code=add_stock_call_status).observe(add_stock_call_duration)
+            PRODUCT_SERVICE_CALL_TOTAL.labels(app_name=APP_NAME, target_endpoint=ADD_STOCK_ENDPOINT, method="PATCH", status_code=add_stock_call_status).inc()
+            PRODUCT_SERVICE_CALL_DURATION.labels(app_name=APP_NAME, target_endpoint=ADD_STOCK_ENDPOINT, method="PATCH", status_code=add_stock_call_status).observe(add_stock_call_duration)
+
+
+async def _add_stock_for_items(client: httpx.AsyncClient, items, action: str):
+    """
+    Adds stock back for (product_id, quantity) pairs, one call per product, with at most
+    PRODUCT_SERVICE_MAX_CONCURRENT_CALLS in flight, so the total time tracks the slowest
+    call rather than the sum of all of them.
+    """
+    quantities = {}
+    for product_id, quantity in items:
+        quantities[product_id] = quantities.get(product_id, 0) + quantity
+    semaphore = asyncio.Semaphore(PRODUCT_SERVICE_MAX_CONCURRENT_CALLS)
+    await asyncio.gather(
+        *(
+            _add_stock(client, product_id, quantity, action, semaphore)
+            for product_id, quantity in quantities.items()
+        )
+    )
+
+
+async def _rollback_stock_deductions(
+    db: AsyncSession, client: httpx.AsyncClient, items: List[OrderItemCreate]
+):
+    """
+    Queues the reserved stock to be given back through the outbox. Only if the outbox
+    row cannot be written either are the Product Service calls made directly.
+    """
+    if not items:
+        return
+
+    logger.warning(
+        "Order Service: Attempting to rollback stock deductions due to order creation failure or upstream error."
+    )
+    try:
+        enqueued = enqueue_stock_release(
+            db, [(item.product_id, item.quantity) for item in items], "order_create_failed"
+        )
+        await db.commit()
+        STOCK_OUTBOX_TOTAL.labels(app_name=APP_NAME, result="enqueued").inc(enqueued)
+        wake_stock_outbox_dispatcher()
+    except Exception as e:
+        await db.rollback()
+        logger.error(
+            f"Order Service: Could not queue stock rollback in the outbox, calling Product Service directly: {e}",
+            exc_info=True,
+        )
+        await _add_stock_for_items(
+            client, [(item.product_id, item.quantity) for item in items], "rollback"
+        )
 
 
 @app.get(
@@ -444,41 +869,158 @@ async def _rollback_stock_deductions(client: httpx.AsyncClient, items: List[Orde
     response_model=List[OrderResponse],
     summary="Retrieve a list of all orders",
 )
-def list_orders(
-    db: Session = Depends(get_db),
+async def list_orders(
+    response: Response,
+    db: AsyncSession = Depends(get_db),
     skip: int = Query(0, ge=0),
     limit: int = Query(100, ge=1, le=100),
     user_id: Optional[int] = Query(None, ge=1, description="Filter orders by user ID."),
-    status: Optional[str] = Query(
+    order_status: Optional[str] = Query(
         None,
+        alias="status",
         max_length=50,
         description="Filter orders by status (e.g., pending, shipped).",
     ),
+    cursor: Optional[str] = Query(
+        None,
+        max_length=512,
+        description=f"Opaque cursor from the {NEXT_CURSOR_HEADER} header of the previous page.",
+    ),
 ):
-
+    """
+    Lists orders newest first. When a page is full, the X-Next-Cursor response
+    header holds the cursor for the next one.
+    """
     logger.info(
-        f"Order Service: Listing orders (skip={skip}, limit={limit}, user_id={user_id}, status='{status}')"
+        f"Order Service: Listing orders (skip={skip}, limit={limit}, user_id={user_id}, status='{order_status}', cursor={cursor})"
     )
-    query = db.query(Order)
+    # Items are part of OrderResponse; load them up front as lazy loads are not possible under asyncio
+    query = select(Order).options(selectinload(Order.items))
 
     if user_id:
         query = query.filter(Order.user_id == user_id)
-    if status:
-        query = query.filter(Order.status == status)
+    if order_status:
+        query = query.filter(Order.status == order_status)
+    if cursor:
+        if skip:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="skip cannot be combined with cursor.",
+            )
+        # Keyset pagination: seek straight past the last order of the previous page
+        position = decode_cursor(cursor, order_date=datetime.fromisoformat, order_id=int)
+        query = query.filter(
+            tuple_(Order.order_date, Order.order_id)
+            < tuple_(position["order_date"], position["order_id"])
+        )
+    query = query.order_by(Order.order_date.desc(), Order.order_id.desc())
 
-    orders = query.offset(skip).limit(limit).all()
+    orders = (await db.execute(query.offset(skip).limit(limit))).scalars().all()
+    if len(orders) == limit:
+        last = orders[-1]
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor(
+            order_date=last.order_date.isoformat(), order_id=last.order_id
+        )
     logger.info(f"Order Service: Retrieved {len(orders)} orders.")
     return orders
 
 
+def _check_day_range(start: Optional[date], end: Optional[date]):
+    if start and end and start >= end:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="start must be before end."
+        )
+
+
+# Order statistics are answered from the rollup tables maintained by app.aggregates; run
+# `python -m app.aggregates rebuild` once to add orders placed before they existed.
+@app.get(
+    "/orders/stats/daily",
+    response_model=List[DailyOrderStats],
+    summary="Orders and revenue per day",
+)
+async def get_daily_order_stats(
+    db: AsyncSession = Depends(get_db),
+    start: Optional[date] = Query(None, description="First day (UTC) to include."),
+    end: Optional[date] = Query(None, description="Day (UTC) after the last one to include."),
+    order_status: Optional[str] = Query(
+        None, alias="status", max_length=50, description="Only orders currently in this status."
+    ),
+):
+    _check_day_range(start, end)
+    return await daily_totals(db, start, end, order_status)
+
+
+@app.get(
+    "/orders/stats/statuses",
+    response_model=List[StatusOrderStats],
+    summary="Orders and revenue per order status",
+)
+async def get_status_order_stats(
+    db: AsyncSession = Depends(get_db),
+    start: Optional[date] = Query(None, description="First day (UTC) to include."),
+    end: Optional[date] = Query(None, description="Day (UTC) after the last one to include."),
+):
+    _check_day_range(start, end)
+    return await status_totals(db, start, end)
+
+
+@app.get(
+    "/orders/stats/products",
+    response_model=List[ProductSalesStats],
+    summary="Units sold and revenue per product, best sellers first",
+)
+async def get_product_sales_stats(
+    db: AsyncSession = Depends(get_db),
+    start: Optional[date] = Query(None, description="First day (UTC) to include."),
+    end: Optional[date] = Query(None, description="Day (UTC) after the last one to include."),
+    product_id: Optional[int] = Query(None, ge=1, description="Only this product."),
+    limit: int = Query(20, ge=1, le=1000),
+):
+    _check_day_range(start, end)
+    return await product_totals(db, start, end, product_id, limit)
+
+
+# Declared before /orders/{order_id} so "export" is not taken for an order ID
+@app.get(
+    "/orders/export",
+    summary="Stream orders with their items as NDJSON",
+    response_class=StreamingResponse,
+)
+async def export_orders_ndjson(
+    start: Optional[datetime] = Query(None, description="Orders placed at or after this time."),
+    end: Optional[datetime] = Query(None, description="Orders placed before this time."),
+    order_status: Optional[str] = Query(
+        None, alias="status", max_length=50, description="Only orders with this status (e.g., shipped)."
+    ),
+):
+    """
+    Streams the matching orders oldest first, one JSON object per line with the items
+    nested, in a single pass over a server-side cursor. Intended for analytics extracts
+    of any size; use GET /orders/ for paging through orders interactively.
+    """
+    if start and end and start >= end:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="start must be before end."
+        )
+    logger.info(f"Order Service: Exporting orders (start={start}, end={end}, status='{order_status}').")
+    return StreamingResponse(
+        export_orders(SessionLocal, ORDER_EXPORT_BATCH_SIZE, start, end, order_status),
+        media_type=NDJSON_CONTENT_TYPE,
+        headers={"Content-Disposition": 'attachment; filename="orders.ndjson"'},
+    )
+
+
 @app.get(
     "/orders/{order_id}",
     response_model=OrderResponse,
     summary="Retrieve a single order by ID",
 )
-def get_order(order_id: int, db: Session = Depends(get_db)):
+async def get_order(order_id: int, db: AsyncSession = Depends(get_db)):
     logger.info(f"Order Service: Fetching order with ID: {order_id}")
-    order = db.query(Order).filter(Order.order_id == order_id).first()
+    order = await db.scalar(
+        select(Order).options(selectinload(Order.items)).filter(Order.order_id == order_id)
+    )
     if not order:
         logger.warning(f"Order Service: Order with ID {order_id} not found.")
         raise HTTPException(
@@ -501,12 +1043,14 @@ async def update_order_status(
     new_status: str = Query(
         ..., min_length=1, max_length=50, description="New status for the order."
     ),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ):
     logger.info(
         f"Order Service: Updating status for order {order_id} to '{new_status}'"
     )
-    db_order = db.query(Order).filter(Order.order_id == order_id).first()
+    db_order = await db.scalar(
+        select(Order).options(selectinload(Order.items)).filter(Order.order_id == order_id)
+    )
     if not db_order:
         logger.warning(
             f"Order Service: Order with ID {order_id} not found for status update."
@@ -521,15 +1065,17 @@ async def update_order_status(
 
     try:
         db.add(db_order)
-        db.commit()
-        db.refresh(db_order)
+        await record_status_change(db, db_order, old_status)
+        await db.commit()
+        await db.refresh(db_order)
+        await db.refresh(db_order, attribute_names=["items"])
         logger.info(
             f"Order Service: Order {order_id} status updated to '{new_status}' from '{old_status}'."
         )
         ORDER_STATUS_UPDATE_TOTAL.labels(app_name=APP_NAME, status="success").inc()
         return db_order
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         logger.error(
             f"Order Service: Error updating status for order {order_id}: {e}",
             exc_info=True,
@@ -546,26 +1092,31 @@ async def update_order_status(
     status_code=status.HTTP_204_NO_CONTENT,
     summary="Delete an order by ID",
 )
-async def delete_order(order_id: int, db: Session = Depends(get_db)): # Made async for rollback call
+async def delete_order(order_id: int, db: AsyncSession = Depends(get_db)):
+    """
+    Deletes an order. The stock it held is queued in the outbox in the same transaction
+    and given back to the Product Service in the background.
+    """
     logger.info(f"Order Service: Attempting to delete order with ID: {order_id}")
-    order = db.query(Order).filter(Order.order_id == order_id).first()
+    order = await db.scalar(
+        select(Order).options(selectinload(Order.items)).filter(Order.order_id == order_id)
+    )
     if not order:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="Order not found"
         )
 
     # Prepare items for rollback before deleting the order from DB
-    items_to_restock = [
-        {"product_id": item.product_id, "quantity": item.quantity}
-        for item in order.items
-    ]
+    items_to_restock = [(item.product_id, item.quantity) for item in order.items]
 
     try:
-        db.delete(order)
-        db.commit()
+        await db.delete(order)
+        enqueued = enqueue_stock_release(db, items_to_restock, "order_deleted", order_id=order_id)
+        await record_order(db, order, order.items, sign=-1)
+        await db.commit()
         logger.info(f"Order Service: Order (ID: {order_id}) deleted successfully from database.")
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         logger.error(
             f"Order Service: Error deleting order {order_id} from database: {e}", exc_info=True
         )
@@ -574,36 +1125,11 @@ async def delete_order(order_id: int, db: Session = Depends(get_db)): # Made asy
             detail="An error occurred while deleting the order from database.",
         )
     
-    # Attempt to restock products after order is deleted from DB
-    if items_to_restock:
-        logger.info(f"Order Service: Attempting to restock products for deleted order {order_id}.")
-        async with httpx.AsyncClient() as client:
-            for item_data in items_to_restock:
-                product_id = item_data["product_id"]
-                quantity = item_data["quantity"]
-                add_stock_url = f"{PRODUCT_SERVICE_URL}/products/{product_id}/add-stock"
-                
-                add_stock_call_start = time.time()
-                add_stock_call_status = "unknown"
-                try:
-                    response = await client.patch(add_stock_url, json={"quantity_to_deduct": quantity}, timeout=5)
-                    response.raise_for_status()
-                    logger.info(f"Order Service: Successfully restocked {quantity} units for product {product_id}.")
-                    add_stock_call_status = str(response.status_code)
-                except httpx.RequestError as e:
-                    logger.critical(f"Order Service: CRITICAL: Network error during restock for product {product_id}: {e}. Manual intervention required!")
-                    add_stock_call_status = "network_error"
-                except httpx.HTTPStatusError as e:
-                    logger.critical(f"Order Service: CRITICAL: Product Service returned error {e.response.status_code} during restock for product {product_id}: {e.response.text}. Manual intervention required!")
-                    add_stock_call_status = str(e.response.status_code)
-                except Exception as e:
-                    logger.critical(f"Order Service: CRITICAL: Unexpected error during restock for product {product_id}: {e}. Manual intervention required!", exc_info=True)
-                    add_stock_call_status = "internal_error"
-                finally:
-                    add_stock_call_duration = time.time() - add_stock_call_start
-                    PRODUCT_SERVICE_CALL_TOTAL.labels(app_name=APP_NAME, target_endpoint=add_stock_url, method="PATCH", status_code=add_stock_call_status).inc()
-                    PRODUCT_SERVICE_CALL_DURATION.labels(app_name=APP_NAME, target_endpoint=add_stock_url, method="PATCH", status_code=add_stock_call_status).observe(add_stock_call_duration)
-    
+    if enqueued:
+        logger.info(f"Order Service: Queued restock of {enqueued} products for deleted order {order_id}.")
+        STOCK_OUTBOX_TOTAL.labels(app_name=APP_NAME, result="enqueued").inc(enqueued)
+        wake_stock_outbox_dispatcher()
+
     return Response(status_code=status.HTTP_204_NO_CONTENT)
 
 
@@ -612,9 +1138,11 @@ async def delete_order(order_id: int, db: Session = Depends(get_db)): # Made asy
     response_model=List[OrderItemResponse],
     summary="Retrieve all items for a specific order",
 )
-def get_order_items(order_id: int, db: Session = Depends(get_db)):
+async def get_order_items(order_id: int, db: AsyncSession = Depends(get_db)):
     logger.info(f"Order Service: Fetching items for order ID: {order_id}")
-    order = db.query(Order).filter(Order.order_id == order_id).first()
+    order = await db.scalar(
+        select(Order).options(selectinload(Order.items)).filter(Order.order_id == order_id)
+    )
     if not order:
         logger.warning(
             f"Order Service: Order with ID {order_id} not found when fetching items."
@@ -0,0 +1,27 @@
+# week09/example-2/backend/order_service/app/migrate.py
+
+import os
+
+from alembic import command
+from alembic.config import Config
+
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Advisory lock key held (for the transaction) while migrating the schema
+SCHEMA_SETUP_LOCK_ID = 902002
+
+
+def alembic_config(connection=None) -> Config:
+    """The service's alembic.ini, usable from any working directory."""
+    config = Config(os.path.join(SERVICE_DIR, "alembic.ini"))
+    config.set_main_option("script_location", os.path.join(SERVICE_DIR, "migrations"))
+    if connection is not None:
+        config.attributes["connection"] = connection
+    return config
+
+
+def upgrade_schema(connection, revision: str = "head"):
+    """
+    Applies the pending migrations on a sync connection (AsyncConnection.run_sync), in
+    that connection's transaction; the caller commits.
+    """
+    command.upgrade(alembic_config(connection), revision)
@@ -1,6 +1,6 @@
 # week09/example-2/backend/order_service/app/models.py
 
-from sqlalchemy import Column, DateTime, ForeignKey, Integer, Numeric, String, Text
+from sqlalchemy import BigInteger, Column, Date, DateTime, ForeignKey, Index, Integer, Numeric, String, Text
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 
@@ -10,8 +10,8 @@ from .db import Base
 class Order(Base):
     __tablename__ = "orders_week09_example_02"
 
-    order_id = Column(Integer, primary_key=True, index=True, autoincrement=True)
-    user_id = Column(Integer, nullable=False, index=True)
+    order_id = Column(Integer, primary_key=True, autoincrement=True)
+    user_id = Column(Integer, nullable=False)
     order_date = Column(
         DateTime(timezone=True), server_default=func.now(), nullable=False
     )
@@ -22,8 +22,19 @@ class Order(Base):
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
 
     # Define a relationship to OrderItem for easy access to order items from an Order object
+    # Items must be eager-loaded (selectinload) by the query; an implicit lazy load would
+    # issue one query per order and is refused rather than silently allowed
     items = relationship(
-        "OrderItem", back_populates="order", cascade="all, delete-orphan"
+        "OrderItem", back_populates="order", cascade="all, delete-orphan", lazy="raise_on_sql"
+    )
+
+    # Serve the newest-first listing and its keyset cursor, unfiltered or by user or
+    # status, and the date-range export, in index order (scanned backwards for newest
+    # first). Schema changes go through Alembic migrations (migrations/versions).
+    __table_args__ = (
+        Index("ix_orders_week09_example_02_order_date_order_id", "order_date", "order_id"),
+        Index("ix_orders_week09_example_02_status_order_date_order_id", "status", "order_date", "order_id"),
+        Index("ix_orders_week09_example_02_user_id_order_date_order_id", "user_id", "order_date", "order_id"),
     )
 
     def __repr__(self):
@@ -54,3 +65,118 @@ class OrderItem(Base):
 
     def __repr__(self):
         return f"<OrderItem(id={self.order_item_id}, order_id={self.order_id}, product_id={self.product_id}, qty={self.quantity})>"
+
+
+class StockOutbox(Base):
+    # Stock adjustments owed to the Product Service. Rows are written in the same
+    # transaction as the order change that causes them and delivered later by
+    # app.outbox.StockOutboxDispatcher, so the request never waits on the call and a
+    # failed delivery is retried instead of lost.
+    __tablename__ = "stock_outbox_week09_example_02"
+
+    outbox_id = Column(Integer, primary_key=True, autoincrement=True)
+    # Sent with the adjustment; the Product Service applies each key at most once
+    idempotency_key = Column(String(100), nullable=False, unique=True)
+    product_id = Column(Integer, nullable=False)
+    quantity = Column(Integer, nullable=False)
+    reason = Column(String(50), nullable=False)  # e.g. order_deleted, order_create_failed
+    order_id = Column(Integer, nullable=True)  # No foreign key: the order may be gone
+    status = Column(String(20), nullable=False, default="pending")  # pending, delivered, failed
+    attempts = Column(Integer, nullable=False, default=0)
+    # Also the lease of a dispatcher delivering the row: it is due again if that one dies
+    next_attempt_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    last_error = Column(Text, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    delivered_at = Column(DateTime(timezone=True), nullable=True)
+
+    # The dispatcher polls for due pending rows
+    __table_args__ = (
+        Index("ix_stock_outbox_week09_example_02_status_next_attempt_at", "status", "next_attempt_at"),
+    )
+
+    def __repr__(self):
+        return f"<StockOutbox(id={self.outbox_id}, product_id={self.product_id}, qty={self.quantity}, status='{self.status}')>"
+
+
+class IdempotencyKey(Base):
+    # Completed responses of requests sent with an Idempotency-Key header, so a client
+    # retry is answered from here instead of being run again. The row is inserted and
+    # committed before the request does its work, with a short expiry, and a concurrent
+    # retry with the same key gets a 409 until the response is stored.
+    __tablename__ = "idempotency_keys_week09_example_02"
+
+    scope = Column(String(100), primary_key=True)  # Route template, e.g. POST /orders/
+    idempotency_key = Column(String(255), primary_key=True)
+    request_hash = Column(String(64), nullable=False)  # SHA-256 of the request parameters
+    status_code = Column(Integer, nullable=True)  # Set when the response is stored
+    response_body = Column(Text, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    expires_at = Column(DateTime(timezone=True), nullable=False, index=True)
+
+    def __repr__(self):
+        return f"<IdempotencyKey(scope='{self.scope}', key='{self.idempotency_key}', status={self.status_code})>"
+
+
+class OrderDailyStatusRollup(Base):
+    # Orders and revenue per UTC day of order_date and current status. Each order change
+    # appends its deltas to OrderStatusRollupDelta, which app.aggregates folds in here in
+    # the background; rebuilt from the orders table with `python -m app.aggregates rebuild`.
+    __tablename__ = "order_daily_status_rollups_week09_example_02"
+
+    day = Column(Date, primary_key=True)
+    status = Column(String(50), primary_key=True)
+    order_count = Column(BigInteger, nullable=False, default=0)
+    total_amount = Column(Numeric(14, 2), nullable=False, default=0)
+
+    def __repr__(self):
+        return f"<OrderDailyStatusRollup(day={self.day}, status='{self.status}', orders={self.order_count})>"
+
+
+class OrderDailyProductRollup(Base):
+    # Units, revenue and orders per UTC day of order_date and product, maintained like
+    # OrderDailyStatusRollup
+    __tablename__ = "order_daily_product_rollups_week09_example_02"
+
+    day = Column(Date, primary_key=True)
+    product_id = Column(Integer, primary_key=True)
+    units_sold = Column(BigInteger, nullable=False, default=0)
+    revenue = Column(Numeric(14, 2), nullable=False, default=0)
+    order_count = Column(BigInteger, nullable=False, default=0)
+
+    # One product's history; the primary key serves date ranges over all products
+    __table_args__ = (
+        Index("ix_order_daily_product_rollups_week09_example_02_product_id_day", "product_id", "day"),
+    )
+
+    def __repr__(self):
+        return f"<OrderDailyProductRollup(day={self.day}, product_id={self.product_id}, units={self.units_sold})>"
+
+
+class OrderStatusRollupDelta(Base):
+    # Changes to OrderDailyStatusRollup not folded into it yet. Order changes only insert
+    # here, so orders of the same day do not queue for the lock on one rollup row.
+    __tablename__ = "order_status_rollup_deltas_week09_example_02"
+
+    delta_id = Column(BigInteger, primary_key=True, autoincrement=True)
+    day = Column(Date, nullable=False)
+    status = Column(String(50), nullable=False)
+    order_count = Column(BigInteger, nullable=False)
+    total_amount = Column(Numeric(14, 2), nullable=False)
+
+    def __repr__(self):
+        return f"<OrderStatusRollupDelta(id={self.delta_id}, day={self.day}, status='{self.status}', orders={self.order_count})>"
+
+
+class OrderProductRollupDelta(Base):
+    # Changes to OrderDailyProductRollup not folded into it yet, like OrderStatusRollupDelta
+    __tablename__ = "order_product_rollup_deltas_week09_example_02"
+
+    delta_id = Column(BigInteger, primary_key=True, autoincrement=True)
+    day = Column(Date, nullable=False)
+    product_id = Column(Integer, nullable=False)
+    units_sold = Column(BigInteger, nullable=False)
+    revenue = Column(Numeric(14, 2), nullable=False)
+    order_count = Column(BigInteger, nullable=False)
+
+    def __repr__(self):
+        return f"<OrderProductRollupDelta(id={self.delta_id}, day={self.day}, product_id={self.product_id}, units={self.units_sold})>"
@@ -0,0 +1,214 @@
+# week09/example-2/backend/order_service/app/outbox.py
+
+import asyncio
+import logging
+from datetime import timedelta
+from typing import Callable, Optional
+
+import httpx
+from sqlalchemy import func, select, update
+
+from .models import StockOutbox
+
+logger = logging.getLogger(__name__)
+
+
+class StockOutboxDispatcher:
+    """
+    Delivers pending StockOutbox rows to the Product Service's stock release endpoint.
+
+    Each pass claims up to batch_size due rows with FOR UPDATE SKIP LOCKED (so several
+    dispatchers can run side by side) by moving their next_attempt_at lease_seconds
+    ahead, and commits. It then sends them in one request, holding no locks and no
+    connection, and records the outcome in a second short transaction, for the rows
+    whose lease it still holds. Rows of a dispatcher that dies mid-send are due again
+    once their lease runs out. Every row carries an idempotency key, so a batch that is
+    re-sent after a lost response or lease is not applied twice. Failed deliveries are
+    retried with exponential backoff until max_attempts, after which the row is
+    marked failed for manual follow-up.
+    """
+
+    def __init__(
+        self,
+        session_factory,
+        client: httpx.AsyncClient,
+        release_url: str,
+        batch_size: int = 50,
+        max_attempts: int = 10,
+        retry_base_seconds: float = 1.0,
+        retry_max_seconds: float = 300.0,
+        poll_interval_seconds: float = 2.0,
+        lease_seconds: float = 60.0,
+        on_result: Optional[Callable[[str, int], None]] = None,
+    ):
+        self.session_factory = session_factory
+        self.client = client
+        self.release_url = release_url
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_base_seconds = retry_base_seconds
+        self.retry_max_seconds = retry_max_seconds
+        self.poll_interval_seconds = poll_interval_seconds
+        self.lease_seconds = lease_seconds
+        self._on_result = on_result
+        self._wake = asyncio.Event()
+
+    def wake(self):
+        """Asks the dispatcher to run now instead of at the next poll."""
+        self._wake.set()
+
+    async def run(self):
+        """Dispatches until cancelled."""
+        logger.info(f"Order Service: Stock outbox dispatcher started (batch_size={self.batch_size}).")
+        while True:
+            self._wake.clear()
+            try:
+                # Keep going while full batches come back; there may be more due rows
+                while await self.dispatch_once() == self.batch_size:
+                    pass
+            except Exception as e:
+                logger.error(f"Order Service: Stock outbox dispatch failed: {e}", exc_info=True)
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.poll_interval_seconds)
+            except asyncio.TimeoutError:
+                pass
+
+    async def dispatch_once(self) -> int:
+        """Delivers one batch of due rows. Returns the number of rows handled."""
+        claimed, lease = await self._claim()
+        if not claimed:
+            return 0
+
+        error = None
+        try:
+            response = await self.client.post(
+                self.release_url,
+                json={
+                    "items": [
+                        {
+                            "idempotency_key": row.idempotency_key,
+                            "product_id": row.product_id,
+                            "quantity": row.quantity,
+                        }
+                        for row in claimed
+                    ]
+                },
+                timeout=10,
+            )
+            response.raise_for_status()
+            result = response.json()
+        except (httpx.HTTPError, ValueError) as e:
+            error = f"{type(e).__name__}: {e}"
+
+        async with self.session_factory() as db:
+            # Rows whose lease ran out meanwhile may have been claimed again; leave them be
+            rows = (
+                await db.execute(
+                    select(StockOutbox)
+                    .filter(
+                        StockOutbox.outbox_id.in_([row.outbox_id for row in claimed]),
+                        StockOutbox.status == "pending",
+                        StockOutbox.next_attempt_at == lease,
+                    )
+                    .order_by(StockOutbox.outbox_id)
+                    .with_for_update()
+                )
+            ).scalars().all()
+            if len(rows) < len(claimed):
+                logger.warning(
+                    f"Order Service: Stock outbox lease expired for {len(claimed) - len(rows)} adjustments before their outcome was recorded."
+                )
+            if error is not None:
+                if rows:
+                    self._schedule_retry(rows, error)
+                await db.commit()
+                return len(claimed)
+
+            delivered_keys = set(result["applied"]) | set(result["duplicates"])
+            missing_keys = set(result["missing"])
+            undelivered = []
+            for row in rows:
+                if row.idempotency_key in delivered_keys:
+                    row.status = "delivered"
+                    row.delivered_at = func.now()
+                elif row.idempotency_key in missing_keys:
+                    row.status = "failed"
+                    row.last_error = "Product no longer exists."
+                    logger.critical(
+                        f"Order Service: CRITICAL: Stock release of {row.quantity} units for deleted product {row.product_id} (outbox {row.outbox_id}) cannot be applied."
+                    )
+                else:
+                    undelivered.append(row)
+            self._record("delivered", sum(1 for row in rows if row.status == "delivered"))
+            self._record("failed", sum(1 for row in rows if row.status == "failed"))
+            if undelivered:
+                self._schedule_retry(undelivered, "Missing from the Product Service response.")
+            await db.commit()
+        logger.info(f"Order Service: Stock outbox delivered {len(rows) - len(undelivered)} of {len(claimed)} adjustments.")
+        return len(claimed)
+
+    async def _claim(self):
+        """
+        Leases up to batch_size due rows to this dispatcher and commits. Returns the
+        claimed rows (as tuples, ordered by outbox_id) and the lease's end, which the
+        rows keep as next_attempt_at while the lease holds.
+        """
+        async with self.session_factory() as db:
+            due = (
+                select(StockOutbox.outbox_id)
+                .filter(StockOutbox.status == "pending", StockOutbox.next_attempt_at <= func.now())
+                .order_by(StockOutbox.outbox_id)
+                .limit(self.batch_size)
+                .with_for_update(skip_locked=True)
+            )
+            claimed = (
+                await db.execute(
+                    update(StockOutbox)
+                    .where(StockOutbox.outbox_id.in_(due))
+                    .values(next_attempt_at=func.now() + timedelta(seconds=self.lease_seconds))
+                    .returning(
+                        StockOutbox.outbox_id,
+                        StockOutbox.idempotency_key,
+                        StockOutbox.product_id,
+                        StockOutbox.quantity,
+                        StockOutbox.next_attempt_at,
+                    )
+                    .execution_options(synchronize_session=False)
+                )
+            ).all()
+            await db.commit()
+        claimed.sort(key=lambda row: row.outbox_id)
+        return claimed, claimed[0].next_attempt_at if claimed else None
+
+    def _schedule_retry(self, rows, error: str):
+        for row in rows:
+            row.attempts += 1
+            row.last_error = error[:1000]
+            if row.attempts >= self.max_attempts:
+                row.status = "failed"
+                logger.critical(
+                    f"Order Service: CRITICAL: Giving up on stock release of {row.quantity} units for product {row.product_id} (outbox {row.outbox_id}) after {row.attempts} attempts: {error}. Manual intervention required!"
+                )
+            else:
+                delay = min(self.retry_base_seconds * 2 ** (row.attempts - 1), self.retry_max_seconds)
+                row.next_attempt_at = func.now() + timedelta(seconds=delay)
+        logger.warning(f"Order Service: Stock outbox delivery of {len(rows)} adjustments failed: {error}")
+        self._record("retry", sum(1 for row in rows if row.status == "pending"))
+        self._record("failed", sum(1 for row in rows if row.status == "failed"))
+
+    def _record(self, result: str, count: int):
+        if self._on_result and count:
+            self._on_result(result, count)
+
+
+async def run_standalone():
+    """Runs a dispatcher outside the API process (OUTBOX_DISPATCHER_ENABLED=false there)."""
+    from .main import create_product_service_transport, create_stock_outbox_dispatcher
+
+    async with httpx.AsyncClient(transport=create_product_service_transport()) as client:
+        await create_stock_outbox_dispatcher(client).run()
+
+
+if __name__ == "__main__":
+    # python -m app.outbox
+    asyncio.run(run_standalone())
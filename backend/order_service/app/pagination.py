@@ -0,0 +1,32 @@
+# week09/example-2/backend/order_service/app/pagination.py
+
+import base64
+import json
+
+from fastapi import HTTPException, status
+
+# Response header carrying the cursor for the next page; absent on the last page
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
+def encode_cursor(**position) -> str:
+    """
+    Encodes the sort key of the last row on a page as an opaque, URL-safe cursor.
+    """
+    raw = json.dumps(position, separators=(",", ":"), default=str).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, **converters) -> dict:
+    """
+    Decodes a cursor produced by encode_cursor. Each keyword names a required key and
+    the callable that converts its value (e.g. product_id=int).
+    Raises a 400 HTTPException for anything malformed.
+    """
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return {key: convert(position[key]) for key, convert in converters.items()}
+    except (ValueError, TypeError, KeyError):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor."
+        )
@@ -1,6 +1,6 @@
 # week09/example-2/backend/order_service/app/schemas.py
 
-from datetime import datetime
+from datetime import date, datetime
 from typing import List, Optional
 from pydantic import BaseModel, ConfigDict, Field
 
@@ -60,3 +60,28 @@ class OrderResponse(OrderBase):
     items: List[OrderItemResponse] = []  # Nested items for detailed order response
 
     model_config = ConfigDict(from_attributes=True)  # Enable ORM mode for Pydantic V2
+
+
+class DailyOrderStats(BaseModel):
+    day: date  # UTC day of order_date
+    order_count: int
+    total_amount: float
+
+    model_config = ConfigDict(from_attributes=True)
+
+
+class StatusOrderStats(BaseModel):
+    status: str
+    order_count: int
+    total_amount: float
+
+    model_config = ConfigDict(from_attributes=True)
+
+
+class ProductSalesStats(BaseModel):
+    product_id: int
+    units_sold: int
+    revenue: float
+    order_count: int  # Orders containing the product
+
+    model_config = ConfigDict(from_attributes=True)
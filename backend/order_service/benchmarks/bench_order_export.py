@@ -0,0 +1,129 @@
+# backend/order_service/benchmarks/bench_order_export.py
+"""
+Order extract throughput: OFFSET paging through list_orders vs GET /orders/export.
+
+Seeds --orders orders with --items items each in one month, then reads them back the
+way analytics extracts did (list_orders pages of 100 with skip, for the first
+--paging-orders orders only, as each page re-reads every order before it) and with the
+streaming export, and reports orders per second and the peak memory of this process.
+The export is read from the generator GET /orders/export streams, since httpx's ASGI
+transport buffers whole response bodies. Seeded orders are deleted afterwards.
+
+Run from backend/order_service against the service database, e.g.:
+    python -m benchmarks.bench_order_export --orders 1000000
+"""
+
+import argparse
+import asyncio
+import logging
+import resource
+import time
+from datetime import datetime, timezone
+from decimal import Decimal
+
+from fastapi import Response
+from sqlalchemy import delete, select, text
+
+from app.db import SessionLocal, engine
+from app.export import export_orders, export_query
+from app.main import ORDER_EXPORT_BATCH_SIZE, list_orders
+from app.migrate import upgrade_schema
+from app.models import Order, OrderItem
+
+BENCH_STATUS = "bench-export"
+MONTH_START = datetime(2001, 1, 1, tzinfo=timezone.utc)
+MONTH_END = datetime(2001, 2, 1, tzinfo=timezone.utc)
+
+
+def peak_memory_mib() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def seed(orders: int, items: int):
+    async with engine.begin() as conn:
+        await conn.execute(
+            text(
+                f"INSERT INTO {Order.__tablename__} (user_id, order_date, status, total_amount, shipping_address) "
+                "SELECT 1 + n % 10000, CAST(:start AS timestamptz) + n * CAST(:spacing AS interval), "
+                ":status, :total, 'Bench Street ' || n FROM generate_series(0, :orders - 1) AS n"
+            ),
+            {
+                "start": MONTH_START,
+                "spacing": (MONTH_END - MONTH_START) / orders,
+                "orders": orders,
+                "total": items * Decimal("9.99"),
+                "status": BENCH_STATUS,
+            },
+        )
+        await conn.execute(
+            text(
+                f"INSERT INTO {OrderItem.__tablename__} (order_id, product_id, quantity, price_at_purchase, item_total) "
+                f"SELECT o.order_id, 1 + (o.order_id + i) % 1000, 1, 9.99, 9.99 "
+                f"FROM {Order.__tablename__} o CROSS JOIN generate_series(1, :items) AS i WHERE o.status = :status"
+            ),
+            {"items": items, "status": BENCH_STATUS},
+        )
+        await conn.execute(text(f"ANALYZE {Order.__tablename__}"))
+        await conn.execute(text(f"ANALYZE {OrderItem.__tablename__}"))
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--orders", type=int, default=1_000_000, help="Orders seeded in the month")
+    parser.add_argument("--items", type=int, default=3, help="Items per order")
+    parser.add_argument("--paging-orders", type=int, default=20_000, help="Orders read by OFFSET paging")
+    args = parser.parse_args()
+
+    logging.getLogger("app.main").setLevel(logging.ERROR)
+    async with engine.begin() as conn:
+        await conn.run_sync(upgrade_schema)
+    started = time.perf_counter()
+    await seed(args.orders, args.items)
+    print(f"seeded {args.orders} orders x {args.items} items in {time.perf_counter() - started:.1f}s")
+
+    try:
+        async with engine.connect() as conn:
+            query = export_query(MONTH_START, MONTH_END, BENCH_STATUS)
+            compiled = query.compile(conn.sync_connection, compile_kwargs={"literal_binds": True})
+            plan = (await conn.exec_driver_sql(f"EXPLAIN {compiled}")).scalars().all()
+            print("export plan:\n  " + "\n  ".join(plan))
+
+        started = time.perf_counter()
+        paged = 0
+        async with SessionLocal() as db:
+            while paged < args.paging_orders:
+                page = await list_orders(
+                    Response(), db, skip=paged, limit=100, user_id=None, order_status=BENCH_STATUS, cursor=None
+                )
+                if not page:
+                    break
+                paged += len(page)
+                db.expunge_all()
+        elapsed = time.perf_counter() - started
+        print(
+            f"OFFSET paging: {paged} orders in {elapsed:6.1f}s ({paged / elapsed:8.0f} orders/s)  "
+            f"peak memory {peak_memory_mib():.0f} MiB"
+        )
+
+        started = time.perf_counter()
+        exported = 0
+        async for chunk in export_orders(
+            SessionLocal, ORDER_EXPORT_BATCH_SIZE, MONTH_START, MONTH_END, BENCH_STATUS
+        ):
+            exported += chunk.count(b"\n")
+        elapsed = time.perf_counter() - started
+        print(
+            f"export:        {exported} orders in {elapsed:6.1f}s ({exported / elapsed:8.0f} orders/s)  "
+            f"peak memory {peak_memory_mib():.0f} MiB"
+        )
+    finally:
+        async with SessionLocal() as db:
+            bench_orders = select(Order.order_id).where(Order.status == BENCH_STATUS)
+            await db.execute(delete(OrderItem).where(OrderItem.order_id.in_(bench_orders)))
+            await db.execute(delete(Order).where(Order.status == BENCH_STATUS))
+            await db.commit()
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
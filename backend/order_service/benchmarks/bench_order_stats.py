@@ -0,0 +1,104 @@
+# backend/order_service/benchmarks/bench_order_stats.py
+"""
+Order statistics: answering from the rollup tables vs aggregating the orders table.
+
+Seeds --orders orders with --items items each in one month (as bench_order_export),
+backfills the rollups with app.aggregates.rebuild_rollups, then times revenue per day
+and units sold per product for the month --requests times each, from the rollups
+(daily_totals, product_totals, as GET /orders/stats/* does) and with the equivalent
+GROUP BY over orders and order items. Seeded orders and their rollup rows are deleted
+afterwards.
+
+Run from backend/order_service against the service database, e.g.:
+    python -m benchmarks.bench_order_stats --orders 1000000
+"""
+
+import argparse
+import asyncio
+import logging
+import statistics
+import time
+
+from sqlalchemy import delete, distinct, func, select
+
+from app.aggregates import daily_totals, product_totals, rebuild_rollups
+from app.db import SessionLocal, engine
+from app.migrate import upgrade_schema
+from app.models import Order, OrderItem
+from benchmarks.bench_order_export import BENCH_STATUS, MONTH_END, MONTH_START, seed
+
+DAY = func.date(func.timezone("UTC", Order.order_date))
+IN_MONTH = (Order.order_date >= MONTH_START, Order.order_date < MONTH_END)
+
+
+async def daily_from_orders(db):
+    query = (
+        select(DAY, func.count(), func.sum(Order.total_amount)).where(*IN_MONTH).group_by(DAY).order_by(DAY)
+    )
+    return (await db.execute(query)).all()
+
+
+async def products_from_orders(db):
+    units_sold = func.sum(OrderItem.quantity)
+    query = (
+        select(OrderItem.product_id, units_sold, func.sum(OrderItem.item_total), func.count(distinct(Order.order_id)))
+        .join(OrderItem, OrderItem.order_id == Order.order_id)
+        .where(*IN_MONTH)
+        .group_by(OrderItem.product_id)
+        .order_by(units_sold.desc(), OrderItem.product_id)
+        .limit(20)
+    )
+    return (await db.execute(query)).all()
+
+
+async def time_query(label: str, run, requests: int):
+    latencies = []
+    async with SessionLocal() as db:
+        for _ in range(requests):
+            started = time.perf_counter()
+            await run(db)
+            latencies.append((time.perf_counter() - started) * 1000)
+    print(f"{label:>26}: p50={statistics.median(latencies):9.2f} ms  max={max(latencies):9.2f} ms")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--orders", type=int, default=1_000_000, help="Orders seeded in the month")
+    parser.add_argument("--items", type=int, default=3, help="Items per order")
+    parser.add_argument("--requests", type=int, default=5, help="Runs of each query")
+    args = parser.parse_args()
+
+    logging.getLogger("app.main").setLevel(logging.ERROR)
+    async with engine.begin() as conn:
+        await conn.run_sync(upgrade_schema)
+    await seed(args.orders, args.items)
+
+    try:
+        started = time.perf_counter()
+        async with SessionLocal() as db:
+            status_rows, product_rows = await rebuild_rollups(db, MONTH_START.date(), MONTH_END.date())
+            await db.commit()
+        print(
+            f"rebuilt rollups for {args.orders} orders in {time.perf_counter() - started:.1f}s "
+            f"({status_rows} status rows, {product_rows} product rows)"
+        )
+        start, end = MONTH_START.date(), MONTH_END.date()
+        await time_query("daily revenue, rollups", lambda db: daily_totals(db, start, end, None), args.requests)
+        await time_query("daily revenue, orders", daily_from_orders, args.requests)
+        await time_query(
+            "top products, rollups", lambda db: product_totals(db, start, end, None, 20), args.requests
+        )
+        await time_query("top products, orders", products_from_orders, args.requests)
+    finally:
+        async with SessionLocal() as db:
+            bench_orders = select(Order.order_id).where(Order.status == BENCH_STATUS)
+            await db.execute(delete(OrderItem).where(OrderItem.order_id.in_(bench_orders)))
+            await db.execute(delete(Order).where(Order.status == BENCH_STATUS))
+            # Leaves the month's rollups matching the orders table again
+            await rebuild_rollups(db, MONTH_START.date(), MONTH_END.date())
+            await db.commit()
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
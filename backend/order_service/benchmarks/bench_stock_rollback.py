@@ -0,0 +1,120 @@
+# backend/order_service/benchmarks/bench_stock_rollback.py
+"""
+Stock rollback latency benchmark against a stub Product Service with injected latency.
+
+Starts a local HTTP stub whose add-stock endpoint sleeps for a per-product delay,
+then times rolling back an order's items the previous way (one PATCH after another)
+and with _add_stock_for_items (concurrent, bounded by
+PRODUCT_SERVICE_MAX_CONCURRENT_CALLS). Concurrent latency should track the slowest
+item; sequential latency tracks the sum of all items.
+
+Run from backend/order_service:
+    python -m benchmarks.bench_stock_rollback --items 10 --orders 20
+"""
+
+import argparse
+import asyncio
+import logging
+import random
+import socket
+import statistics
+import time
+
+import httpx
+import uvicorn
+
+import app.main as order_main
+from app.main import _add_stock_for_items, create_product_service_transport
+from app.schemas import OrderItemCreate
+
+
+def make_stub_product_service(latencies_ms):
+    """A bare ASGI app answering PATCH /products/{id}/add-stock after latencies_ms[id]."""
+
+    async def stub(scope, receive, send):
+        if scope["type"] != "http":
+            return
+        product_id = int(scope["path"].split("/")[2])
+        while (await receive()).get("more_body"):
+            pass
+        await asyncio.sleep(latencies_ms[product_id] / 1000)
+        await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"application/json")]})
+        await send({"type": "http.response.body", "body": b"{}"})
+
+    return stub
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def sequential_rollback(client: httpx.AsyncClient, items):
+    # The rollback loop before concurrent lookups: one call at a time
+    for item in items:
+        response = await client.patch(
+            f"{order_main.PRODUCT_SERVICE_URL}/products/{item.product_id}/add-stock",
+            json={"quantity_to_deduct": item.quantity},
+            timeout=5,
+        )
+        response.raise_for_status()
+
+
+async def concurrent_rollback(client: httpx.AsyncClient, items):
+    await _add_stock_for_items(client, [(item.product_id, item.quantity) for item in items], "rollback")
+
+
+async def time_orders(name: str, rollback, client, orders):
+    latencies = []
+    for items in orders:
+        started = time.perf_counter()
+        await rollback(client, items)
+        latencies.append((time.perf_counter() - started) * 1000)
+    print(f"{name:>10}: p50={statistics.median(latencies):8.1f} ms  max={max(latencies):8.1f} ms")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--items", type=int, default=10, help="Items per order")
+    parser.add_argument("--orders", type=int, default=20, help="Orders to roll back per strategy")
+    parser.add_argument("--min-latency-ms", type=float, default=10, help="Fastest stub response")
+    parser.add_argument("--max-latency-ms", type=float, default=80, help="Slowest stub response")
+    args = parser.parse_args()
+
+    logging.getLogger("app.main").setLevel(logging.ERROR)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    rng = random.Random(42)
+    latencies_ms = {
+        product_id: rng.uniform(args.min_latency_ms, args.max_latency_ms)
+        for product_id in range(1, args.items + 1)
+    }
+    orders = [
+        [OrderItemCreate(product_id=product_id, quantity=1, price_at_purchase=1.0) for product_id in latencies_ms]
+        for _ in range(args.orders)
+    ]
+
+    port = free_port()
+    server = uvicorn.Server(
+        uvicorn.Config(make_stub_product_service(latencies_ms), host="127.0.0.1", port=port, log_level="warning")
+    )
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+    order_main.PRODUCT_SERVICE_URL = f"http://127.0.0.1:{port}"
+
+    print(
+        f"{args.items} items per order, stub latency sum={sum(latencies_ms.values()):.1f} ms, "
+        f"slowest={max(latencies_ms.values()):.1f} ms, "
+        f"concurrency limit={order_main.PRODUCT_SERVICE_MAX_CONCURRENT_CALLS}"
+    )
+    async with httpx.AsyncClient(transport=create_product_service_transport()) as client:
+        await time_orders("sequential", sequential_rollback, client, orders)
+        await time_orders("concurrent", concurrent_rollback, client, orders)
+
+    server.should_exit = True
+    await server_task
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
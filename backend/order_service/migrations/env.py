@@ -0,0 +1,50 @@
+# week09/example-2/backend/order_service/migrations/env.py
+
+import asyncio
+from logging.config import fileConfig
+
+from alembic import context
+from sqlalchemy import func, select
+
+from app.db import DATABASE_URL, Base, engine
+from app.migrate import SCHEMA_SETUP_LOCK_ID
+import app.models  # noqa: F401  Registers the tables on Base.metadata
+
+config = context.config
+target_metadata = Base.metadata
+
+
+def do_run_migrations(connection):
+    context.configure(connection=connection, target_metadata=target_metadata, compare_type=True)
+    with context.begin_transaction():
+        # Workers and replicas start together; let one migrate at a time
+        connection.execute(select(func.pg_advisory_xact_lock(SCHEMA_SETUP_LOCK_ID)))
+        context.run_migrations()
+
+
+async def run_async_migrations():
+    try:
+        async with engine.connect() as connection:
+            await connection.run_sync(do_run_migrations)
+    finally:
+        await engine.dispose()
+
+
+def run_migrations_offline():
+    # alembic upgrade head --sql: print the SQL instead of running it
+    context.configure(url=DATABASE_URL, target_metadata=target_metadata, literal_binds=True)
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+# app.migrate.upgrade_schema passes the service's connection, already in a transaction;
+# the alembic command line gets its own
+connection = config.attributes.get("connection")
+if context.is_offline_mode():
+    run_migrations_offline()
+elif connection is not None:
+    do_run_migrations(connection)
+else:
+    if config.config_file_name:
+        fileConfig(config.config_file_name)
+    asyncio.run(run_async_migrations())
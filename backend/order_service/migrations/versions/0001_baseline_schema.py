@@ -0,0 +1,126 @@
+"""baseline schema
+
+The schema as Base.metadata.create_all created it before migrations were introduced.
+Tables and indexes are created only if missing, so databases set up by create_all are
+adopted as they are.
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-17 03:19:34.001815
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0001'
+down_revision: Union[str, Sequence[str], None] = None
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('idempotency_keys_week09_example_02',
+    sa.Column('scope', sa.String(length=100), nullable=False),
+    sa.Column('idempotency_key', sa.String(length=255), nullable=False),
+    sa.Column('request_hash', sa.String(length=64), nullable=False),
+    sa.Column('status_code', sa.Integer(), nullable=True),
+    sa.Column('response_body', sa.Text(), nullable=True),
+    sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=True),
+    sa.Column('expires_at', sa.DateTime(timezone=True), nullable=False),
+    sa.PrimaryKeyConstraint('scope', 'idempotency_key'),
+    if_not_exists=True,
+    )
+    op.create_index(op.f('ix_idempotency_keys_week09_example_02_expires_at'), 'idempotency_keys_week09_example_02', ['expires_at'], unique=False, if_not_exists=True)
+    op.create_table('order_daily_product_rollups_week09_example_02',
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('product_id', sa.Integer(), nullable=False),
+    sa.Column('units_sold', sa.BigInteger(), nullable=False),
+    sa.Column('revenue', sa.Numeric(precision=14, scale=2), nullable=False),
+    sa.Column('order_count', sa.BigInteger(), nullable=False),
+    sa.PrimaryKeyConstraint('day', 'product_id'),
+    if_not_exists=True,
+    )
+    op.create_index('ix_order_daily_product_rollups_week09_example_02_product_id_day', 'order_daily_product_rollups_week09_example_02', ['product_id', 'day'], unique=False, if_not_exists=True)
+    op.create_table('order_daily_status_rollups_week09_example_02',
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('status', sa.String(length=50), nullable=False),
+    sa.Column('order_count', sa.BigInteger(), nullable=False),
+    sa.Column('total_amount', sa.Numeric(precision=14, scale=2), nullable=False),
+    sa.PrimaryKeyConstraint('day', 'status'),
+    if_not_exists=True,
+    )
+    op.create_table('orders_week09_example_02',
+    sa.Column('order_id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('order_date', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+    sa.Column('status', sa.String(length=50), nullable=False),
+    sa.Column('total_amount', sa.Numeric(precision=10, scale=2), nullable=False),
+    sa.Column('shipping_address', sa.Text(), nullable=True),
+    sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=True),
+    sa.Column('updated_at', sa.DateTime(timezone=True), nullable=True),
+    sa.PrimaryKeyConstraint('order_id'),
+    if_not_exists=True,
+    )
+    op.create_index('ix_orders_week09_example_02_order_date_order_id', 'orders_week09_example_02', ['order_date', 'order_id'], unique=False, if_not_exists=True)
+    op.create_index(op.f('ix_orders_week09_example_02_order_id'), 'orders_week09_example_02', ['order_id'], unique=False, if_not_exists=True)
+    op.create_index('ix_orders_week09_example_02_status_order_date_order_id', 'orders_week09_example_02', ['status', 'order_date', 'order_id'], unique=False, if_not_exists=True)
+    op.create_index(op.f('ix_orders_week09_example_02_user_id'), 'orders_week09_example_02', ['user_id'], unique=False, if_not_exists=True)
+    op.create_table('stock_outbox_week09_example_02',
+    sa.Column('outbox_id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('idempotency_key', sa.String(length=100), nullable=False),
+    sa.Column('product_id', sa.Integer(), nullable=False),
+    sa.Column('quantity', sa.Integer(), nullable=False),
+    sa.Column('reason', sa.String(length=50), nullable=False),
+    sa.Column('order_id', sa.Integer(), nullable=True),
+    sa.Column('status', sa.String(length=20), nullable=False),
+    sa.Column('attempts', sa.Integer(), nullable=False),
+    sa.Column('next_attempt_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+    sa.Column('last_error', sa.Text(), nullable=True),
+    sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=True),
+    sa.Column('delivered_at', sa.DateTime(timezone=True), nullable=True),
+    sa.PrimaryKeyConstraint('outbox_id'),
+    sa.UniqueConstraint('idempotency_key'),
+    if_not_exists=True,
+    )
+    op.create_index('ix_stock_outbox_week09_example_02_status_next_attempt_at', 'stock_outbox_week09_example_02', ['status', 'next_attempt_at'], unique=False, if_not_exists=True)
+    op.create_table('order_items_week09_example_02',
+    sa.Column('order_item_id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('order_id', sa.Integer(), nullable=False),
+    sa.Column('product_id', sa.Integer(), nullable=False),
+    sa.Column('quantity', sa.Integer(), nullable=False),
+    sa.Column('price_at_purchase', sa.Numeric(precision=10, scale=2), nullable=False),
+    sa.Column('item_total', sa.Numeric(precision=10, scale=2), nullable=False),
+    sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=True),
+    sa.Column('updated_at', sa.DateTime(timezone=True), nullable=True),
+    sa.ForeignKeyConstraint(['order_id'], ['orders_week09_example_02.order_id'], ),
+    sa.PrimaryKeyConstraint('order_item_id'),
+    if_not_exists=True,
+    )
+    op.create_index(op.f('ix_order_items_week09_example_02_order_id'), 'order_items_week09_example_02', ['order_id'], unique=False, if_not_exists=True)
+    op.create_index(op.f('ix_order_items_week09_example_02_order_item_id'), 'order_items_week09_example_02', ['order_item_id'], unique=False, if_not_exists=True)
+    op.create_index(op.f('ix_order_items_week09_example_02_product_id'), 'order_items_week09_example_02', ['product_id'], unique=False, if_not_exists=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_order_items_week09_example_02_product_id'), table_name='order_items_week09_example_02')
+    op.drop_index(op.f('ix_order_items_week09_example_02_order_item_id'), table_name='order_items_week09_example_02')
+    op.drop_index(op.f('ix_order_items_week09_example_02_order_id'), table_name='order_items_week09_example_02')
+    op.drop_table('order_items_week09_example_02')
+    op.drop_index('ix_stock_outbox_week09_example_02_status_next_attempt_at', table_name='stock_outbox_week09_example_02')
+    op.drop_table('stock_outbox_week09_example_02')
+    op.drop_index(op.f('ix_orders_week09_example_02_user_id'), table_name='orders_week09_example_02')
+    op.drop_index('ix_orders_week09_example_02_status_order_date_order_id', table_name='orders_week09_example_02')
+    op.drop_index(op.f('ix_orders_week09_example_02_order_id'), table_name='orders_week09_example_02')
+    op.drop_index('ix_orders_week09_example_02_order_date_order_id', table_name='orders_week09_example_02')
+    op.drop_table('orders_week09_example_02')
+    op.drop_table('order_daily_status_rollups_week09_example_02')
+    op.drop_index('ix_order_daily_product_rollups_week09_example_02_product_id_day', table_name='order_daily_product_rollups_week09_example_02')
+    op.drop_table('order_daily_product_rollups_week09_example_02')
+    op.drop_index(op.f('ix_idempotency_keys_week09_example_02_expires_at'), table_name='idempotency_keys_week09_example_02')
+    op.drop_table('idempotency_keys_week09_example_02')
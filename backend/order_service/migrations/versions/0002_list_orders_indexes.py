@@ -0,0 +1,42 @@
+"""list orders indexes
+
+Indexes GET /orders/ by user in its newest-first order: (user_id, order_date, order_id)
+replaces the user_id index, which is its prefix. The index on order_id duplicated the
+primary key. Status filters are served by (status, order_date, order_id) from 0001.
+
+CREATE INDEX blocks writes to the table while it builds. On a large orders table, build
+the index first with CREATE INDEX CONCURRENTLY under the same name; this migration then
+leaves it in place.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-17 03:19:48.184355
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0002'
+down_revision: Union[str, Sequence[str], None] = '0001'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_index(
+        'ix_orders_week09_example_02_user_id_order_date_order_id', 'orders_week09_example_02',
+        ['user_id', 'order_date', 'order_id'], unique=False, if_not_exists=True,
+    )
+    op.drop_index('ix_orders_week09_example_02_user_id', table_name='orders_week09_example_02', if_exists=True)
+    op.drop_index('ix_orders_week09_example_02_order_id', table_name='orders_week09_example_02', if_exists=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.create_index('ix_orders_week09_example_02_order_id', 'orders_week09_example_02', ['order_id'], unique=False)
+    op.create_index('ix_orders_week09_example_02_user_id', 'orders_week09_example_02', ['user_id'], unique=False)
+    op.drop_index('ix_orders_week09_example_02_user_id_order_date_order_id', table_name='orders_week09_example_02')
@@ -0,0 +1,48 @@
+"""order rollup deltas
+
+Order changes append their rollup changes to these tables instead of updating the
+rollup rows of their day in place; app.aggregates folds them into the rollups.
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-17 03:53:28.826083
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0003'
+down_revision: Union[str, Sequence[str], None] = '0002'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('order_product_rollup_deltas_week09_example_02',
+    sa.Column('delta_id', sa.BigInteger(), autoincrement=True, nullable=False),
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('product_id', sa.Integer(), nullable=False),
+    sa.Column('units_sold', sa.BigInteger(), nullable=False),
+    sa.Column('revenue', sa.Numeric(precision=14, scale=2), nullable=False),
+    sa.Column('order_count', sa.BigInteger(), nullable=False),
+    sa.PrimaryKeyConstraint('delta_id')
+    )
+    op.create_table('order_status_rollup_deltas_week09_example_02',
+    sa.Column('delta_id', sa.BigInteger(), autoincrement=True, nullable=False),
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('status', sa.String(length=50), nullable=False),
+    sa.Column('order_count', sa.BigInteger(), nullable=False),
+    sa.Column('total_amount', sa.Numeric(precision=14, scale=2), nullable=False),
+    sa.PrimaryKeyConstraint('delta_id')
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('order_status_rollup_deltas_week09_example_02')
+    op.drop_table('order_product_rollup_deltas_week09_example_02')
@@ -1,18 +1,37 @@
 # week07/example-2/backend/order_service/tests/test_main.py
 
+import asyncio
+import json
 import logging
 import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
 from decimal import Decimal
-from unittest.mock import AsyncMock, patch
+from unittest.mock import AsyncMock, MagicMock
 
+import httpx
 import pytest
 
+from app.aggregates import fold_rollup_deltas, rebuild_rollups
 from app.db import SessionLocal, engine, get_db
-from app.main import PRODUCT_SERVICE_URL, app
-from app.models import Base, Order, OrderItem
-from fastapi.testclient import TestClient
+from app.migrate import upgrade_schema
+import app.main as main_module
+from app.main import (
+    ADD_STOCK_ENDPOINT,
+    PRODUCT_SERVICE_URL,
+    _add_stock_for_items,
+    app,
+    create_product_service_transport,
+    get_product_service_client,
+    registry,
+)
+from app.models import Base, Order, OrderItem, OrderProductRollupDelta, OrderStatusRollupDelta, StockOutbox
+from app.outbox import StockOutboxDispatcher
+from alembic.autogenerate import compare_metadata
+from alembic.migration import MigrationContext
+from sqlalchemy import event, func, select, text, update
 from sqlalchemy.exc import OperationalError
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
 # Suppress noisy logs from SQLAlchemy/FastAPI/Uvicorn during tests for cleaner output
 logging.getLogger("sqlalchemy.engine").setLevel(logging.WARNING)
@@ -22,6 +41,27 @@ logging.getLogger("fastapi").setLevel(logging.WARNING)
 logging.getLogger("app.main").setLevel(logging.WARNING)  # Suppress app's own info logs
 
 
+# All tests run on the asyncio backend of the anyio pytest plugin, sharing one event loop
+# per module so pooled asyncpg connections are never reused across loops.
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture(scope="module")
+def anyio_backend():
+    return "asyncio"
+
+
+async def _recreate_tables():
+    async with engine.begin() as conn:
+        # Explicitly drop all tables first to ensure a clean slate for the session
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.execute(text("DROP TABLE IF EXISTS alembic_version"))
+        # Then create them with the migrations, as the service does at startup
+        await conn.run_sync(upgrade_schema)
+    # Connections opened here belong to a throwaway event loop; don't keep them pooled
+    await engine.dispose()
+
+
 @pytest.fixture(scope="session", autouse=True)
 def setup_database_for_tests():
     max_retries = 10
@@ -31,19 +71,12 @@ def setup_database_for_tests():
             logging.info(
                 f"Order Service Tests: Attempting to connect to PostgreSQL for test setup (attempt {i+1}/{max_retries})..."
             )
-            # Explicitly drop all tables first to ensure a clean slate for the session
-            Base.metadata.drop_all(bind=engine)
+            asyncio.run(_recreate_tables())
             logging.info(
-                "Order Service Tests: Successfully dropped all tables in PostgreSQL for test setup."
-            )
-
-            # Then create all tables required by the application
-            Base.metadata.create_all(bind=engine)
-            logging.info(
-                "Order Service Tests: Successfully created all tables in PostgreSQL for test setup."
+                "Order Service Tests: Successfully recreated all tables in PostgreSQL for test setup."
             )
             break
-        except OperationalError as e:
+        except (OperationalError, OSError) as e:
             logging.warning(
                 f"Order Service Tests: Test setup DB connection failed: {e}. Retrying in {retry_delay_seconds} seconds..."
             )
@@ -62,12 +95,12 @@ def setup_database_for_tests():
 
 
 @pytest.fixture(scope="function")
-def db_session_for_test():
-    connection = engine.connect()
-    transaction = connection.begin()
+async def db_session_for_test():
+    connection = await engine.connect()
+    transaction = await connection.begin()
     db = SessionLocal(bind=connection)
 
-    def override_get_db():
+    async def override_get_db():
         yield db
 
     app.dependency_overrides[get_db] = override_get_db
@@ -75,37 +108,691 @@ def db_session_for_test():
     try:
         yield db
     finally:
-        transaction.rollback()
-        db.close()
-        connection.close()
+        await transaction.rollback()
+        await db.close()
+        await connection.close()
         app.dependency_overrides.pop(get_db, None)
 
 
 @pytest.fixture(scope="module")
-def client():
-    with TestClient(app) as test_client:
+async def client():
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as test_client:
         yield test_client
 
 
 @pytest.fixture(scope="function")
 def mock_httpx_client():
-    with patch("app.main.httpx.AsyncClient") as mock_async_client_cls:
-        mock_client_instance = AsyncMock()
-        mock_async_client_cls.return_value.__aenter__.return_value = (
-            mock_client_instance
-        )
+    mock_client_instance = AsyncMock()
+    app.dependency_overrides[get_product_service_client] = lambda: mock_client_instance
+    try:
         yield mock_client_instance
+    finally:
+        app.dependency_overrides.pop(get_product_service_client, None)
 
 
-def test_read_root(client: TestClient):
+async def test_read_root(client: httpx.AsyncClient):
     """Test the root endpoint."""
-    response = client.get("/")
+    response = await client.get("/")
     assert response.status_code == 200
     assert response.json() == {"message": "Welcome to the Order Service!"}
 
 
-def test_health_check(client: TestClient):
+async def test_health_check(client: httpx.AsyncClient):
     """Test the health check endpoint."""
-    response = client.get("/health")
+    response = await client.get("/health")
     assert response.status_code == 200
     assert response.json() == {"status": "ok", "service": "order-service"}
+
+
+async def test_create_order_reserves_stock_in_one_call(
+    client: httpx.AsyncClient, db_session_for_test: AsyncSession, mock_httpx_client
+):
+    """
+    Tests that creating an order issues a single batch reservation call to the
+    Product Service instead of a lookup and deduction per item.
+    """
+    reserve_response = MagicMock(status_code=200)
+    mock_httpx_client.post.return_value = reserve_response
+
+    order_data = {
+        "user_id": 1,
+        "shipping_address": "1 Test Street",
+        "items": [
+            {"product_id": 1, "quantity": 2, "price_at_purchase": 10.0},
+            {"product_id": 2, "quantity": 1, "price_at_purchase": 5.5},
+        ],
+    }
+    response = await client.post("/orders/", json=order_data)
+
+    assert response.status_code == 201
+    response_data = response.json()
+    assert response_data["status"] == "confirmed"
+    assert response_data["total_amount"] == 25.5
+    assert len(response_data["items"]) == 2
+
+    mock_httpx_client.post.assert_awaited_once()
+    call = mock_httpx_client.post.await_args
+    assert call.args[0] == f"{PRODUCT_SERVICE_URL}/products/stock/reserve"
+    assert call.kwargs["json"] == {
+        "items": [
+            {"product_id": 1, "quantity": 2},
+            {"product_id": 2, "quantity": 1},
+        ]
+    }
+    mock_httpx_client.get.assert_not_called()
+    mock_httpx_client.patch.assert_not_called()
+
+
+async def test_create_order_insufficient_stock(
+    client: httpx.AsyncClient, db_session_for_test: AsyncSession, mock_httpx_client
+):
+    """
+    Tests that a rejected reservation fails the order without saving it.
+    """
+    request = httpx.Request("POST", f"{PRODUCT_SERVICE_URL}/products/stock/reserve")
+    mock_httpx_client.post.side_effect = httpx.HTTPStatusError(
+        "Bad Request",
+        request=request,
+        response=httpx.Response(
+            400,
+            json={"detail": "Insufficient stock for product 'Widget'. Only 1 available."},
+            request=request,
+        ),
+    )
+
+    response = await client.post(
+        "/orders/",
+        json={
+            "user_id": 2,
+            "items": [{"product_id": 1, "quantity": 5, "price_at_purchase": 10.0}],
+        },
+    )
+
+    assert response.status_code == 400
+    assert "Insufficient stock" in response.json()["detail"]
+    order_count = await db_session_for_test.scalar(
+        select(func.count()).select_from(Order).filter(Order.user_id == 2)
+    )
+    assert order_count == 0
+
+
+
+async def test_list_orders_cursor_pagination(
+    client: httpx.AsyncClient, db_session_for_test: AsyncSession, mock_httpx_client
+):
+    """
+    Tests that orders are listed newest first and that following X-Next-Cursor
+    visits each order once, even when orders share the same order_date.
+    """
+    mock_httpx_client.post.return_value = MagicMock(status_code=200)
+    created_ids = []
+    for _ in range(3):
+        response = await client.post(
+            "/orders/",
+            json={
+                "user_id": 7,
+                "items": [{"product_id": 1, "quantity": 1, "price_at_purchase": 10.0}],
+            },
+        )
+        created_ids.append(response.json()["order_id"])
+
+    first_page = await client.get("/orders/", params={"user_id": 7, "limit": 2})
+    assert first_page.status_code == 200
+    assert [o["order_id"] for o in first_page.json()] == created_ids[::-1][:2]
+
+    second_page = await client.get(
+        "/orders/",
+        params={"user_id": 7, "limit": 2, "cursor": first_page.headers["X-Next-Cursor"]},
+    )
+    assert second_page.status_code == 200
+    assert [o["order_id"] for o in second_page.json()] == created_ids[:1]
+    assert "X-Next-Cursor" not in second_page.headers
+
+    response = await client.get("/orders/", params={"cursor": "e30"})  # "{}"
+    assert response.status_code == 400
+
+    response = await client.get(
+        "/orders/", params={"cursor": first_page.headers["X-Next-Cursor"], "skip": 1}
+    )
+    assert response.status_code == 400
+
+
+@contextmanager
+def count_statements():
+    """Counts the SQL statements the engine executes inside the block."""
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine.sync_engine, "before_cursor_execute", record)
+    try:
+        yield statements
+    finally:
+        event.remove(engine.sync_engine, "before_cursor_execute", record)
+
+
+async def test_order_reads_use_bounded_number_of_queries(
+    client: httpx.AsyncClient, db_session_for_test: AsyncSession, mock_httpx_client
+):
+    """
+    Tests that order items are eager-loaded: listing a page costs the same number
+    of statements whether it holds one order or many, instead of one per order.
+    """
+    mock_httpx_client.post.return_value = MagicMock(status_code=200)
+    order_ids = []
+    for _ in range(5):
+        response = await client.post(
+            "/orders/",
+            json={
+                "user_id": 8,
+                "items": [
+                    {"product_id": 1, "quantity": 1, "price_at_purchase": 10.0},
+                    {"product_id": 2, "quantity": 2, "price_at_purchase": 4.0},
+                ],
+            },
+        )
+        order_ids.append(response.json()["order_id"])
+
+    statement_counts = {}
+    for limit in (1, 5):
+        with count_statements() as statements:
+            response = await client.get("/orders/", params={"user_id": 8, "limit": limit})
+        assert response.status_code == 200
+        assert len(response.json()) == limit
+        assert all(len(o["items"]) == 2 for o in response.json())
+        statement_counts[limit] = len(statements)
+    assert statement_counts[1] == statement_counts[5] == 2  # Orders, then all their items
+
+    for path in (f"/orders/{order_ids[0]}", f"/orders/{order_ids[0]}/items"):
+        with count_statements() as statements:
+            response = await client.get(path)
+        assert response.status_code == 200
+        assert len(statements) == 2
+
+    response = await client.patch(
+        f"/orders/{order_ids[0]}/status", params={"new_status": "shipped"}
+    )
+    assert response.status_code == 200
+    assert len(response.json()["items"]) == 2
+
+    mock_httpx_client.patch.return_value = MagicMock(status_code=200)
+    response = await client.delete(f"/orders/{order_ids[1]}")
+    assert response.status_code == 204
+
+async def test_product_service_transport_reuses_pooled_connection():
+    """
+    Tests that the shared Product Service transport keeps connections alive between
+    calls, records pool wait time and idle/active connection counts, and passes trace
+    events on to the caller's trace callback.
+    """
+    connections_opened = 0
+
+    async def handle_connection(reader, writer):
+        nonlocal connections_opened
+        connections_opened += 1
+        try:
+            while True:
+                await reader.readuntil(b"\r\n\r\n")
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\n{}")
+                await writer.drain()
+        except asyncio.IncompleteReadError:
+            writer.close()
+
+    server = await asyncio.start_server(handle_connection, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    wait_sample = "product_service_pool_wait_seconds_count"
+    waits_before = registry.get_sample_value(wait_sample, {"app_name": "order_service"}) or 0
+
+    traced = []
+
+    async def caller_trace(event_name, info):
+        traced.append(event_name)
+
+    transport = create_product_service_transport()
+    async with httpx.AsyncClient(transport=transport) as product_client:
+        for _ in range(3):
+            response = await product_client.get(
+                f"http://127.0.0.1:{port}/products/1", extensions={"trace": caller_trace}
+            )
+            assert response.status_code == 200
+        assert transport.connection_count("idle") == 1
+        assert transport.connection_count("active") == 0
+    assert transport.connection_count("idle") == 0
+
+    server.close()
+    await server.wait_closed()
+
+    assert connections_opened == 1
+    waits_after = registry.get_sample_value(wait_sample, {"app_name": "order_service"})
+    assert waits_after - waits_before == 3
+    # The caller's own trace callback still sees every request's events
+    assert traced.count("connection.connect_tcp.complete") == 1
+    assert traced.count("http11.response_closed.complete") == 3
+
+
+async def test_product_service_call_metrics_use_endpoint_templates():
+    """
+    Tests that calls for 10k distinct products add a constant number of
+    inter-service metric series, labelled with the endpoint template.
+    """
+    def count_series():
+        return sum(
+            1
+            for metric in registry.collect()
+            for sample in metric.samples
+            if sample.name == "product_service_call_total"
+        )
+
+    mock_client = AsyncMock()
+    mock_client.patch.return_value = MagicMock(status_code=200)
+    await _add_stock_for_items(mock_client, [(1, 1)], "rollback")
+    series_before = count_series()
+
+    await _add_stock_for_items(
+        mock_client, [(product_id, 1) for product_id in range(100_000, 110_000)], "rollback"
+    )
+
+    assert count_series() == series_before
+    assert mock_client.patch.await_count == 10_001
+    assert registry.get_sample_value(
+        "product_service_call_total",
+        {"app_name": "order_service", "target_endpoint": ADD_STOCK_ENDPOINT, "method": "PATCH", "status_code": "200"},
+    ) >= 10_001
+
+
+async def test_stock_rollback_runs_concurrently_within_limit(monkeypatch):
+    """
+    Tests that rolling back an order's items calls the Product Service concurrently,
+    never exceeding PRODUCT_SERVICE_MAX_CONCURRENT_CALLS, and merges repeated products.
+    """
+    monkeypatch.setattr(main_module, "PRODUCT_SERVICE_MAX_CONCURRENT_CALLS", 3)
+    in_flight = max_in_flight = 0
+    restocked = {}
+
+    async def slow_patch(url, json, timeout):
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        await asyncio.sleep(0.05)
+        in_flight -= 1
+        restocked[url] = json["quantity_to_deduct"]
+        return MagicMock(status_code=200)
+
+    mock_client = AsyncMock()
+    mock_client.patch.side_effect = slow_patch
+    items = [(product_id, 2) for product_id in range(1, 10)] + [(1, 3)]
+
+    started = time.perf_counter()
+    await _add_stock_for_items(mock_client, items, "rollback")
+    elapsed = time.perf_counter() - started
+
+    assert max_in_flight == 3
+    assert elapsed < 9 * 0.05  # Three waves of three calls, not nine calls back to back
+    assert len(restocked) == 9
+    assert restocked[f"{PRODUCT_SERVICE_URL}/products/1/add-stock"] == 5
+
+
+async def test_delete_order_queues_restock_in_outbox(
+    client: httpx.AsyncClient, db_session_for_test: AsyncSession, mock_httpx_client
+):
+    """
+    Tests that deleting an order writes its restock to the outbox in the same
+    transaction instead of calling the Product Service inline.
+    """
+    mock_httpx_client.post.return_value = MagicMock(status_code=200)
+    response = await client.post(
+        "/orders/",
+        json={
+            "user_id": 14,
+            "items": [
+                {"product_id": 3, "quantity": 2, "price_at_purchase": 5.0},
+                {"product_id": 4, "quantity": 1, "price_at_purchase": 7.0},
+                {"product_id": 3, "quantity": 1, "price_at_purchase": 5.0},
+            ],
+        },
+    )
+    order_id = response.json()["order_id"]
+    mock_httpx_client.reset_mock()
+
+    response = await client.delete(f"/orders/{order_id}")
+
+    assert response.status_code == 204
+    mock_httpx_client.patch.assert_not_awaited()
+    mock_httpx_client.post.assert_not_awaited()
+    rows = (
+        await db_session_for_test.execute(
+            select(StockOutbox).filter(StockOutbox.order_id == order_id).order_by(StockOutbox.product_id)
+        )
+    ).scalars().all()
+    assert [(row.product_id, row.quantity, row.status) for row in rows] == [
+        (3, 3, "pending"),
+        (4, 1, "pending"),
+    ]
+    assert len({row.idempotency_key for row in rows}) == 2
+
+
+async def test_stock_outbox_dispatcher_delivers_and_retries(db_session_for_test: AsyncSession):
+    """
+    Tests that the dispatcher marks acknowledged rows delivered, backs off on
+    failures and gives up after max_attempts.
+    """
+    db_session_for_test.add_all(
+        [
+            StockOutbox(idempotency_key="test-delivered", product_id=1, quantity=2, reason="test"),
+            StockOutbox(idempotency_key="test-retried", product_id=2, quantity=1, reason="test"),
+        ]
+    )
+    await db_session_for_test.commit()
+    results = []
+    mock_client = AsyncMock()
+    mock_client.post.return_value = MagicMock(
+        json=MagicMock(return_value={"applied": ["test-delivered"], "duplicates": [], "missing": []})
+    )
+    dispatcher = StockOutboxDispatcher(
+        lambda: db_session_for_test,
+        mock_client,
+        "http://product-service/products/stock/release",
+        max_attempts=2,
+        retry_base_seconds=0,
+        on_result=lambda result, count: results.append((result, count)),
+    )
+
+    assert await dispatcher.dispatch_once() == 2
+    sent = mock_client.post.await_args.kwargs["json"]["items"]
+    assert {item["idempotency_key"] for item in sent} == {"test-delivered", "test-retried"}
+
+    mock_client.post.side_effect = httpx.ConnectError("Connection refused")
+    assert await dispatcher.dispatch_once() == 1
+
+    rows = {
+        row.idempotency_key: row
+        for row in (
+            await db_session_for_test.execute(select(StockOutbox).filter(StockOutbox.reason == "test"))
+        ).scalars()
+    }
+    assert rows["test-delivered"].status == "delivered"
+    assert rows["test-delivered"].delivered_at is not None
+    assert rows["test-retried"].status == "failed"
+    assert rows["test-retried"].attempts == 2
+    assert "ConnectError" in rows["test-retried"].last_error
+    assert results == [("delivered", 1), ("retry", 1), ("failed", 1)]
+    assert await dispatcher.dispatch_once() == 0
+
+
+async def test_stock_outbox_dispatcher_leases_rows_while_sending(db_session_for_test: AsyncSession):
+    """
+    Tests that rows are leased, not locked, while their release request is in flight,
+    and that no outcome is recorded for rows whose lease was taken over meanwhile.
+    """
+    db_session_for_test.add(StockOutbox(idempotency_key="test-leased", product_id=1, quantity=1, reason="test"))
+    await db_session_for_test.commit()
+    leased = StockOutbox.idempotency_key == "test-leased"
+
+    async def send(url, json, timeout):
+        # Leased for lease_seconds and committed before the request is sent
+        assert await db_session_for_test.scalar(
+            select(StockOutbox.next_attempt_at > func.now() + timedelta(seconds=50)).filter(leased)
+        )
+        # The lease runs out and another dispatcher claims the row
+        await db_session_for_test.execute(update(StockOutbox).where(leased).values(next_attempt_at=func.now()))
+        return MagicMock(json=MagicMock(return_value={"applied": ["test-leased"], "duplicates": [], "missing": []}))
+
+    mock_client = AsyncMock()
+    mock_client.post.side_effect = send
+    dispatcher = StockOutboxDispatcher(
+        lambda: db_session_for_test, mock_client, "http://product-service/products/stock/release", lease_seconds=60
+    )
+
+    assert await dispatcher.dispatch_once() == 1
+    row = await db_session_for_test.scalar(select(StockOutbox).filter(leased).execution_options(populate_existing=True))
+    assert (row.status, row.attempts, row.delivered_at) == ("pending", 0, None)
+
+
+async def test_create_order_with_idempotency_key_runs_once(
+    client: httpx.AsyncClient, db_session_for_test: AsyncSession, mock_httpx_client
+):
+    """
+    Tests that a retried order with the same Idempotency-Key gets the stored response
+    without reserving stock or saving the order again.
+    """
+    mock_httpx_client.post.return_value = MagicMock(status_code=200)
+    order_data = {
+        "user_id": 15,
+        "items": [{"product_id": 1, "quantity": 2, "price_at_purchase": 10.0}],
+    }
+    headers = {"Idempotency-Key": "order-retry-1"}
+
+    first = await client.post("/orders/", json=order_data, headers=headers)
+    retry = await client.post("/orders/", json=order_data, headers=headers)
+
+    assert first.status_code == retry.status_code == 201
+    assert retry.json() == first.json()
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    mock_httpx_client.post.assert_awaited_once()
+    order_count = await db_session_for_test.scalar(
+        select(func.count()).select_from(Order).filter(Order.user_id == 15)
+    )
+    assert order_count == 1
+
+    different = await client.post(
+        "/orders/", json={**order_data, "user_id": 16}, headers=headers
+    )
+    assert different.status_code == 422
+    mock_httpx_client.post.assert_awaited_once()
+
+
+async def test_create_order_retry_after_lost_reservation_reuses_reserve_key(
+    client: httpx.AsyncClient, db_session_for_test: AsyncSession, mock_httpx_client
+):
+    """
+    Tests that when the reservation commits but its response is lost, the failed order
+    releases its Idempotency-Key and the retry sends the same reservation key, which
+    the Product Service answers from its stored response instead of reserving again.
+    """
+    mock_httpx_client.post.side_effect = [
+        httpx.ReadTimeout("Reservation response timed out"),
+        MagicMock(status_code=200),
+    ]
+    order_data = {
+        "user_id": 17,
+        "items": [{"product_id": 1, "quantity": 1, "price_at_purchase": 4.0}],
+    }
+    headers = {"Idempotency-Key": "order-retry-2"}
+
+    first = await client.post("/orders/", json=order_data, headers=headers)
+    assert first.status_code == 503
+    retry = await client.post("/orders/", json=order_data, headers=headers)
+    assert retry.status_code == 201
+
+    reserve_keys = [call.kwargs["headers"]["Idempotency-Key"] for call in mock_httpx_client.post.await_args_list]
+    assert reserve_keys == ["order-retry-2:reserve", "order-retry-2:reserve"]
+    order_count = await db_session_for_test.scalar(
+        select(func.count()).select_from(Order).filter(Order.user_id == 17)
+    )
+    assert order_count == 1
+
+
+async def test_export_orders_streams_filtered_orders_with_items(
+    client: httpx.AsyncClient, db_session_for_test: AsyncSession, monkeypatch
+):
+    """
+    Tests that GET /orders/export writes one NDJSON line per order in the date range,
+    oldest first, with all of its items, also when an order's items span cursor batches.
+    """
+    orders = [
+        Order(
+            user_id=20,
+            order_date=datetime(2001, 1, day, tzinfo=timezone.utc),
+            status=order_status,
+            total_amount=Decimal("3.00") * items,
+            items=[
+                OrderItem(product_id=i + 1, quantity=1, price_at_purchase=Decimal("3.00"), item_total=Decimal("3.00"))
+                for i in range(items)
+            ],
+        )
+        for day, order_status, items in [(5, "shipped", 2), (3, "pending", 4), (1, "shipped", 1), (9, "shipped", 1)]
+    ]
+    db_session_for_test.add_all(orders)
+    await db_session_for_test.flush()
+    # The export opens its own session; give it the test's connection and small batches
+    monkeypatch.setattr(main_module, "SessionLocal", lambda: SessionLocal(bind=db_session_for_test.bind))
+    monkeypatch.setattr(main_module, "ORDER_EXPORT_BATCH_SIZE", 3)
+
+    params = {"start": "2001-01-01T00:00:00Z", "end": "2001-01-09T00:00:00Z"}
+    response = await client.get("/orders/export", params=params)
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    exported = [json.loads(line) for line in response.text.splitlines()]
+    assert [o["order_id"] for o in exported] == [orders[2].order_id, orders[1].order_id, orders[0].order_id]
+    assert [len(o["items"]) for o in exported] == [1, 4, 2]
+    assert exported[1]["total_amount"] == 12.0
+    assert {item["order_id"] for item in exported[1]["items"]} == {orders[1].order_id}
+
+    response = await client.get("/orders/export", params={**params, "status": "shipped"})
+    assert [json.loads(line)["order_id"] for line in response.text.splitlines()] == [
+        orders[2].order_id, orders[0].order_id
+    ]
+
+    response = await client.get("/orders/export", params={"start": params["end"], "end": params["start"]})
+    assert response.status_code == 400
+
+
+async def test_order_stats_follow_order_changes_and_rebuild(
+    client: httpx.AsyncClient, db_session_for_test: AsyncSession, mock_httpx_client
+):
+    """
+    Tests that the stats endpoints reflect created, re-statused and deleted orders from
+    the rollups and their pending deltas, and that folding the deltas or rebuilding the
+    rollups from the orders gives the same answers.
+    """
+    mock_httpx_client.post.return_value = MagicMock(status_code=200)
+    mock_httpx_client.patch.return_value = MagicMock(status_code=200)
+    order_ids = []
+    for items in (
+        [{"product_id": 1, "quantity": 2, "price_at_purchase": 10.0}, {"product_id": 2, "quantity": 1, "price_at_purchase": 5.0}],
+        [{"product_id": 1, "quantity": 1, "price_at_purchase": 10.0}, {"product_id": 1, "quantity": 3, "price_at_purchase": 9.0}],
+        [{"product_id": 2, "quantity": 4, "price_at_purchase": 5.0}],
+    ):
+        response = await client.post("/orders/", json={"user_id": 21, "items": items})
+        assert response.status_code == 201
+        order_ids.append(response.json()["order_id"])
+    await client.patch(f"/orders/{order_ids[0]}/status", params={"new_status": "shipped"})
+    assert (await client.delete(f"/orders/{order_ids[2]}")).status_code == 204
+
+    async def stats():
+        daily = (await client.get("/orders/stats/daily")).json()
+        statuses = (await client.get("/orders/stats/statuses")).json()
+        products = (await client.get("/orders/stats/products")).json()
+        return daily, statuses, products
+
+    daily, statuses, products = await stats()
+    assert [(d["order_count"], d["total_amount"]) for d in daily] == [(2, 62.0)]
+    assert statuses == [
+        {"status": "confirmed", "order_count": 1, "total_amount": 37.0},
+        {"status": "shipped", "order_count": 1, "total_amount": 25.0},
+    ]
+    assert products == [
+        {"product_id": 1, "units_sold": 6, "revenue": 57.0, "order_count": 2},
+        {"product_id": 2, "units_sold": 1, "revenue": 5.0, "order_count": 1},
+    ]
+    response = await client.get("/orders/stats/daily", params={"status": "shipped"})
+    assert [d["total_amount"] for d in response.json()] == [25.0]
+
+    # Order changes only appended deltas (6 status, 5 product); fold them in two batches
+    assert await fold_rollup_deltas(db_session_for_test, batch_size=4) == 8
+    assert await fold_rollup_deltas(db_session_for_test, batch_size=4) == 3
+    for delta in (OrderStatusRollupDelta, OrderProductRollupDelta):
+        assert await db_session_for_test.scalar(select(func.count()).select_from(delta)) == 0
+    assert await stats() == (daily, statuses, products)
+
+    await rebuild_rollups(db_session_for_test)
+    assert await stats() == (daily, statuses, products)
+
+    response = await client.get("/orders/stats/daily", params={"start": "2024-02-01", "end": "2024-01-01"})
+    assert response.status_code == 400
+
+
+async def test_migrations_match_models(db_session_for_test: AsyncSession):
+    """
+    Tests that the schema built by the Alembic migrations is the one the models declare,
+    so a model change without a migration fails here.
+    """
+    connection = await db_session_for_test.connection()
+    differences = await connection.run_sync(
+        lambda sync_connection: compare_metadata(MigrationContext.configure(sync_connection), Base.metadata)
+    )
+    assert differences == []
+
+
+async def test_list_orders_query_plans_use_indexes(
+    client: httpx.AsyncClient, db_session_for_test: AsyncSession
+):
+    """
+    Tests that the queries behind GET /orders/ with each filter are answered from
+    indexes on a seeded table: EXPLAIN must not show a sequential scan of orders or items.
+    """
+    await db_session_for_test.execute(
+        text(
+            f"INSERT INTO {Order.__tablename__} (user_id, order_date, status, total_amount) "
+            "SELECT 1 + n % 500, now() - n * interval '1 minute', "
+            "CASE WHEN n % 20 = 0 THEN 'pending' WHEN n % 5 = 0 THEN 'shipped' ELSE 'delivered' END, 10 "
+            "FROM generate_series(1, 20000) AS n"
+        )
+    )
+    await db_session_for_test.execute(
+        text(
+            f"INSERT INTO {OrderItem.__tablename__} (order_id, product_id, quantity, price_at_purchase, item_total) "
+            f"SELECT order_id, 1 + order_id % 100, 1, 10, 10 FROM {Order.__tablename__}"
+        )
+    )
+    for table in (Order.__tablename__, OrderItem.__tablename__):
+        await db_session_for_test.execute(text(f"ANALYZE {table}"))
+
+    first_page = await client.get("/orders/", params={"limit": 100})
+    filters = [
+        {},
+        {"user_id": 6},
+        {"status": "pending"},
+        {"status": "delivered"},
+        {"user_id": 6, "status": "shipped"},
+        {"cursor": first_page.headers["X-Next-Cursor"]},
+    ]
+    connection = await db_session_for_test.connection()
+    for params in filters:
+        queries = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            queries.append((statement, parameters))
+
+        event.listen(engine.sync_engine, "before_cursor_execute", record)
+        try:
+            response = await client.get("/orders/", params=params)
+        finally:
+            event.remove(engine.sync_engine, "before_cursor_execute", record)
+        assert response.status_code == 200
+        assert len(queries) == 2  # Orders, then their items
+
+        for statement, parameters in queries:
+            plan = "\n".join((await connection.exec_driver_sql(f"EXPLAIN {statement}", parameters)).scalars())
+            assert "Seq Scan" not in plan, f"GET /orders/ with {params} scans a whole table:\n{plan}"
+
+
+async def test_db_pool_metrics_track_checked_out_connections():
+    """
+    Tests that database pool gauges follow connections being checked out and
+    returned, and that each session's checkout is timed.
+    """
+    def sample(name, **labels):
+        return registry.get_sample_value(name, {"app_name": "order_service", **labels}) or 0
+
+    checkouts_before = sample("db_pool_checkout_duration_seconds_count")
+    async with SessionLocal() as db:
+        await db.execute(select(1))
+        checked_out = sample("db_pool_connections", state="checked_out")
+        assert checked_out >= 1
+    assert sample("db_pool_connections", state="checked_out") == checked_out - 1
+    assert sample("db_pool_checkout_duration_seconds_count") == checkouts_before + 1
+    if main_module.DB_POOL_CLASS == "queue":
+        assert sample("db_pool_capacity_connections") == main_module.DB_POOL_SIZE + main_module.DB_MAX_OVERFLOW
@@ -0,0 +1,149 @@
+# week09/example-2/backend/product_service/app/blob_storage.py
+
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Callable, List, Optional
+from urllib.parse import quote, unquote
+
+from azure.core.exceptions import ResourceExistsError
+from azure.storage.blob import BlobSasPermissions, ContentSettings, generate_blob_sas
+from azure.storage.blob.aio import BlobServiceClient
+from fastapi import HTTPException, UploadFile, status
+
+from .cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+
+def create_blob_service_client(account_url: str, account_key: str, account_name: str) -> BlobServiceClient:
+    """
+    Async client for Azure Blob Storage. account_url may point at Azurite
+    (e.g. http://azurite:10000/devstoreaccount1) for local development.
+    """
+    return BlobServiceClient(
+        account_url=account_url,
+        credential={"account_name": account_name, "account_key": account_key},
+    )
+
+
+async def ensure_container(blob_service_client, container_name: str):
+    try:
+        await blob_service_client.get_container_client(container_name).create_container()
+        logger.info(f"Product Service: Azure container '{container_name}' created.")
+    except ResourceExistsError:
+        pass
+
+
+async def stream_upload_to_blob(
+    blob_client, file: UploadFile, content_type: str, chunk_size: int, max_bytes: int
+) -> int:
+    """
+    Uploads the file as a block blob one chunk at a time: each chunk is staged as a
+    block and the block list is committed at the end, so at most chunk_size bytes of
+    the file are held in memory. Returns the number of bytes uploaded.
+
+    Raises a 413 HTTPException once more than max_bytes have been read from the file.
+    Starlette has already received and spooled the whole request body by then, so this
+    only keeps oversized files out of storage; content_length_exceeds is what turns
+    them away before the body is read. Nothing is committed in that case; Azure
+    discards the staged blocks on its own.
+    """
+    if file.size is not None and file.size > max_bytes:
+        raise _too_large(max_bytes)
+
+    block_ids: List[str] = []
+    uploaded = 0
+    while chunk := await file.read(chunk_size):
+        uploaded += len(chunk)
+        if uploaded > max_bytes:
+            raise _too_large(max_bytes)
+        # Block IDs of a blob must all have the same length; the SDK base64-encodes them
+        block_id = f"{len(block_ids):08d}"
+        await blob_client.stage_block(block_id, chunk, length=len(chunk))
+        block_ids.append(block_id)
+
+    await blob_client.commit_block_list(
+        block_ids, content_settings=ContentSettings(content_type=content_type)
+    )
+    return uploaded
+
+
+# Room for the multipart boundaries and part headers around the file itself
+MULTIPART_OVERHEAD_BYTES = 16 * 1024
+
+
+def content_length_exceeds(content_length: Optional[str], max_bytes: int) -> bool:
+    """
+    Whether a multipart upload announces a body too large to carry a file of at most
+    max_bytes. Requests without a usable Content-Length (e.g. chunked) are let through
+    and left to the limit in stream_upload_to_blob.
+    """
+    if content_length is None or not content_length.isdigit():
+        return False
+    return int(content_length) > max_bytes + MULTIPART_OVERHEAD_BYTES
+
+
+def _too_large(max_bytes: int) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+        detail=f"Image is larger than the {max_bytes} byte limit.",
+    )
+
+
+class BlobUrlSigner:
+    """
+    Read-only SAS URLs for the blobs of one container, cached by blob name.
+
+    A token is valid for expiry_seconds and signed again once fewer than
+    refresh_before_expiry_seconds remain, so each blob costs one HMAC per refresh
+    window however often it is read. Keep refresh_before_expiry_seconds above the TTL
+    of any cache holding rendered responses, so no client is handed a URL about to expire.
+    """
+
+    def __init__(
+        self,
+        account_url: str,
+        account_name: str,
+        account_key: str,
+        container_name: str,
+        expiry_seconds: float,
+        refresh_before_expiry_seconds: float,
+        max_entries: int,
+        on_lookup: Optional[Callable[[str], None]] = None,
+    ):
+        self.container_url = f"{account_url.rstrip('/')}/{container_name}/"
+        self.account_name = account_name
+        self.account_key = account_key
+        self.container_name = container_name
+        self.expiry_seconds = expiry_seconds
+        self._on_lookup = on_lookup
+        self._urls = TTLCache(max_entries, expiry_seconds - refresh_before_expiry_seconds)
+
+    def url(self, blob_name: str) -> str:
+        signed = self._urls.get(blob_name)
+        if signed is not None:
+            self._lookup("hit")
+            return signed
+        self._lookup("miss")
+        generation = self._urls.generation()
+        sas_token = generate_blob_sas(
+            account_name=self.account_name,
+            account_key=self.account_key,
+            container_name=self.container_name,
+            blob_name=blob_name,
+            permission=BlobSasPermissions(read=True),
+            expiry=datetime.now(timezone.utc) + timedelta(seconds=self.expiry_seconds),
+        )
+        signed = f"{self.container_url}{quote(blob_name, safe='~/')}?{sas_token}"
+        self._urls.set(blob_name, signed, generation)
+        return signed
+
+    def blob_name(self, url: str) -> Optional[str]:
+        """The blob a URL points to if it is in this container (signed or not), otherwise None."""
+        if not url.startswith(self.container_url):
+            return None
+        return unquote(url[len(self.container_url):].split("?", 1)[0]) or None
+
+    def _lookup(self, result: str):
+        if self._on_lookup:
+            self._on_lookup(result)
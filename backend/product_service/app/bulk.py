@@ -0,0 +1,251 @@
+# week09/example-2/backend/product_service/app/bulk.py
+
+import asyncio
+import codecs
+import csv
+import io
+import json
+from datetime import datetime
+from decimal import Decimal
+from typing import AsyncIterator, Callable, List, Optional, Tuple
+
+from pydantic import ValidationError
+from sqlalchemy import select
+
+from .models import Product
+from .schemas import BulkImportError, BulkImportResponse, ProductCreate
+
+# Fields accepted per product, in CSV header order for exports
+IMPORT_FIELDS = ("name", "description", "price", "stock_quantity", "image_url")
+EXPORT_FIELDS = ("product_id",) + IMPORT_FIELDS + ("created_at", "updated_at")
+REQUIRED_CSV_FIELDS = {"name", "price", "stock_quantity"}
+# Columns written by COPY; the rest come from column defaults
+COPY_COLUMNS = ("name", "description", "price", "stock_quantity", "image_url", "image_blob_name")
+# Limits of the products table columns that ProductCreate does not check
+MAX_PRICE = Decimal("99999999.99")
+MAX_STOCK_QUANTITY = 2**31 - 1
+
+
+class BulkFormatError(ValueError):
+    """The upload as a whole cannot be parsed (e.g. a CSV header without required columns)."""
+
+
+# Records are parsed and yielded per received chunk, not per line, to keep the
+# per-row overhead of the async generators out of the import's hot loop
+Records = AsyncIterator[List[Tuple[int, object]]]
+
+
+async def _lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[List[str]]:
+    """Splits a byte stream into text lines without holding more than one partial line."""
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    pending = ""
+    async for chunk in chunks:
+        pending += decoder.decode(chunk)
+        *lines, pending = pending.split("\n")
+        if lines:
+            yield lines
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield [pending]
+
+
+async def ndjson_records(chunks: AsyncIterator[bytes]) -> Records:
+    """Yields (line number, parsed object or the parse error) for each non-blank line."""
+    line_number = 0
+    async for lines in _lines(chunks):
+        records = []
+        for line_number, line in enumerate(lines, line_number + 1):
+            if not line.strip():
+                continue
+            try:
+                records.append((line_number, json.loads(line)))
+            except json.JSONDecodeError as e:
+                records.append((line_number, ValueError(f"Invalid JSON: {e.msg}")))
+        yield records
+
+
+def _csv_header(values: List[str]) -> List[str]:
+    header = [name.strip() for name in values]
+    unknown = set(header) - set(IMPORT_FIELDS)
+    missing = REQUIRED_CSV_FIELDS - set(header)
+    if unknown or missing:
+        raise BulkFormatError(
+            f"CSV header must name columns from {', '.join(IMPORT_FIELDS)}"
+            + (f"; unknown: {', '.join(sorted(unknown))}" if unknown else "")
+            + (f"; missing: {', '.join(sorted(missing))}" if missing else "")
+        )
+    return header
+
+
+async def csv_records(chunks: AsyncIterator[bytes]) -> Records:
+    """
+    Yields (line number, dict of the row's fields) for each CSV record after the header.
+    Empty fields are read as missing. Quoted fields may span lines; a record ends on a
+    line that leaves an even number of quotes open.
+    """
+    header = None
+    record, record_line, quotes = [], 0, 0
+    line_number = 0
+    async for lines in _lines(chunks):
+        records = []
+        for line_number, line in enumerate(lines, line_number + 1):
+            if not record:
+                record_line = line_number
+            record.append(line)
+            quotes += line.count('"')
+            if quotes % 2:
+                continue
+            text = "\n".join(record).rstrip("\r")
+            record, quotes = [], 0
+            if not text.strip():
+                continue
+            values = next(csv.reader([text]))
+            if header is None:
+                header = _csv_header(values)
+            elif len(values) != len(header):
+                records.append((record_line, ValueError(f"Expected {len(header)} fields, got {len(values)}.")))
+            else:
+                records.append((record_line, {name: value for name, value in zip(header, values) if value != ""}))
+        yield records
+    if record:
+        yield [(record_line, ValueError("Unterminated quoted field."))]
+
+
+def _validation_message(error: ValidationError) -> str:
+    return "; ".join(
+        f"{'.'.join(str(part) for part in detail['loc']) or 'row'}: {detail['msg']}" for detail in error.errors()
+    )
+
+
+def to_copy_row(raw: object, blob_name_for: Callable[[str], Optional[str]]) -> tuple:
+    """Validates one imported product and returns its COPY_COLUMNS values. Raises ValueError."""
+    if isinstance(raw, Exception):
+        raise raw
+    try:
+        product = ProductCreate.model_validate(raw)
+    except ValidationError as e:
+        raise ValueError(_validation_message(e)) from None
+    price = round(Decimal(str(product.price)), 2)
+    if price > MAX_PRICE:
+        raise ValueError(f"price: must be at most {MAX_PRICE}")
+    if product.stock_quantity > MAX_STOCK_QUANTITY:
+        raise ValueError(f"stock_quantity: must be at most {MAX_STOCK_QUANTITY}")
+    # URLs into the image container are stored as blob names, as for single creates
+    blob_name = blob_name_for(product.image_url) if product.image_url else None
+    return (
+        product.name,
+        product.description,
+        price,
+        product.stock_quantity,
+        None if blob_name else product.image_url,
+        blob_name,
+    )
+
+
+async def import_products(
+    db,
+    records: Records,
+    batch_size: int,
+    max_reported_errors: int,
+    blob_name_for: Callable[[str], Optional[str]],
+) -> BulkImportResponse:
+    """
+    Validates the records and loads the valid ones with COPY, batch_size rows at a time,
+    in the session's transaction (the caller commits). Invalid rows are skipped and
+    reported by line number. A batch the database rejects is rolled back to its
+    savepoint and every row in it is reported.
+
+    Each batch is copied while the next one is parsed, so the database's work (mostly
+    index maintenance) overlaps with this process's.
+    """
+    connection = await db.connection()
+    raw_connection = (await connection.get_raw_connection()).driver_connection
+    result = BulkImportResponse(imported=0, rejected=0, errors=[])
+
+    def reject(line: int, message: str):
+        result.rejected += 1
+        if len(result.errors) < max_reported_errors:
+            result.errors.append(BulkImportError(line=line, error=message))
+        else:
+            result.errors_truncated = True
+
+    async def flush(batch: List[tuple], lines: List[int]):
+        try:
+            async with db.begin_nested():
+                # SQLAlchemy emits BEGIN and SAVEPOINT lazily, with the next statement it
+                # runs; without one, COPY on the raw connection would run outside both
+                await db.execute(select(1))
+                await raw_connection.copy_records_to_table(
+                    Product.__tablename__, records=batch, columns=COPY_COLUMNS
+                )
+            result.imported += len(batch)
+        except Exception as e:
+            message = f"Batch of lines {lines[0]}-{lines[-1]} was rejected by the database: {e}"
+            for line in lines:
+                reject(line, message)
+
+    batch, lines = [], []
+    copying: Optional[asyncio.Task] = None
+    try:
+        async for chunk in records:
+            for line, raw in chunk:
+                try:
+                    batch.append(to_copy_row(raw, blob_name_for))
+                    lines.append(line)
+                except ValueError as e:
+                    reject(line, str(e))
+                    continue
+                if len(batch) >= batch_size:
+                    # One statement at a time per connection: wait for the previous batch
+                    if copying:
+                        await copying
+                    copying = asyncio.create_task(flush(batch, lines))
+                    batch, lines = [], []
+        if copying:
+            await copying
+        if batch:
+            await flush(batch, lines)
+    finally:
+        if copying and not copying.done():
+            copying.cancel()
+    result.errors.sort(key=lambda error: error.line)
+    return result
+
+
+def _json_value(value):
+    # Prices are numbers in NDJSON, as in ProductResponse
+    return float(value) if isinstance(value, Decimal) else value
+
+
+async def export_products(
+    session_factory,
+    export_format: str,
+    batch_size: int,
+    image_url_for: Callable[[str], Optional[str]],
+) -> AsyncIterator[bytes]:
+    """
+    Streams every product, ordered by product_id, as NDJSON lines or CSV rows. A
+    server-side cursor fetches batch_size rows at a time, so memory use does not grow
+    with the catalog. Uploaded images are exported as signed URLs, which an import
+    stores as blob names again.
+    """
+    columns = [getattr(Product, field) for field in EXPORT_FIELDS] + [Product.image_blob_name]
+    query = select(*columns).order_by(Product.product_id).execution_options(yield_per=batch_size)
+    if export_format == "csv":
+        yield (",".join(EXPORT_FIELDS) + "\r\n").encode()
+    async with session_factory() as db:
+        connection = await db.connection()
+        result = await connection.stream(query)
+        async for rows in result.partitions():
+            out = io.StringIO()
+            writer = csv.writer(out) if export_format == "csv" else None
+            for row in rows:
+                values = [value.isoformat() if isinstance(value, datetime) else value for value in row[:-1]]
+                if row.image_blob_name:
+                    values[EXPORT_FIELDS.index("image_url")] = image_url_for(row.image_blob_name)
+                if writer:
+                    writer.writerow(["" if value is None else value for value in values])
+                else:
+                    out.write(json.dumps(dict(zip(EXPORT_FIELDS, map(_json_value, values)))))
+                    out.write("\n")
+            yield out.getvalue().encode()
@@ -0,0 +1,71 @@
+# week09/example-2/backend/product_service/app/cache.py
+
+import time
+from collections import OrderedDict
+from typing import Callable, Hashable, Optional
+
+
+class TTLCache:
+    """
+    A bounded, in-process LRU cache whose entries also expire after a fixed TTL.
+
+    Meant for use from a single event loop (no locking). Writers call invalidate()
+    after committing; readers take generation() before loading from the database and
+    pass it to set(), so a value read before a concurrent invalidation is never stored.
+    """
+
+    def __init__(
+        self,
+        max_entries: int,
+        ttl_seconds: float,
+        on_evict: Optional[Callable[[str], None]] = None,
+    ):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._on_evict = on_evict
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._generation = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0 and self.ttl_seconds > 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def generation(self) -> int:
+        return self._generation
+
+    def get(self, key: Hashable):
+        """Returns the cached value, or None if it is missing or has expired."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            self._evicted("expired")
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value, generation: int):
+        if not self.enabled or generation != self._generation:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._evicted("size")
+
+    def invalidate(self, key: Hashable):
+        self._generation += 1
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._generation += 1
+        self._entries.clear()
+
+    def _evicted(self, reason: str):
+        if self._on_evict:
+            self._on_evict(reason)
@@ -0,0 +1,88 @@
+# week09/example-2/backend/product_service/app/image_variants.py
+
+import asyncio
+import io
+import multiprocessing
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Dict
+
+from azure.storage.blob import ContentSettings
+from PIL import Image, ImageOps
+
+VARIANT_CONTENT_TYPE = "image/webp"
+
+
+def parse_variant_sizes(spec: str) -> Dict[str, int]:
+    """
+    Parses "thumbnail:160,small:480" into {"thumbnail": 160, "small": 480}: variant
+    name to the longest edge in pixels.
+    """
+    sizes = {}
+    for entry in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, max_edge = entry.partition(":")
+        sizes[name.strip()] = int(max_edge)
+    return sizes
+
+
+def variant_blob_name(blob_name: str, variant: str) -> str:
+    """product-7-20240101120000.jpg -> product-7-20240101120000-thumbnail.webp"""
+    return f"{os.path.splitext(blob_name)[0]}-{variant}.webp"
+
+
+def generate_image_variants(data: bytes, sizes: Dict[str, int], quality: int) -> Dict[str, bytes]:
+    """
+    Decodes the image once and returns a WebP rendition per variant, scaled to fit
+    within max_edge x max_edge. Images are never scaled up. CPU-bound: run it in a
+    process pool, not on the event loop.
+    """
+    with Image.open(io.BytesIO(data)) as source:
+        # JPEGs can be decoded at a reduced scale, which is much cheaper than full size
+        largest = max(sizes.values())
+        source.draft("RGB", (largest, largest))
+        image = ImageOps.exif_transpose(source)
+        has_alpha = image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info
+        image = image.convert("RGBA" if has_alpha else "RGB")
+
+    variants = {}
+    for name, max_edge in sizes.items():
+        variant = image.copy()
+        variant.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+        out = io.BytesIO()
+        variant.save(out, "WEBP", quality=quality, method=4)
+        variants[name] = out.getvalue()
+    return variants
+
+
+def create_image_variant_pool(workers: int) -> ProcessPoolExecutor:
+    # Spawned rather than forked: the parent runs an event loop with open sockets
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+
+async def build_image_variants(
+    blob_service_client,
+    container: str,
+    blob_name: str,
+    pool: Executor,
+    sizes: Dict[str, int],
+    quality: int,
+) -> Dict[str, str]:
+    """
+    Downloads the original image, renders the variants in the pool and uploads each
+    as a sibling blob. Returns the variant name to blob name mapping.
+    """
+    source = blob_service_client.get_blob_client(container=container, blob=blob_name)
+    data = await (await source.download_blob()).readall()
+    variants = await asyncio.get_running_loop().run_in_executor(
+        pool, generate_image_variants, data, sizes, quality
+    )
+    del data
+
+    variant_blobs = {}
+    for name, content in variants.items():
+        variant_blob = variant_blob_name(blob_name, name)
+        await blob_service_client.get_blob_client(container=container, blob=variant_blob).upload_blob(
+            content, overwrite=True, content_settings=ContentSettings(content_type=VARIANT_CONTENT_TYPE)
+        )
+        variant_blobs[name] = variant_blob
+    return variant_blobs
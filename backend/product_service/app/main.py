@@ -1,26 +1,25 @@
 # week09/example-2/backend/product_service/app/main.py
 
+import asyncio
+import hashlib
+import json
 import logging
 import os
+import re
 import sys
 import time
 from datetime import datetime, timedelta
 from decimal import Decimal
-from typing import List, Optional
+from typing import List, Optional, Set, Union
 from urllib.parse import urlparse
 
 # Azure Storage Imports
-from azure.storage.blob import (
-    BlobSasPermissions,
-    BlobServiceClient,
-    ContentSettings,
-    generate_blob_sas,
-)
 from fastapi import (
     Depends,
     FastAPI,
     File,
     Form,
+    Header,
     HTTPException,
     Query,
     Response,
@@ -29,17 +28,71 @@ from fastapi import (
     Request, # Import Request for middleware
 )
 from fastapi.middleware.cors import CORSMiddleware
+from pydantic import TypeAdapter
+from redis import asyncio as aioredis
+from sqlalchemy import Integer, any_, bindparam, column, func, select, update, values
+from sqlalchemy.dialects.postgresql import ARRAY, insert as pg_insert
 from sqlalchemy.exc import OperationalError
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
 # --- Prometheus client imports ---
-from prometheus_client import Counter, Histogram, Gauge, generate_latest
+from prometheus_client import Counter, Histogram, Gauge, generate_latest, multiprocess
 from prometheus_client.core import CollectorRegistry
-from starlette.responses import PlainTextResponse
-
-from .db import Base, engine, get_db
-from .models import Product
-from .schemas import ProductCreate, ProductResponse, ProductUpdate, StockDeductRequest
+from starlette.responses import JSONResponse, PlainTextResponse, StreamingResponse
+
+from .blob_storage import (
+    BlobUrlSigner,
+    content_length_exceeds,
+    create_blob_service_client,
+    ensure_container,
+    stream_upload_to_blob,
+)
+from .bulk import BulkFormatError, csv_records, export_products, import_products, ndjson_records
+from .cache import TTLCache
+from .image_variants import (
+    build_image_variants,
+    create_image_variant_pool,
+    parse_variant_sizes,
+)
+from .db import (
+    DB_MAX_OVERFLOW,
+    DB_POOL_CLASS,
+    DB_POOL_SIZE,
+    SessionLocal,
+    engine,
+    get_db,
+    pool_stats,
+)
+from .idempotency import (
+    IDEMPOTENCY_KEY_HEADER,
+    IDEMPOTENT_REPLAYED_HEADER,
+    claim_idempotency_key,
+    replay_response,
+    request_fingerprint,
+    run_idempotency_key_purge,
+    store_idempotent_response,
+)
+from .pagination import NEXT_CURSOR_HEADER, decode_cursor, encode_cursor
+from .shared_cache import SharedProductCache
+from .stock_metrics import StockCollector
+from .search import apply_search, check_trigram_indexes, is_ranked, resolve_search_mode
+from .metrics_labels import LabelGuard, route_template
+from .migrate import upgrade_schema
+from .models import Product, StockAdjustment
+from .schemas import (
+    BulkImportResponse,
+    ExportFormat,
+    ProductBatchResponse,
+    ProductCreate,
+    ProductResponse,
+    ProductUpdate,
+    SearchMode,
+    StockDeductRequest,
+    StockReleaseRequest,
+    StockReleaseResponse,
+    StockReserveRequest,
+    set_blob_url_signer,
+)
 
 # --- Standard Logging Configuration ---
 logging.basicConfig(
@@ -59,47 +112,82 @@ AZURE_STORAGE_CONTAINER_NAME = os.getenv(
     "AZURE_STORAGE_CONTAINER_NAME", "product-images"
 )
 AZURE_SAS_TOKEN_EXPIRY_HOURS = int(os.getenv("AZURE_SAS_TOKEN_EXPIRY_HOURS", "24"))
+# Image URLs are signed when products are read and the signed URL is reused until this
+# long before it expires; keep it above PRODUCT_CACHE_TTL_SECONDS and SHARED_CACHE_TTL_SECONDS
+AZURE_SAS_REFRESH_BEFORE_EXPIRY_SECONDS = float(os.getenv("AZURE_SAS_REFRESH_BEFORE_EXPIRY_SECONDS", "3600"))
+AZURE_SAS_URL_CACHE_MAX_ENTRIES = int(os.getenv("AZURE_SAS_URL_CACHE_MAX_ENTRIES", "10000"))
+# Blob endpoint; point it at Azurite (http://azurite:10000/devstoreaccount1) for local development
+AZURE_STORAGE_ACCOUNT_URL = os.getenv(
+    "AZURE_STORAGE_ACCOUNT_URL", f"https://{AZURE_STORAGE_ACCOUNT_NAME}.blob.core.windows.net"
+)
+# Images are streamed to storage in blocks of this size; larger uploads are rejected with 413
+IMAGE_UPLOAD_CHUNK_BYTES = int(os.getenv("IMAGE_UPLOAD_CHUNK_BYTES", str(1024 * 1024)))
+IMAGE_UPLOAD_MAX_BYTES = int(os.getenv("IMAGE_UPLOAD_MAX_BYTES", str(10 * 1024 * 1024)))
+# WebP variants generated after each upload, as name:longest-edge-in-pixels pairs
+IMAGE_VARIANT_SIZES = parse_variant_sizes(
+    os.getenv("IMAGE_VARIANT_SIZES", "thumbnail:160,small:480,medium:960")
+)
+IMAGE_VARIANT_QUALITY = int(os.getenv("IMAGE_VARIANT_QUALITY", "80"))
+# Processes per service worker that render variants (0 disables variant generation)
+IMAGE_VARIANT_WORKERS = int(os.getenv("IMAGE_VARIANT_WORKERS", "1"))
 
-# Initialize BlobServiceClient
-if AZURE_STORAGE_ACCOUNT_NAME and AZURE_STORAGE_ACCOUNT_KEY:
-    try:
-        blob_service_client = BlobServiceClient(
-            account_url=f"https://{AZURE_STORAGE_ACCOUNT_NAME}.blob.core.windows.net",
-            credential=AZURE_STORAGE_ACCOUNT_KEY,
-        )
-        logger.info("Product Service: Azure BlobServiceClient initialized.")
-        # Ensure the container exists
-        try:
-            container_client = blob_service_client.get_container_client(
-                AZURE_STORAGE_CONTAINER_NAME
-            )
-            container_client.create_container()
-            logger.info(
-                f"Product Service: Azure container '{AZURE_STORAGE_CONTAINER_NAME}' ensured to exist."
-            )
-        except Exception as e:
-            logger.warning(
-                f"Product Service: Could not create or verify Azure container '{AZURE_STORAGE_CONTAINER_NAME}'. It might already exist. Error: {e}"
-            )
-    except Exception as e:
-        logger.critical(
-            f"Product Service: Failed to initialize Azure BlobServiceClient. Check credentials and account name. Error: {e}",
-            exc_info=True,
-        )
-        blob_service_client = None  # Set to None if initialization fails
-else:
-    logger.warning(
-        "Product Service: Azure Storage credentials not found. Image upload functionality will be disabled."
-    )
-    blob_service_client = None
+# Read-through cache for GET /products/{product_id}; 0 for either setting disables it.
+# The cache is per process, so other workers may serve a changed product until the TTL passes.
+PRODUCT_CACHE_MAX_ENTRIES = int(os.getenv("PRODUCT_CACHE_MAX_ENTRIES", "1024"))
+PRODUCT_CACHE_TTL_SECONDS = float(os.getenv("PRODUCT_CACHE_TTL_SECONDS", "30"))
+
+# Optional cache shared by all replicas (Redis protocol) for product detail and list responses.
+# Unset REDIS_URL to disable; the in-process cache and the database are used whenever it is down.
+REDIS_URL = os.getenv("REDIS_URL")
+SHARED_CACHE_TTL_SECONDS = float(os.getenv("SHARED_CACHE_TTL_SECONDS", "300"))
+SHARED_CACHE_TIMEOUT_SECONDS = float(os.getenv("SHARED_CACHE_TIMEOUT_SECONDS", "0.25"))
+SHARED_CACHE_RETRY_AFTER_SECONDS = float(os.getenv("SHARED_CACHE_RETRY_AFTER_SECONDS", "5"))
+
+# Async BlobServiceClient, created at startup when credentials are configured
+blob_service_client = None
 
 
 RESTOCK_THRESHOLD = 5  # Threshold for restock notification
 
+# POST /products/bulk loads rows with COPY in batches of this size and lists at most
+# BULK_IMPORT_MAX_REPORTED_ERRORS rejected rows; GET /products/export fetches this many rows at a time
+BULK_IMPORT_BATCH_SIZE = int(os.getenv("BULK_IMPORT_BATCH_SIZE", "5000"))
+BULK_IMPORT_MAX_REPORTED_ERRORS = int(os.getenv("BULK_IMPORT_MAX_REPORTED_ERRORS", "100"))
+BULK_EXPORT_BATCH_SIZE = int(os.getenv("BULK_EXPORT_BATCH_SIZE", "2000"))
+# Content types accepted by POST /products/bulk
+NDJSON_CONTENT_TYPES = ("application/x-ndjson", "application/ndjson", "application/jsonl")
+CSV_CONTENT_TYPE = "text/csv"
+
+# Most product IDs accepted by one GET /products/batch request
+PRODUCT_BATCH_MAX_IDS = int(os.getenv("PRODUCT_BATCH_MAX_IDS", "100"))
+
+# Stock metrics are read from the database when /metrics is scraped, at most this often
+STOCK_METRICS_MAX_STALENESS_SECONDS = float(os.getenv("STOCK_METRICS_MAX_STALENESS_SECONDS", "15"))
+# Low-stock products that keep a per-product product_stock_quantity series (0 for none)
+STOCK_METRICS_LOW_STOCK_LIMIT = int(os.getenv("STOCK_METRICS_LOW_STOCK_LIMIT", "50"))
+
+# Responses to stock requests sent with an Idempotency-Key are kept this long for replay
+IDEMPOTENCY_KEY_TTL_SECONDS = float(os.getenv("IDEMPOTENCY_KEY_TTL_SECONDS", "86400"))
+# Expired keys are deleted in the background this often (0 disables the purge), in batches
+IDEMPOTENCY_PURGE_INTERVAL_SECONDS = float(os.getenv("IDEMPOTENCY_PURGE_INTERVAL_SECONDS", "300"))
+IDEMPOTENCY_PURGE_BATCH_SIZE = int(os.getenv("IDEMPOTENCY_PURGE_BATCH_SIZE", "1000"))
+# Applied stock release keys are remembered this long and then purged with the idempotency
+# keys; keep it well above the longest time a caller may still redeliver a release
+STOCK_ADJUSTMENT_TTL_SECONDS = float(os.getenv("STOCK_ADJUSTMENT_TTL_SECONDS", "604800"))
+# Idempotency keys are scoped per endpoint
+DEDUCT_STOCK_SCOPE = "PATCH /products/{product_id}/deduct-stock"
+ADD_STOCK_SCOPE = "PATCH /products/{product_id}/add-stock"
+RESERVE_STOCK_SCOPE = "POST /products/stock/reserve"
+
 # --- Prometheus Metrics Initialization ---
 # Create a custom registry specific to this application instance
 registry = CollectorRegistry()
 APP_NAME = "product_service" # Unique identifier for this service in metrics
+# Set (by gunicorn.conf.py) when several worker processes serve the app. Each worker then
+# writes its metric values to files in this directory and /metrics aggregates all of them.
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+# Cardinality guard for the endpoint label of the HTTP metrics
+METRICS_MAX_ENDPOINT_LABELS = int(os.getenv("METRICS_MAX_ENDPOINT_LABELS", "200"))
 
 # Define Prometheus metrics
 # Counter: Total HTTP requests
@@ -115,7 +203,8 @@ REQUEST_DURATION = Histogram(
 # Gauge: Number of concurrent HTTP requests currently in progress
 REQUESTS_IN_PROGRESS = Gauge(
     'http_requests_in_progress', 'Number of HTTP requests in progress',
-    ['app_name', 'method', 'endpoint'], registry=registry
+    ['app_name', 'method', 'endpoint'], registry=registry,
+    multiprocess_mode='livesum',  # Summed over live workers in multiprocess mode
 )
 
 # Custom Metrics specific to Product Service business logic
@@ -123,6 +212,10 @@ PRODUCT_CREATION_TOTAL = Counter(
     'product_creation_total', 'Total number of products created',
     ['app_name', 'status'], registry=registry
 )
+PRODUCT_BULK_IMPORT_ROWS_TOTAL = Counter(
+    'product_bulk_import_rows_total', 'Rows received by bulk imports, by whether they were imported',
+    ['app_name', 'result'], registry=registry
+)
 PRODUCT_UPDATE_TOTAL = Counter(
     'product_update_total', 'Total number of products updated',
     ['app_name', 'status'], registry=registry
@@ -135,18 +228,187 @@ STOCK_DEDUCTION_TOTAL = Counter(
     'stock_deduction_total', 'Total stock deduction attempts',
     ['app_name', 'product_id', 'status'], registry=registry
 )
-STOCK_LEVEL_GAUGE = Gauge(
-    'product_stock_quantity', 'Current stock quantity of a product',
-    ['app_name', 'product_id', 'product_name'], registry=registry
+IMAGE_URL_SIGNING_TOTAL = Counter(
+    'product_image_url_signing_total', 'Image URL lookups by whether a cached signed URL was reused',
+    ['app_name', 'result'], registry=registry
+)
+IMAGE_VARIANT_JOBS_TOTAL = Counter(
+    'product_image_variant_jobs_total', 'Image variant generation jobs by outcome',
+    ['app_name', 'status'], registry=registry
+)
+IMAGE_VARIANT_DURATION = Histogram(
+    'product_image_variant_duration_seconds', 'Time to download, render and upload the variants of one image',
+    ['app_name'], registry=registry,
+    buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
 )
 IMAGE_UPLOAD_TOTAL = Counter(
     'product_image_upload_total', 'Total product image upload attempts',
     ['app_name', 'product_id', 'status'], registry=registry
 )
+stock_collector = StockCollector(
+    app_name=APP_NAME,
+    threshold=RESTOCK_THRESHOLD,
+    low_stock_limit=STOCK_METRICS_LOW_STOCK_LIMIT,
+    max_staleness_seconds=STOCK_METRICS_MAX_STALENESS_SECONDS,
+)
+registry.register(stock_collector)
+STOCK_RELEASE_TOTAL = Counter(
+    'stock_release_total', 'Stock release items by result (applied, duplicate or missing)',
+    ['app_name', 'result'], registry=registry
+)
+IDEMPOTENT_REQUESTS_TOTAL = Counter(
+    'idempotent_requests_total', 'Requests sent with an Idempotency-Key, by endpoint and result (stored or replayed)',
+    ['app_name', 'endpoint', 'result'], registry=registry
+)
 LOW_STOCK_ALERTS_TOTAL = Counter(
     'low_stock_alerts_total', 'Total alerts triggered for low stock',
     ['app_name', 'product_id', 'product_name'], registry=registry
 )
+PRODUCT_CACHE_REQUESTS_TOTAL = Counter(
+    'product_cache_requests_total', 'Product cache lookups by tier (local or shared), resource and result (hit, miss or unavailable)',
+    ['app_name', 'tier', 'resource', 'result'], registry=registry
+)
+PRODUCT_CACHE_HIT_RATIO = Gauge(
+    'product_cache_hit_ratio', 'Fraction of product cache lookups answered from the cache since startup',
+    ['app_name', 'tier'], registry=registry
+)
+SHARED_CACHE_OPERATION_DURATION = Histogram(
+    'product_shared_cache_operation_duration_seconds', 'Latency of shared cache operations',
+    ['app_name', 'operation', 'result'], registry=registry,
+    buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5),
+)
+PRODUCT_CACHE_EVICTIONS_TOTAL = Counter(
+    'product_cache_evictions_total', 'Product cache entries evicted, by reason (size or expired)',
+    ['app_name', 'reason'], registry=registry
+)
+# Metrics for the database connection pool, reported by app.db.pool_stats
+DB_POOL_CONNECTIONS = Gauge(
+    'db_pool_connections', 'Database connections held by the pool, by state (checked_out, idle)',
+    ['app_name', 'state'], registry=registry, multiprocess_mode='livesum'
+)
+DB_POOL_OVERFLOW = Gauge(
+    'db_pool_overflow_connections', 'Checked-out database connections beyond DB_POOL_SIZE',
+    ['app_name'], registry=registry, multiprocess_mode='livesum'
+)
+DB_POOL_CAPACITY = Gauge(
+    'db_pool_capacity_connections', 'Most database connections the pool may open (DB_POOL_SIZE + DB_MAX_OVERFLOW)',
+    ['app_name'], registry=registry, multiprocess_mode='livesum'
+)
+DB_POOL_CHECKOUT_DURATION = Histogram(
+    'db_pool_checkout_duration_seconds', 'Time for a session to check out its database connection, including waiting for a free one',
+    ['app_name'], registry=registry,
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+)
+DB_POOL_CHECKOUT_TIMEOUTS_TOTAL = Counter(
+    'db_pool_checkout_timeouts_total', 'Requests that failed waiting DB_POOL_TIMEOUT_SECONDS for a free database connection',
+    ['app_name'], registry=registry
+)
+
+
+def _observe_db_pool(stats):
+    DB_POOL_CONNECTIONS.labels(app_name=APP_NAME, state="checked_out").set(stats.checked_out)
+    DB_POOL_CONNECTIONS.labels(app_name=APP_NAME, state="idle").set(stats.idle)
+    # A null pool (DB_POOL_CLASS=null) opens every connection on demand and never overflows
+    overflow = max(stats.opened - DB_POOL_SIZE, 0) if DB_POOL_CLASS == "queue" else 0
+    DB_POOL_OVERFLOW.labels(app_name=APP_NAME).set(overflow)
+
+
+def _observe_db_pool_checkout(seconds: float):
+    DB_POOL_CHECKOUT_DURATION.labels(app_name=APP_NAME).observe(seconds)
+
+
+def _observe_db_pool_timeout():
+    DB_POOL_CHECKOUT_TIMEOUTS_TOTAL.labels(app_name=APP_NAME).inc()
+
+
+# A null pool has no limit of its own
+if DB_POOL_CLASS == "queue":
+    DB_POOL_CAPACITY.labels(app_name=APP_NAME).set(DB_POOL_SIZE + DB_MAX_OVERFLOW)
+pool_stats.on_change = _observe_db_pool
+pool_stats.on_checkout = _observe_db_pool_checkout
+pool_stats.on_timeout = _observe_db_pool_timeout
+
+# Serialized ProductResponse bodies keyed by product_id
+product_cache = TTLCache(
+    max_entries=PRODUCT_CACHE_MAX_ENTRIES,
+    ttl_seconds=PRODUCT_CACHE_TTL_SECONDS,
+    on_evict=lambda reason: PRODUCT_CACHE_EVICTIONS_TOTAL.labels(app_name=APP_NAME, reason=reason).inc(),
+)
+# Signs the image URLs of product responses; None when storage credentials are missing
+blob_url_signer: Optional[BlobUrlSigner] = None
+if AZURE_STORAGE_ACCOUNT_NAME and AZURE_STORAGE_ACCOUNT_KEY:
+    blob_url_signer = BlobUrlSigner(
+        AZURE_STORAGE_ACCOUNT_URL,
+        AZURE_STORAGE_ACCOUNT_NAME,
+        AZURE_STORAGE_ACCOUNT_KEY,
+        AZURE_STORAGE_CONTAINER_NAME,
+        expiry_seconds=AZURE_SAS_TOKEN_EXPIRY_HOURS * 3600,
+        refresh_before_expiry_seconds=AZURE_SAS_REFRESH_BEFORE_EXPIRY_SECONDS,
+        max_entries=AZURE_SAS_URL_CACHE_MAX_ENTRIES,
+        on_lookup=lambda result: IMAGE_URL_SIGNING_TOTAL.labels(app_name=APP_NAME, result=result).inc(),
+    )
+
+
+# Both look up blob_url_signer on every call, so a replaced signer takes effect
+def sign_image_blob(blob_name: str) -> Optional[str]:
+    return blob_url_signer.url(blob_name) if blob_url_signer else None
+
+
+def image_blob_name_for(image_url: str) -> Optional[str]:
+    return blob_url_signer.blob_name(image_url) if blob_url_signer else None
+
+
+set_blob_url_signer(sign_image_blob)
+# Created at startup when REDIS_URL is set
+shared_product_cache: Optional[SharedProductCache] = None
+_invalidation_listener: Optional[asyncio.Task] = None
+_idempotency_key_purge: Optional[asyncio.Task] = None
+# Created at startup unless IMAGE_VARIANT_WORKERS is 0
+image_variant_pool = None
+# One slot per pool worker; a job downloads the original only once it holds a slot
+image_variant_slots: Optional[asyncio.Semaphore] = None
+# Variant jobs in flight, referenced here so they are not garbage collected before they finish
+_image_variant_tasks: Set[asyncio.Task] = set()
+
+_cache_lookup_counts = {}
+
+
+def record_cache_lookup(tier: str, resource: str, result: str):
+    PRODUCT_CACHE_REQUESTS_TOTAL.labels(app_name=APP_NAME, tier=tier, resource=resource, result=result).inc()
+    _cache_lookup_counts[(tier, result)] = _cache_lookup_counts.get((tier, result), 0) + 1
+
+
+def _cache_hit_ratio(tier: str) -> float:
+    hits = _cache_lookup_counts.get((tier, "hit"), 0)
+    lookups = hits + _cache_lookup_counts.get((tier, "miss"), 0)
+    return hits / lookups if lookups else 0.0
+
+
+# The ratio is per process; with several workers, derive it from product_cache_requests_total instead
+if not PROMETHEUS_MULTIPROC_DIR:
+    for _tier in ("local", "shared"):
+        PRODUCT_CACHE_HIT_RATIO.labels(app_name=APP_NAME, tier=_tier).set_function(
+            lambda tier=_tier: _cache_hit_ratio(tier)
+        )
+
+
+def _observe_shared_cache_operation(operation: str, result: str, seconds: float):
+    SHARED_CACHE_OPERATION_DURATION.labels(app_name=APP_NAME, operation=operation, result=result).observe(seconds)
+
+
+async def invalidate_cached_products(*product_ids: int):
+    """
+    Drops cached copies of the given products (and, in the shared cache, every cached
+    list) after a write has been committed. Other replicas are notified through the
+    shared cache and drop their in-process copies too.
+    """
+    for product_id in product_ids:
+        product_cache.invalidate(product_id)
+    if shared_product_cache:
+        await shared_product_cache.invalidate(product_ids)
+
+
+_product_list_adapter = TypeAdapter(List[ProductResponse])
 
 
 # --- FastAPI Application Setup ---
@@ -163,9 +425,33 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[NEXT_CURSOR_HEADER, IDEMPOTENT_REPLAYED_HEADER],
 )
 
+# --- Middleware rejecting oversized image uploads ---
+# Form bodies are read in full before the endpoint runs, so the size check has to come first
+IMAGE_UPLOAD_PATH = re.compile(r"^/products/(\d+)/upload-image$")
+
+@app.middleware("http")
+async def reject_oversized_image_uploads(request: Request, call_next):
+    upload = IMAGE_UPLOAD_PATH.match(request.url.path) if request.method == "POST" else None
+    if upload and content_length_exceeds(request.headers.get("content-length"), IMAGE_UPLOAD_MAX_BYTES):
+        product_id = upload.group(1)
+        logger.warning(
+            f"Product Service: Image for product {product_id} rejected: "
+            f"Content-Length {request.headers['content-length']} is over the {IMAGE_UPLOAD_MAX_BYTES} byte limit."
+        )
+        IMAGE_UPLOAD_TOTAL.labels(app_name=APP_NAME, product_id=product_id, status="too_large").inc()
+        return JSONResponse(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            content={"detail": f"Image is larger than the {IMAGE_UPLOAD_MAX_BYTES} byte limit."},
+        )
+    return await call_next(request)
+
 # --- Middleware for Prometheus Metrics ---
+# Upper bound on distinct endpoint label values; further ones are reported as "__other__"
+endpoint_label_guard = LabelGuard(METRICS_MAX_ENDPOINT_LABELS)
+
 @app.middleware("http")
 async def add_process_time_header(request: Request, call_next):
     # Exclude the /metrics endpoint itself from being tracked
@@ -174,7 +460,8 @@ async def add_process_time_header(request: Request, call_next):
         return response
 
     method = request.method
-    endpoint = request.url.path
+    # Label by route template, not the raw path, to keep one series per route
+    endpoint = endpoint_label_guard(route_template(request))
 
     # Increment requests in progress
     REQUESTS_IN_PROGRESS.labels(app_name=APP_NAME, method=method, endpoint=endpoint).inc()
@@ -195,14 +482,34 @@ async def add_process_time_header(request: Request, call_next):
     return response
 
 # --- Prometheus Metrics Endpoint ---
+def _metrics_registry() -> CollectorRegistry:
+    """
+    The registry to expose: this process's own, or in multiprocess mode one that
+    aggregates the metric files written by every worker.
+    """
+    if not PROMETHEUS_MULTIPROC_DIR:
+        return registry
+    aggregated = CollectorRegistry()
+    multiprocess.MultiProcessCollector(aggregated)
+    # Stock metrics are read from the database, so whichever worker is scraped reports them
+    aggregated.register(stock_collector)
+    return aggregated
+
+
 # This is the endpoint Prometheus will scrape to collect metrics.
 @app.get("/metrics", response_class=PlainTextResponse, summary="Prometheus metrics endpoint")
-async def metrics():
+async def metrics(db: AsyncSession = Depends(get_db)):
+    try:
+        await stock_collector.refresh(db)
+    except Exception as e:
+        # Serve the last snapshot (or none) rather than failing the whole scrape
+        logger.warning(f"Product Service: Could not refresh stock metrics: {e}")
     # generate_latest collects all metrics from the registry and formats them for Prometheus
-    return PlainTextResponse(generate_latest(registry))
+    return PlainTextResponse(generate_latest(_metrics_registry()))
 
 
 # --- FastAPI Event Handlers ---
+
 @app.on_event("startup")
 async def startup_event():
     max_retries = 10
@@ -210,29 +517,28 @@ async def startup_event():
     for i in range(max_retries):
         try:
             logger.info(
-                f"Product Service: Attempting to connect to PostgreSQL and create tables (attempt {i+1}/{max_retries})..."
+                f"Product Service: Attempting to connect to PostgreSQL and migrate the schema (attempt {i+1}/{max_retries})..."
             )
-            Base.metadata.create_all(bind=engine)
+            image_container_url = blob_url_signer.container_url if blob_url_signer else None
+            async with engine.begin() as conn:
+                # Applies pending Alembic migrations; one worker or replica at a time
+                await conn.run_sync(upgrade_schema, image_container_url=image_container_url)
+                trigram_available = await check_trigram_indexes(conn)
             logger.info(
-                "Product Service: Successfully connected to PostgreSQL and ensured tables exist."
+                "Product Service: Successfully connected to PostgreSQL and migrated the schema."
+            )
+            logger.info(
+                f"Product Service: Search indexes checked (trigram search available: {trigram_available})."
             )
             
-            # Initial population of stock levels into Prometheus Gauge
-            db = next(get_db()) # Get a session for initial load
-            products = db.query(Product).all()
-            for product in products:
-                STOCK_LEVEL_GAUGE.labels(app_name=APP_NAME, product_id=product.product_id, product_name=product.name).set(product.stock_quantity)
-            db.close() # Close the session
-            logger.info("Product Service: Initial product stock levels loaded into Prometheus.")
-
             break  # Exit loop if successful
-        except OperationalError as e:
+        except (OperationalError, OSError) as e:
             logger.warning(f"Product Service: Failed to connect to PostgreSQL: {e}")
             if i < max_retries - 1:
                 logger.info(
                     f"Product Service: Retrying in {retry_delay_seconds} seconds..."
                 )
-                time.sleep(retry_delay_seconds)
+                await asyncio.sleep(retry_delay_seconds)
             else:
                 logger.critical(
                     f"Product Service: Failed to connect to PostgreSQL after {max_retries} attempts. Exiting application."
@@ -246,6 +552,172 @@ async def startup_event():
             sys.exit(1)
 
 
+@app.on_event("startup")
+async def open_shared_cache():
+    global shared_product_cache, _invalidation_listener
+    if not REDIS_URL:
+        logger.info("Product Service: REDIS_URL not set; shared product cache disabled.")
+        return
+    shared_product_cache = SharedProductCache(
+        aioredis.from_url(
+            REDIS_URL,
+            socket_timeout=SHARED_CACHE_TIMEOUT_SECONDS,
+            socket_connect_timeout=SHARED_CACHE_TIMEOUT_SECONDS,
+        ),
+        ttl_seconds=SHARED_CACHE_TTL_SECONDS,
+        retry_after_seconds=SHARED_CACHE_RETRY_AFTER_SECONDS,
+        on_operation=_observe_shared_cache_operation,
+    )
+    # The subscription blocks on reads, so it gets its own client without the short timeout
+    listener_cache = SharedProductCache(
+        aioredis.from_url(REDIS_URL),
+        ttl_seconds=SHARED_CACHE_TTL_SECONDS,
+        retry_after_seconds=SHARED_CACHE_RETRY_AFTER_SECONDS,
+    )
+    _invalidation_listener = asyncio.create_task(
+        listener_cache.listen_for_invalidations(product_cache.invalidate)
+    )
+    logger.info(f"Product Service: Shared product cache enabled (ttl={SHARED_CACHE_TTL_SECONDS}s).")
+
+
+@app.on_event("shutdown")
+async def close_shared_cache():
+    global shared_product_cache, _invalidation_listener
+    if _invalidation_listener:
+        _invalidation_listener.cancel()
+        _invalidation_listener = None
+    if shared_product_cache:
+        await shared_product_cache.close()
+        shared_product_cache = None
+
+
+@app.on_event("startup")
+async def open_blob_storage():
+    global blob_service_client
+    if not (AZURE_STORAGE_ACCOUNT_NAME and AZURE_STORAGE_ACCOUNT_KEY):
+        logger.warning(
+            "Product Service: Azure Storage credentials not found. Image upload functionality will be disabled."
+        )
+        return
+    try:
+        blob_service_client = create_blob_service_client(
+            AZURE_STORAGE_ACCOUNT_URL, AZURE_STORAGE_ACCOUNT_KEY, AZURE_STORAGE_ACCOUNT_NAME
+        )
+        logger.info("Product Service: Azure BlobServiceClient initialized.")
+    except Exception as e:
+        logger.critical(
+            f"Product Service: Failed to initialize Azure BlobServiceClient. Check credentials and account name. Error: {e}",
+            exc_info=True,
+        )
+        return
+    try:
+        await ensure_container(blob_service_client, AZURE_STORAGE_CONTAINER_NAME)
+    except Exception as e:
+        logger.warning(
+            f"Product Service: Could not create or verify Azure container '{AZURE_STORAGE_CONTAINER_NAME}'. Error: {e}"
+        )
+
+
+@app.on_event("shutdown")
+async def close_blob_storage():
+    global blob_service_client
+    if blob_service_client:
+        await blob_service_client.close()
+        blob_service_client = None
+
+
+@app.on_event("startup")
+async def start_image_variant_pool():
+    global image_variant_pool, image_variant_slots
+    if IMAGE_VARIANT_WORKERS > 0 and IMAGE_VARIANT_SIZES:
+        image_variant_pool = create_image_variant_pool(IMAGE_VARIANT_WORKERS)
+        image_variant_slots = asyncio.Semaphore(IMAGE_VARIANT_WORKERS)
+        logger.info(
+            f"Product Service: Image variant pool started ({IMAGE_VARIANT_WORKERS} processes, variants: {', '.join(IMAGE_VARIANT_SIZES)})."
+        )
+
+
+@app.on_event("shutdown")
+async def stop_image_variant_pool():
+    global image_variant_pool, image_variant_slots
+    for task in list(_image_variant_tasks):
+        task.cancel()
+    if image_variant_pool:
+        image_variant_pool.shutdown(wait=False, cancel_futures=True)
+        image_variant_pool = None
+    image_variant_slots = None
+
+
+@app.on_event("startup")
+async def start_idempotency_key_purge():
+    global _idempotency_key_purge
+    if IDEMPOTENCY_PURGE_INTERVAL_SECONDS > 0:
+        _idempotency_key_purge = asyncio.create_task(
+            run_idempotency_key_purge(
+                SessionLocal, IDEMPOTENCY_PURGE_INTERVAL_SECONDS, IDEMPOTENCY_PURGE_BATCH_SIZE
+            )
+        )
+
+
+@app.on_event("shutdown")
+async def stop_idempotency_key_purge():
+    global _idempotency_key_purge
+    if _idempotency_key_purge:
+        _idempotency_key_purge.cancel()
+        _idempotency_key_purge = None
+
+
+async def claim_stock_request(
+    db: AsyncSession, scope: str, idempotency_key: Optional[str], **params
+) -> Optional[Response]:
+    """
+    Claims the request's Idempotency-Key, if it has one, for the request defined by
+    params. Returns the stored response when the key has already been used for it.
+    """
+    if not idempotency_key:
+        return None
+    stored = await claim_idempotency_key(
+        db,
+        scope,
+        idempotency_key,
+        request_fingerprint(**params),
+        IDEMPOTENCY_KEY_TTL_SECONDS,
+    )
+    if stored is None:
+        return None
+    logger.info(f"Product Service: Replaying stored response for {scope} (Idempotency-Key: {idempotency_key}).")
+    IDEMPOTENT_REQUESTS_TOTAL.labels(app_name=APP_NAME, endpoint=scope, result="replayed").inc()
+    return replay_response(stored)
+
+
+async def store_stock_response(
+    db: AsyncSession, scope: str, idempotency_key: str, db_product: Union[Product, List[Product]]
+) -> bytes:
+    """Stores a successful stock response under its Idempotency-Key, before the commit."""
+    if isinstance(db_product, list):
+        body = _product_list_adapter.dump_json(
+            _product_list_adapter.validate_python(db_product, from_attributes=True)
+        )
+    else:
+        body = ProductResponse.model_validate(db_product).model_dump_json().encode()
+    await store_idempotent_response(db, scope, idempotency_key, status.HTTP_200_OK, body)
+    IDEMPOTENT_REQUESTS_TOTAL.labels(app_name=APP_NAME, endpoint=scope, result="stored").inc()
+    return body
+
+
+def set_image_url(db_product: Product, image_url: Optional[str]):
+    """
+    Sets a client-supplied image URL. A URL into the image container (such as a signed
+    URL from an earlier response) is stored as its blob name, so it does not expire.
+    """
+    blob_name = image_blob_name_for(image_url) if image_url else None
+    if blob_name != db_product.image_blob_name:
+        # Generated variants belong to the previous image
+        db_product.image_variants = None
+    db_product.image_blob_name = blob_name
+    db_product.image_url = None if blob_name else image_url
+
+
 # --- Root Endpoint ---
 @app.get("/", status_code=status.HTTP_200_OK, summary="Root endpoint")
 async def read_root():
@@ -264,25 +736,25 @@ async def health_check():
     status_code=status.HTTP_201_CREATED,
     summary="Create a new product",
 )
-async def create_product(product: ProductCreate, db: Session = Depends(get_db)):
+async def create_product(product: ProductCreate, db: AsyncSession = Depends(get_db)):
     """
     Creates a new product in the database.
     """
     logger.info(f"Product Service: Creating product: {product.name}")
     try:
         db_product = Product(**product.model_dump())
+        set_image_url(db_product, product.image_url)
         db.add(db_product)
-        db.commit()
-        db.refresh(db_product)
+        await db.commit()
+        await invalidate_cached_products()  # Cached lists may now be missing it
+        await db.refresh(db_product)
         logger.info(
             f"Product Service: Product '{db_product.name}' (ID: {db_product.product_id}) created successfully."
         )
         PRODUCT_CREATION_TOTAL.labels(app_name=APP_NAME, status="success").inc()
-        # Update stock gauge for newly created product
-        STOCK_LEVEL_GAUGE.labels(app_name=APP_NAME, product_id=db_product.product_id, product_name=db_product.name).set(db_product.stock_quantity)
         return db_product
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         logger.error(f"Product Service: Error creating product: {e}", exc_info=True)
         PRODUCT_CREATION_TOTAL.labels(app_name=APP_NAME, status="failure").inc()
         raise HTTPException(
@@ -296,47 +768,243 @@ async def create_product(product: ProductCreate, db: Session = Depends(get_db)):
     response_model=List[ProductResponse],
     summary="Retrieve a list of all products",
 )
-def list_products(
-    db: Session = Depends(get_db),
+async def list_products(
+    response: Response,
+    db: AsyncSession = Depends(get_db),
     skip: int = Query(0, ge=0),
     limit: int = Query(100, ge=1, le=100),
     search: Optional[str] = Query(None, max_length=255),
+    search_mode: SearchMode = Query(
+        SearchMode.substring,
+        description="How to match the search term: substring, prefix, fulltext or fuzzy.",
+    ),
+    cursor: Optional[str] = Query(
+        None,
+        max_length=512,
+        description=f"Opaque cursor from the {NEXT_CURSOR_HEADER} header of the previous page.",
+    ),
 ):
     """
     Lists products with optional pagination and search by name/description.
+    Prefix, fulltext and fuzzy searches are index-backed and return the best matches first.
+    Unranked listings are ordered by product_id; when a page is full, the
+    X-Next-Cursor response header holds the cursor for the next one.
     """
     logger.info(
-        f"Product Service: Listing products with skip={skip}, limit={limit}, search='{search}'"
+        f"Product Service: Listing products with skip={skip}, limit={limit}, search='{search}', search_mode={search_mode.value}, cursor={cursor}"
     )
-    query = db.query(Product)
+    query = select(Product)
+    ranked = False
     if search:
-        search_pattern = f"%{search}%"
-        logger.info(f"Product Service: Applying search filter for term: {search}")
-        query = query.filter(
-            (Product.name.ilike(search_pattern))
-            | (Product.description.ilike(search_pattern))
-        )
-    products = query.offset(skip).limit(limit).all()
-
-    # Update stock gauge for all products (could be heavy on large datasets, consider only updating on change)
-    # For now, we'll update all for consistency after a list request
-    for product in products:
-        STOCK_LEVEL_GAUGE.labels(app_name=APP_NAME, product_id=product.product_id, product_name=product.name).set(product.stock_quantity)
+        search_mode = resolve_search_mode(search_mode)
+        ranked = is_ranked(search_mode)
+        logger.info(f"Product Service: Applying {search_mode.value} search filter for term: {search}")
+        query = apply_search(query, search, search_mode)
+
+    if cursor:
+        if ranked:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Cursor pagination is not supported for ranked search modes; use skip.",
+            )
+        if skip:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="skip cannot be combined with cursor.",
+            )
+        # Keyset pagination: seek straight past the last product of the previous page
+        position = decode_cursor(cursor, product_id=int)
+        query = query.filter(Product.product_id > position["product_id"])
+    if not ranked:
+        query = query.order_by(Product.product_id)
+
+    list_cache_key = list_version = None
+    if shared_product_cache:
+        list_cache_key = hashlib.sha256(
+            json.dumps([skip, limit, search, search_mode.value, cursor]).encode()
+        ).hexdigest()
+        cached_entry, list_version = await shared_product_cache.get_list(list_cache_key)
+        if cached_entry is not None:
+            record_cache_lookup("shared", "list", "hit")
+            next_cursor, _, body = cached_entry.partition(b"\n")
+            headers = {NEXT_CURSOR_HEADER: next_cursor.decode()} if next_cursor else None
+            return Response(content=body, media_type="application/json", headers=headers)
+        record_cache_lookup("shared", "list", "miss" if list_version is not None else "unavailable")
+
+    products = (await db.execute(query.offset(skip).limit(limit))).scalars().all()
+    next_cursor = None
+    if not ranked and len(products) == limit:
+        next_cursor = encode_cursor(product_id=products[-1].product_id)
+        response.headers[NEXT_CURSOR_HEADER] = next_cursor
 
     logger.info(
         f"Product Service: Retrieved {len(products)} products (skip={skip}, limit={limit})."
     )
+    if list_cache_key:
+        body = _product_list_adapter.dump_json(
+            _product_list_adapter.validate_python(products, from_attributes=True)
+        )
+        await shared_product_cache.set_list(
+            list_cache_key, (next_cursor or "").encode() + b"\n" + body, list_version
+        )
+        headers = {NEXT_CURSOR_HEADER: next_cursor} if next_cursor else None
+        return Response(content=body, media_type="application/json", headers=headers)
     return products
 
 
+@app.post(
+    "/products/bulk",
+    response_model=BulkImportResponse,
+    summary="Import many products from streamed NDJSON or CSV",
+)
+async def bulk_import_products(request: Request, db: AsyncSession = Depends(get_db)):
+    """
+    Creates products from the request body, read as it streams in: NDJSON (one product
+    object per line) or CSV (a header row naming the product fields, then one row per
+    product). Valid rows are loaded with COPY in batches of BULK_IMPORT_BATCH_SIZE and
+    committed together; invalid rows are skipped and reported by line number.
+    Returns 415 for other content types and 400 for a CSV header it cannot use.
+    """
+    content_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+    if content_type in NDJSON_CONTENT_TYPES:
+        records = ndjson_records(request.stream())
+    elif content_type == CSV_CONTENT_TYPE:
+        records = csv_records(request.stream())
+    else:
+        raise HTTPException(
+            status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            detail=f"Send {NDJSON_CONTENT_TYPES[0]} or {CSV_CONTENT_TYPE}.",
+        )
+
+    started = time.perf_counter()
+    try:
+        result = await import_products(
+            db, records, BULK_IMPORT_BATCH_SIZE, BULK_IMPORT_MAX_REPORTED_ERRORS, image_blob_name_for
+        )
+        await db.commit()
+    except BulkFormatError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    except Exception as e:
+        await db.rollback()
+        logger.error(f"Product Service: Bulk import failed: {e}", exc_info=True)
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="An error occurred while importing products.",
+        )
+    await invalidate_cached_products()  # Cached lists may now be missing the new products
+
+    PRODUCT_BULK_IMPORT_ROWS_TOTAL.labels(app_name=APP_NAME, result="imported").inc(result.imported)
+    PRODUCT_BULK_IMPORT_ROWS_TOTAL.labels(app_name=APP_NAME, result="rejected").inc(result.rejected)
+    logger.info(
+        f"Product Service: Bulk import of {result.imported} products ({result.rejected} rows rejected) took {time.perf_counter() - started:.1f}s."
+    )
+    return result
+
+
+@app.get(
+    "/products/export",
+    summary="Stream every product as NDJSON or CSV",
+    response_class=StreamingResponse,
+)
+async def export_all_products(export_format: ExportFormat = Query(ExportFormat.ndjson, alias="format")):
+    """
+    Streams the whole catalog ordered by product_id, read through a server-side cursor
+    so it is never held in memory. The output can be imported again with POST /products/bulk.
+    """
+    logger.info(f"Product Service: Exporting products as {export_format.value}.")
+    media_type = NDJSON_CONTENT_TYPES[0] if export_format == ExportFormat.ndjson else CSV_CONTENT_TYPE
+    return StreamingResponse(
+        export_products(SessionLocal, export_format.value, BULK_EXPORT_BATCH_SIZE, sign_image_blob),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="products.{export_format.value}"'},
+    )
+
+
+# Declared before /products/{product_id} so "batch" is not taken for a product ID
+@app.get(
+    "/products/batch",
+    response_model=ProductBatchResponse,
+    summary="Retrieve several products by ID in one request",
+)
+async def get_products_batch(
+    db: AsyncSession = Depends(get_db),
+    ids: List[str] = Query(
+        ...,
+        description="Product IDs, comma-separated and/or repeated (e.g. ids=1,2&ids=3).",
+    ),
+):
+    """
+    Looks up many products with a single query. Products are returned in the order
+    their IDs were requested (duplicates once); unknown IDs are listed in missing_ids.
+    Returns 400 for a non-numeric ID or more than PRODUCT_BATCH_MAX_IDS distinct IDs.
+    """
+    try:
+        product_ids = list(
+            dict.fromkeys(int(part) for value in ids for part in value.split(",") if part.strip())
+        )
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Product IDs must be integers.",
+        )
+    if not product_ids:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="No product IDs given."
+        )
+    if len(product_ids) > PRODUCT_BATCH_MAX_IDS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"At most {PRODUCT_BATCH_MAX_IDS} product IDs can be requested at once.",
+        )
+    logger.info(f"Product Service: Fetching {len(product_ids)} products by ID: {product_ids}")
+
+    # One array parameter (= ANY(:ids)) keeps the statement text identical for any batch size
+    products = (
+        await db.execute(
+            select(Product).filter(
+                Product.product_id == any_(bindparam("ids", product_ids, type_=ARRAY(Integer)))
+            )
+        )
+    ).scalars().all()
+    products_by_id = {product.product_id: product for product in products}
+
+    missing_ids = [product_id for product_id in product_ids if product_id not in products_by_id]
+    if missing_ids:
+        logger.info(f"Product Service: Products not found in batch lookup: {missing_ids}")
+    return ProductBatchResponse(
+        products=[products_by_id[product_id] for product_id in product_ids if product_id in products_by_id],
+        missing_ids=missing_ids,
+    )
+
+
 @app.get(
     "/products/{product_id}",
     response_model=ProductResponse,
     summary="Retrieve a single product by ID",
 )
-def get_product(product_id: int, db: Session = Depends(get_db)):
+async def get_product(product_id: int, db: AsyncSession = Depends(get_db)):
+    """
+    Retrieves a product, serving it from the in-process cache when possible.
+    Writes to the product invalidate its cache entry.
+    """
     logger.info(f"Product Service: Fetching product with ID: {product_id}")
-    product = db.query(Product).filter(Product.product_id == product_id).first()
+    cached_body = product_cache.get(product_id)
+    if cached_body is not None:
+        record_cache_lookup("local", "product", "hit")
+        return Response(content=cached_body, media_type="application/json")
+    record_cache_lookup("local", "product", "miss")
+
+    cache_generation = product_cache.generation()
+    shared_version = None
+    if shared_product_cache:
+        cached_body, shared_version = await shared_product_cache.get_product(product_id)
+        if cached_body is not None:
+            record_cache_lookup("shared", "product", "hit")
+            product_cache.set(product_id, cached_body, cache_generation)
+            return Response(content=cached_body, media_type="application/json")
+        record_cache_lookup("shared", "product", "miss" if shared_version is not None else "unavailable")
+
+    product = await db.scalar(select(Product).filter(Product.product_id == product_id))
     if not product:
         logger.warning(f"Product Service: Product with ID {product_id} not found.")
         raise HTTPException(
@@ -345,9 +1013,11 @@ def get_product(product_id: int, db: Session = Depends(get_db)):
     logger.info(
         f"Product Service: Retrieved product with ID {product_id}. Name: {product.name}"
     )
-    # Update stock gauge for the retrieved product
-    STOCK_LEVEL_GAUGE.labels(app_name=APP_NAME, product_id=product.product_id, product_name=product.name).set(product.stock_quantity)
-    return product
+    body = ProductResponse.model_validate(product).model_dump_json().encode()
+    product_cache.set(product_id, body, cache_generation)
+    if shared_product_cache:
+        await shared_product_cache.set_product(product_id, body, shared_version)
+    return Response(content=body, media_type="application/json")
 
 
 @app.put(
@@ -356,12 +1026,12 @@ def get_product(product_id: int, db: Session = Depends(get_db)):
     summary="Update an existing product by ID",
 )
 async def update_product(
-    product_id: int, product: ProductUpdate, db: Session = Depends(get_db)
+    product_id: int, product: ProductUpdate, db: AsyncSession = Depends(get_db)
 ):
     logger.info(
         f"Product Service: Updating product with ID: {product_id} with data: {product.model_dump(exclude_unset=True)}"
     )
-    db_product = db.query(Product).filter(Product.product_id == product_id).first()
+    db_product = await db.scalar(select(Product).filter(Product.product_id == product_id))
     if not db_product:
         logger.warning(
             f"Product Service: Attempted to update non-existent product with ID {product_id}."
@@ -377,17 +1047,19 @@ async def update_product(
     update_data = product.model_dump(exclude_unset=True)
     for key, value in update_data.items():
         setattr(db_product, key, value)
+    if "image_url" in update_data:
+        set_image_url(db_product, update_data["image_url"])
 
     try:
         db.add(db_product)  # Mark for update
-        db.commit()
-        db.refresh(db_product)
+        await db.commit()
+        await invalidate_cached_products(product_id)
+        await db.refresh(db_product)
         logger.info(f"Product Service: Product {product_id} updated successfully.")
         PRODUCT_UPDATE_TOTAL.labels(app_name=APP_NAME, status="success").inc()
         
-        # Update stock gauge if stock quantity changed
+        # Log and check for low stock if stock quantity changed
         if db_product.stock_quantity != old_stock_quantity:
-            STOCK_LEVEL_GAUGE.labels(app_name=APP_NAME, product_id=db_product.product_id, product_name=db_product.name).set(db_product.stock_quantity)
             logger.info(f"Product Service: Stock level for {db_product.name} (ID: {db_product.product_id}) updated to {db_product.stock_quantity}.")
             # Check for low stock after update
             if db_product.stock_quantity < RESTOCK_THRESHOLD:
@@ -398,7 +1070,7 @@ async def update_product(
         
         return db_product
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         logger.error(
             f"Product Service: Error updating product {product_id}: {e}", exc_info=True
         )
@@ -414,13 +1086,13 @@ async def update_product(
     status_code=status.HTTP_204_NO_CONTENT,
     summary="Delete a product by ID",
 )
-def delete_product(product_id: int, db: Session = Depends(get_db)):
+async def delete_product(product_id: int, db: AsyncSession = Depends(get_db)):
     """
     Deletes a product record from the database.
     Does NOT delete the image from Azure Blob Storage.
     """
     logger.info(f"Product Service: Attempting to delete product with ID: {product_id}")
-    product = db.query(Product).filter(Product.product_id == product_id).first()
+    product = await db.scalar(select(Product).filter(Product.product_id == product_id))
     if not product:
         logger.warning(
             f"Product Service: Attempted to delete non-existent product with ID {product_id}."
@@ -431,17 +1103,15 @@ def delete_product(product_id: int, db: Session = Depends(get_db)):
         )
 
     try:
-        db.delete(product)
-        db.commit()
+        await db.delete(product)
+        await db.commit()
+        await invalidate_cached_products(product_id)
         logger.info(
             f"Product Service: Product {product_id} deleted successfully. Name: {product.name}"
         )
         PRODUCT_DELETION_TOTAL.labels(app_name=APP_NAME, status="success").inc()
-        # Remove product from stock gauge (set to 0 or remove if product_id is dynamic)
-        # Setting to 0 might be better to see it in Grafana
-        STOCK_LEVEL_GAUGE.labels(app_name=APP_NAME, product_id=product.product_id, product_name=product.name).set(0) # Or remove using registry.unregister if product_id is removed from system forever.
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         logger.error(
             f"Product Service: Error deleting product {product_id}: {e}", exc_info=True
         )
@@ -453,17 +1123,70 @@ def delete_product(product_id: int, db: Session = Depends(get_db)):
     return Response(status_code=status.HTTP_204_NO_CONTENT)
 
 
+async def generate_product_image_variants(product_id: int, blob_name: str):
+    """
+    Renders the WebP variants of an uploaded image in the process pool, uploads them
+    next to the original and records their URLs on the product. Skipped if the
+    product's image was replaced in the meantime. At most IMAGE_VARIANT_WORKERS jobs
+    download and render at once; the others wait for a slot without holding any image data.
+    """
+    try:
+        async with image_variant_slots:
+            started = time.perf_counter()
+            variant_blobs = await build_image_variants(
+                blob_service_client,
+                AZURE_STORAGE_CONTAINER_NAME,
+                blob_name,
+                image_variant_pool,
+                IMAGE_VARIANT_SIZES,
+                IMAGE_VARIANT_QUALITY,
+            )
+        async with SessionLocal() as db:
+            result = await db.execute(
+                update(Product)
+                .where(Product.product_id == product_id, Product.image_blob_name == blob_name)
+                .values(image_variants=variant_blobs)
+            )
+            await db.commit()
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.error(
+            f"Product Service: Generating image variants for product {product_id} from '{blob_name}' failed: {e}",
+            exc_info=True,
+        )
+        IMAGE_VARIANT_JOBS_TOTAL.labels(app_name=APP_NAME, status="failure").inc()
+        return
+
+    IMAGE_VARIANT_DURATION.labels(app_name=APP_NAME).observe(time.perf_counter() - started)
+    if result.rowcount:
+        await invalidate_cached_products(product_id)
+        logger.info(f"Product Service: Image variants {', '.join(variant_blobs)} ready for product {product_id}.")
+        IMAGE_VARIANT_JOBS_TOTAL.labels(app_name=APP_NAME, status="success").inc()
+    else:
+        logger.info(f"Product Service: Product {product_id} image changed or was deleted; variants of '{blob_name}' discarded.")
+        IMAGE_VARIANT_JOBS_TOTAL.labels(app_name=APP_NAME, status="superseded").inc()
+
+
+def schedule_image_variants(product_id: int, blob_name: str):
+    if image_variant_pool is None or image_variant_slots is None:
+        return
+    task = asyncio.create_task(generate_product_image_variants(product_id, blob_name))
+    _image_variant_tasks.add(task)
+    task.add_done_callback(_image_variant_tasks.discard)
+
+
 @app.post(
     "/products/{product_id}/upload-image",
     response_model=ProductResponse,
     summary="Upload an image for a product to Azure Blob Storage",
 )
 async def upload_product_image(
-    product_id: int, file: UploadFile = File(...), db: Session = Depends(get_db)
+    product_id: int, file: UploadFile = File(...), db: AsyncSession = Depends(get_db)
 ):
     """
-    Uploads an image file to Azure Blob Storage and updates the product's image_url in the database.
-    Generates a SAS token for the image URL with a defined expiry.
+    Uploads an image file to Azure Blob Storage and records the blob on the product.
+    Responses carry a SAS URL for it, signed when the product is read.
     Only supports image file types.
     """
     if not blob_service_client:
@@ -473,7 +1196,7 @@ async def upload_product_image(
             detail="Azure Blob Storage is not configured or available.",
         )
 
-    db_product = db.query(Product).filter(Product.product_id == product_id).first()
+    db_product = await db.scalar(select(Product).filter(Product.product_id == product_id))
     if not db_product:
         logger.warning(
             f"Product Service: Product with ID {product_id} not found for image upload."
@@ -510,40 +1233,40 @@ async def upload_product_image(
             f"Product Service: Uploading image '{file.filename}' for product {product_id} as '{blob_name}' to Azure."
         )
 
-        # Upload the file content directly
-        file_content = await file.read() # Read file content once
-        blob_client.upload_blob(
-            file_content, # Pass bytes directly
-            overwrite=True,
-            content_settings=ContentSettings(content_type=file.content_type),
-        )
-
-        # Generate Shared Access Signature (SAS) for public read access
-        sas_token = generate_blob_sas(
-            account_name=AZURE_STORAGE_ACCOUNT_NAME,
-            account_key=AZURE_STORAGE_ACCOUNT_KEY,
-            container_name=AZURE_STORAGE_CONTAINER_NAME,
-            blob_name=blob_name,
-            permission=BlobSasPermissions(read=True),
-            expiry=datetime.utcnow() + timedelta(hours=AZURE_SAS_TOKEN_EXPIRY_HOURS),
+        # Stream the file in blocks instead of reading it into memory
+        uploaded_bytes = await stream_upload_to_blob(
+            blob_client,
+            file,
+            content_type=file.content_type,
+            chunk_size=IMAGE_UPLOAD_CHUNK_BYTES,
+            max_bytes=IMAGE_UPLOAD_MAX_BYTES,
         )
-        # Construct the full URL with SAS token
-        image_url = f"{blob_client.url}?{sas_token}"
+        logger.info(f"Product Service: Uploaded {uploaded_bytes} bytes as '{blob_name}'.")
 
-        # Update the product in the database with the image URL (including SAS token)
-        db_product.image_url = image_url
+        # Store the blob name; responses carry a freshly signed URL for it.
+        # Variants of the previous image no longer apply; new ones are generated below.
+        db_product.image_blob_name = blob_name
+        db_product.image_url = None
+        db_product.image_variants = None
         db.add(db_product)
-        db.commit()
-        db.refresh(db_product)
+        await db.commit()
+        await invalidate_cached_products(product_id)
+        await db.refresh(db_product)
 
         logger.info(
-            f"Product Service: Image uploaded and product {product_id} updated with SAS URL: {image_url}"
+            f"Product Service: Image uploaded and product {product_id} updated with blob '{blob_name}'."
         )
         IMAGE_UPLOAD_TOTAL.labels(app_name=APP_NAME, product_id=product_id, status="success").inc()
+        schedule_image_variants(product_id, blob_name)
         return db_product
 
+    except HTTPException as e:
+        if e.status_code == status.HTTP_413_REQUEST_ENTITY_TOO_LARGE:
+            logger.warning(f"Product Service: Image for product {product_id} rejected: {e.detail}")
+            IMAGE_UPLOAD_TOTAL.labels(app_name=APP_NAME, product_id=product_id, status="too_large").inc()
+        raise
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         logger.error(
             f"Product Service: Error uploading image for product {product_id}: {e}",
             exc_info=True,
@@ -562,69 +1285,95 @@ async def upload_product_image(
     summary="Deduct stock quantity for a product",
 )
 async def deduct_product_stock(
-    product_id: int, request: StockDeductRequest, db: Session = Depends(get_db)
+    product_id: int,
+    request: StockDeductRequest,
+    db: AsyncSession = Depends(get_db),
+    idempotency_key: Optional[str] = Header(None, alias=IDEMPOTENCY_KEY_HEADER, min_length=1, max_length=255),
 ):
     """
     Deducts a specified quantity from a product's stock.
+    The check and the deduction happen in one conditional UPDATE, so concurrent
+    deductions can never take stock below zero.
+    With an Idempotency-Key header, a successful response is stored and returned
+    again for retries with the same key instead of deducting twice.
     Returns 404 if product not found, 400 if insufficient stock.
     """
     logger.info(
         f"Product Service: Attempting to deduct {request.quantity_to_deduct} from stock for product ID: {product_id}"
     )
-    db_product = db.query(Product).filter(Product.product_id == product_id).first()
+    stored_response = await claim_stock_request(
+        db, DEDUCT_STOCK_SCOPE, idempotency_key, product_id=product_id, quantity=request.quantity_to_deduct
+    )
+    if stored_response:
+        return stored_response
 
-    if not db_product:
-        logger.warning(
-            f"Product Service: Stock deduction failed: Product with ID {product_id} not found."
+    body = None
+    try:
+        result = await db.execute(
+            update(Product)
+            .where(
+                Product.product_id == product_id,
+                Product.stock_quantity >= request.quantity_to_deduct,
+            )
+            .values(stock_quantity=Product.stock_quantity - request.quantity_to_deduct)
+            .returning(Product)
+        )
+        db_product = result.scalars().first()
+        if db_product:
+            if idempotency_key:
+                body = await store_stock_response(db, DEDUCT_STOCK_SCOPE, idempotency_key, db_product)
+            await db.commit()
+            await invalidate_cached_products(product_id)
+    except Exception as e:
+        await db.rollback()
+        logger.error(
+            f"Product Service: Error deducting stock for product {product_id}: {e}",
+            exc_info=True,
         )
-        STOCK_DEDUCTION_TOTAL.labels(app_name=APP_NAME, product_id=product_id, status="product_not_found").inc()
+        STOCK_DEDUCTION_TOTAL.labels(app_name=APP_NAME, product_id=product_id, status="failure").inc()
         raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND, detail="Product not found"
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Could not deduct stock.",
         )
 
-    if db_product.stock_quantity < request.quantity_to_deduct:
+    if not db_product:
+        # No row matched: only now look the product up to tell a missing product from a short one
+        current = (
+            await db.execute(
+                select(Product.name, Product.stock_quantity).filter(Product.product_id == product_id)
+            )
+        ).first()
+        if not current:
+            logger.warning(
+                f"Product Service: Stock deduction failed: Product with ID {product_id} not found."
+            )
+            STOCK_DEDUCTION_TOTAL.labels(app_name=APP_NAME, product_id=product_id, status="product_not_found").inc()
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND, detail="Product not found"
+            )
         logger.warning(
-            f"Product Service: Stock deduction failed for product {product_id}. Insufficient stock: {db_product.stock_quantity} available, {request.quantity_to_deduct} requested."
+            f"Product Service: Stock deduction failed for product {product_id}. Insufficient stock: {current.stock_quantity} available, {request.quantity_to_deduct} requested."
         )
         STOCK_DEDUCTION_TOTAL.labels(app_name=APP_NAME, product_id=product_id, status="insufficient_stock").inc()
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail=f"Insufficient stock for product '{db_product.name}'. Only {db_product.stock_quantity} available.",
+            detail=f"Insufficient stock for product '{current.name}'. Only {current.stock_quantity} available.",
         )
 
-    # Perform deduction
-    db_product.stock_quantity -= request.quantity_to_deduct
-
-    try:
-        db.add(db_product)
-        db.commit()
-        db.refresh(db_product)
-        logger.info(
-            f"Product Service: Stock for product {product_id} updated to {db_product.stock_quantity}. Deducted {request.quantity_to_deduct}."
+    logger.info(
+        f"Product Service: Stock for product {product_id} updated to {db_product.stock_quantity}. Deducted {request.quantity_to_deduct}."
+    )
+    STOCK_DEDUCTION_TOTAL.labels(app_name=APP_NAME, product_id=product_id, status="success").inc()
+    # Optional: Log or trigger alert if stock falls below threshold
+    if db_product.stock_quantity < RESTOCK_THRESHOLD:
+        logger.warning(
+            f"Product Service: ALERT! Stock for product '{db_product.name}' (ID: {db_product.product_id}) is low: {db_product.stock_quantity}."
         )
-        STOCK_DEDUCTION_TOTAL.labels(app_name=APP_NAME, product_id=product_id, status="success").inc()
-        # Update stock gauge
-        STOCK_LEVEL_GAUGE.labels(app_name=APP_NAME, product_id=db_product.product_id, product_name=db_product.name).set(db_product.stock_quantity)
+        LOW_STOCK_ALERTS_TOTAL.labels(app_name=APP_NAME, product_id=db_product.product_id, product_name=db_product.name).inc()
 
-        # Optional: Log or trigger alert if stock falls below threshold
-        if db_product.stock_quantity < RESTOCK_THRESHOLD:
-            logger.warning(
-                f"Product Service: ALERT! Stock for product '{db_product.name}' (ID: {db_product.product_id}) is low: {db_product.stock_quantity}."
-            )
-            LOW_STOCK_ALERTS_TOTAL.labels(app_name=APP_NAME, product_id=db_product.product_id, product_name=db_product.name).inc()
-
-        return db_product
-    except Exception as e:
-        db.rollback()
-        logger.error(
-            f"Product Service: Error deducting stock for product {product_id}: {e}",
-            exc_info=True,
-        )
-        STOCK_DEDUCTION_TOTAL.labels(app_name=APP_NAME, product_id=product_id, status="failure").inc()
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="Could not deduct stock.",
-        )
+    if body is not None:
+        return Response(content=body, media_type="application/json")
+    return db_product
 
 
 # --- Endpoint for Adding Stock ---
@@ -634,16 +1383,50 @@ async def deduct_product_stock(
     summary="Add stock quantity for a product",
 )
 async def add_product_stock(
-    product_id: int, request: StockDeductRequest, db: Session = Depends(get_db) # Reusing StockDeductRequest for quantity
+    product_id: int,
+    request: StockDeductRequest,  # Reusing StockDeductRequest for quantity
+    db: AsyncSession = Depends(get_db),
+    idempotency_key: Optional[str] = Header(None, alias=IDEMPOTENCY_KEY_HEADER, min_length=1, max_length=255),
 ):
     """
-    Adds a specified quantity to a product's stock.
+    Adds a specified quantity to a product's stock in one atomic UPDATE.
+    With an Idempotency-Key header, retries with the same key get the stored
+    response instead of adding the stock again.
     Returns 404 if product not found.
     """
     logger.info(
         f"Product Service: Attempting to add {request.quantity_to_deduct} to stock for product ID: {product_id}"
     )
-    db_product = db.query(Product).filter(Product.product_id == product_id).first()
+    stored_response = await claim_stock_request(
+        db, ADD_STOCK_SCOPE, idempotency_key, product_id=product_id, quantity=request.quantity_to_deduct
+    )
+    if stored_response:
+        return stored_response
+
+    body = None
+    try:
+        result = await db.execute(
+            update(Product)
+            .where(Product.product_id == product_id)
+            .values(stock_quantity=Product.stock_quantity + request.quantity_to_deduct)
+            .returning(Product)
+        )
+        db_product = result.scalars().first()
+        if db_product:
+            if idempotency_key:
+                body = await store_stock_response(db, ADD_STOCK_SCOPE, idempotency_key, db_product)
+            await db.commit()
+            await invalidate_cached_products(product_id)
+    except Exception as e:
+        await db.rollback()
+        logger.error(
+            f"Product Service: Error adding stock for product {product_id}: {e}",
+            exc_info=True,
+        )
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Could not add stock.",
+        )
 
     if not db_product:
         logger.warning(
@@ -653,27 +1436,244 @@ async def add_product_stock(
             status_code=status.HTTP_404_NOT_FOUND, detail="Product not found"
         )
 
-    # Perform addition
-    db_product.stock_quantity += request.quantity_to_deduct
+    logger.info(
+        f"Product Service: Stock for product {product_id} updated to {db_product.stock_quantity}. Added {request.quantity_to_deduct}."
+    )
+    if body is not None:
+        return Response(content=body, media_type="application/json")
+    return db_product
+
 
+# --- Endpoint for Batch Stock Reservation ---
+@app.post(
+    "/products/stock/reserve",
+    response_model=List[ProductResponse],
+    summary="Deduct stock for several products in a single transaction",
+)
+async def reserve_product_stock(
+    request: StockReserveRequest,
+    db: AsyncSession = Depends(get_db),
+    idempotency_key: Optional[str] = Header(None, alias=IDEMPOTENCY_KEY_HEADER, min_length=1, max_length=255),
+):
+    """
+    Deducts stock for every requested item in one database transaction (all-or-nothing).
+    Returns each updated product once, in the order it first appears in the request.
+    With an Idempotency-Key header, a successful response is stored and returned
+    again for retries with the same key instead of reserving twice.
+    Returns 404 if any product is not found, 400 if any product has insufficient stock.
+    """
+    # Merge repeated lines for the same product so they are checked against the combined quantity
+    requested_quantities = {}
+    for item in request.items:
+        requested_quantities[item.product_id] = (
+            requested_quantities.get(item.product_id, 0) + item.quantity
+        )
+    logger.info(
+        f"Product Service: Attempting to reserve stock for products: {requested_quantities}"
+    )
+    stored_response = await claim_stock_request(
+        db, RESERVE_STOCK_SCOPE, idempotency_key, items=sorted(requested_quantities.items())
+    )
+    if stored_response:
+        return stored_response
+
+    # Lock the rows in a stable order so concurrent reservations cannot deadlock; only the
+    # columns needed to explain a rejection are read
+    current = {
+        row.product_id: row
+        for row in await db.execute(
+            select(Product.product_id, Product.name, Product.stock_quantity)
+            .filter(Product.product_id.in_(requested_quantities.keys()))
+            .order_by(Product.product_id)
+            .with_for_update()
+        )
+    }
+
+    missing_ids = [
+        product_id for product_id in requested_quantities if product_id not in current
+    ]
+    if missing_ids:
+        logger.warning(
+            f"Product Service: Stock reservation failed: Products not found: {missing_ids}."
+        )
+        for product_id in missing_ids:
+            STOCK_DEDUCTION_TOTAL.labels(app_name=APP_NAME, product_id=product_id, status="product_not_found").inc()
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Product(s) not found: {', '.join(str(product_id) for product_id in missing_ids)}.",
+        )
+
+    for product_id, quantity in requested_quantities.items():
+        row = current[product_id]
+        if row.stock_quantity < quantity:
+            logger.warning(
+                f"Product Service: Stock reservation failed for product {product_id}. Insufficient stock: {row.stock_quantity} available, {quantity} requested."
+            )
+            STOCK_DEDUCTION_TOTAL.labels(app_name=APP_NAME, product_id=product_id, status="insufficient_stock").inc()
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Insufficient stock for product '{row.name}'. Only {row.stock_quantity} available.",
+            )
+
+    # All deductions in one conditional UPDATE; RETURNING gives the updated rows for the response
+    requested = values(
+        column("product_id", Integer), column("quantity", Integer), name="requested"
+    ).data(list(requested_quantities.items()))
+    body = None
     try:
-        db.add(db_product)
-        db.commit()
-        db.refresh(db_product)
+        result = await db.execute(
+            update(Product)
+            .where(
+                Product.product_id == requested.c.product_id,
+                Product.stock_quantity >= requested.c.quantity,
+            )
+            .values(stock_quantity=Product.stock_quantity - requested.c.quantity)
+            .returning(Product)
+            .execution_options(synchronize_session=False)
+        )
+        products_by_id = {product.product_id: product for product in result.scalars()}
+        if len(products_by_id) != len(requested_quantities):
+            # Cannot happen while the rows are locked; never commit a partial reservation
+            raise RuntimeError(f"Reserved {len(products_by_id)} of {len(requested_quantities)} products")
+        products = [products_by_id[product_id] for product_id in requested_quantities]
+        if idempotency_key:
+            # Stored with the deductions, so the reservation and its replayable response commit together
+            body = await store_stock_response(db, RESERVE_STOCK_SCOPE, idempotency_key, products)
+        await db.commit()
+        await invalidate_cached_products(*requested_quantities)
+    except Exception as e:
+        await db.rollback()
+        logger.error(
+            f"Product Service: Error reserving stock for products {list(requested_quantities)}: {e}",
+            exc_info=True,
+        )
+        for product_id in requested_quantities:
+            STOCK_DEDUCTION_TOTAL.labels(app_name=APP_NAME, product_id=product_id, status="failure").inc()
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Could not reserve stock.",
+        )
+
+    for db_product in products:
         logger.info(
-            f"Product Service: Stock for product {product_id} updated to {db_product.stock_quantity}. Added {request.quantity_to_deduct}."
+            f"Product Service: Stock for product {db_product.product_id} updated to {db_product.stock_quantity}. Deducted {requested_quantities[db_product.product_id]}."
         )
-        # Update stock gauge
-        STOCK_LEVEL_GAUGE.labels(app_name=APP_NAME, product_id=db_product.product_id, product_name=db_product.name).set(db_product.stock_quantity)
+        STOCK_DEDUCTION_TOTAL.labels(app_name=APP_NAME, product_id=db_product.product_id, status="success").inc()
 
-        return db_product
+        if db_product.stock_quantity < RESTOCK_THRESHOLD:
+            logger.warning(
+                f"Product Service: ALERT! Stock for product '{db_product.name}' (ID: {db_product.product_id}) is low: {db_product.stock_quantity}."
+            )
+            LOW_STOCK_ALERTS_TOTAL.labels(app_name=APP_NAME, product_id=db_product.product_id, product_name=db_product.name).inc()
+
+    if body is not None:
+        return Response(content=body, media_type="application/json")
+    return products
+
+
+# --- Endpoint for Idempotent Batch Stock Release ---
+@app.post(
+    "/products/stock/release",
+    response_model=StockReleaseResponse,
+    summary="Add stock back for several products, at most once per idempotency key",
+)
+async def release_product_stock(
+    request: StockReleaseRequest, db: AsyncSession = Depends(get_db)
+):
+    """
+    Adds stock back for every item in one database transaction. An item whose
+    idempotency key was applied before is skipped, so callers can retry a delivery
+    safely. Items for products that no longer exist are reported as missing.
+    """
+    # A key repeated within one request counts once
+    items_by_key = {}
+    for item in request.items:
+        items_by_key.setdefault(item.idempotency_key, item)
+    product_ids = sorted({item.product_id for item in items_by_key.values()})
+    logger.info(
+        f"Product Service: Attempting to release stock for {len(items_by_key)} adjustments on products: {product_ids}"
+    )
+
+    try:
+        # Lock the rows in a stable order so concurrent releases and reservations cannot deadlock
+        existing_ids = set(
+            (
+                await db.execute(
+                    select(Product.product_id)
+                    .filter(Product.product_id.in_(product_ids))
+                    .order_by(Product.product_id)
+                    .with_for_update()
+                )
+            ).scalars()
+        )
+        candidates = [item for item in items_by_key.values() if item.product_id in existing_ids]
+        applied_keys = set()
+        if candidates:
+            expires_at = func.now() + timedelta(seconds=STOCK_ADJUSTMENT_TTL_SECONDS)
+            # Recording the key and applying the adjustment commit together; a key that is
+            # already recorded (or being recorded by a concurrent request) is not inserted
+            applied_keys = set(
+                (
+                    await db.execute(
+                        pg_insert(StockAdjustment)
+                        .values(
+                            [
+                                {
+                                    "idempotency_key": item.idempotency_key,
+                                    "product_id": item.product_id,
+                                    "quantity": item.quantity,
+                                    "expires_at": expires_at,
+                                }
+                                for item in candidates
+                            ]
+                        )
+                        .on_conflict_do_nothing(index_elements=[StockAdjustment.idempotency_key])
+                        .returning(StockAdjustment.idempotency_key)
+                    )
+                ).scalars()
+            )
+
+        quantities = {}
+        for item in candidates:
+            if item.idempotency_key in applied_keys:
+                quantities[item.product_id] = quantities.get(item.product_id, 0) + item.quantity
+        for product_id, quantity in quantities.items():
+            await db.execute(
+                update(Product)
+                .where(Product.product_id == product_id)
+                .values(stock_quantity=Product.stock_quantity + quantity)
+            )
+        await db.commit()
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         logger.error(
-            f"Product Service: Error adding stock for product {product_id}: {e}",
+            f"Product Service: Error releasing stock for products {product_ids}: {e}",
             exc_info=True,
         )
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="Could not add stock.",
-        )
\ No newline at end of file
+            detail="Could not release stock.",
+        )
+
+    if quantities:
+        await invalidate_cached_products(*quantities)
+    response = StockReleaseResponse(
+        applied=[key for key in items_by_key if key in applied_keys],
+        duplicates=[
+            item.idempotency_key for item in candidates if item.idempotency_key not in applied_keys
+        ],
+        missing=[
+            key for key, item in items_by_key.items() if item.product_id not in existing_ids
+        ],
+    )
+    for result, keys in (("applied", response.applied), ("duplicate", response.duplicates), ("missing", response.missing)):
+        if keys:
+            STOCK_RELEASE_TOTAL.labels(app_name=APP_NAME, result=result).inc(len(keys))
+    if response.missing:
+        logger.warning(
+            f"Product Service: Stock release skipped for missing products; keys: {response.missing}"
+        )
+    logger.info(
+        f"Product Service: Stock released for products {sorted(quantities)} ({len(response.applied)} applied, {len(response.duplicates)} duplicates)."
+    )
+    return response
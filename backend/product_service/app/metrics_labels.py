@@ -0,0 +1,42 @@
+# week09/example-2/backend/product_service/app/metrics_labels.py
+
+from fastapi import Request
+from starlette.routing import Match
+
+# Label values used when a request cannot be tied to a known, bounded endpoint
+UNMATCHED_ENDPOINT = "__unmatched__"
+OTHER_ENDPOINT = "__other__"
+
+
+def route_template(request: Request) -> str:
+    """
+    Returns the path template of the route serving the request (e.g. /products/{product_id}),
+    so metrics get one series per route instead of one per concrete URL.
+    """
+    partial_match = None
+    for route in request.app.router.routes:
+        match, _ = route.matches(request.scope)
+        if match == Match.FULL:
+            return route.path
+        if match == Match.PARTIAL and partial_match is None:
+            partial_match = route.path  # Path matched, method did not (405)
+    return partial_match or UNMATCHED_ENDPOINT
+
+
+class LabelGuard:
+    """
+    Caps the number of distinct values a metric label may take. Values seen before
+    the cap is reached pass through; any new value after that collapses to OTHER_ENDPOINT.
+    """
+
+    def __init__(self, max_values: int):
+        self.max_values = max_values
+        self._seen = set()
+
+    def __call__(self, value: str) -> str:
+        if value in self._seen:
+            return value
+        if len(self._seen) >= self.max_values:
+            return OTHER_ENDPOINT
+        self._seen.add(value)
+        return value
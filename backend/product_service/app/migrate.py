@@ -0,0 +1,43 @@
+# week09/example-2/backend/product_service/app/migrate.py
+
+import os
+from typing import Optional
+
+from alembic import command
+from alembic.config import Config
+
+from .search import TRIGRAM_INDEXES
+
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Advisory lock key held (for the transaction) while migrating the schema
+SCHEMA_SETUP_LOCK_ID = 902001
+
+
+def alembic_config(connection=None, image_container_url: Optional[str] = None) -> Config:
+    """
+    The service's alembic.ini, usable from any working directory. image_container_url is
+    the product image container, needed to convert image URLs stored by earlier versions.
+    """
+    config = Config(os.path.join(SERVICE_DIR, "alembic.ini"))
+    config.set_main_option("script_location", os.path.join(SERVICE_DIR, "migrations"))
+    if connection is not None:
+        config.attributes["connection"] = connection
+    if image_container_url is not None:
+        config.attributes["image_container_url"] = image_container_url
+    return config
+
+
+def upgrade_schema(connection, revision: str = "head", image_container_url: Optional[str] = None):
+    """
+    Applies the pending migrations on a sync connection (AsyncConnection.run_sync), in
+    that connection's transaction; the caller commits.
+    """
+    command.upgrade(alembic_config(connection, image_container_url), revision)
+
+
+def include_object(object, name, type_, reflected, compare_to) -> bool:
+    """
+    Leaves the trigram indexes out of autogenerate: they are created by a migration only
+    when pg_trgm is available, so the models do not declare them.
+    """
+    return not (type_ == "index" and compare_to is None and name in TRIGRAM_INDEXES.values())
@@ -1,10 +1,14 @@
 # week09/example-2/backend/product_service/app/models.py
 
-from sqlalchemy import Column, DateTime, Integer, Numeric, String, Text
+from sqlalchemy import Column, Computed, DateTime, Index, Integer, Numeric, String, Text
+from sqlalchemy.dialects.postgresql import JSONB, TSVECTOR
 from sqlalchemy.sql import func
 
 from .db import Base
 
+# Text search configuration used to build Product.search_vector and to parse search queries
+SEARCH_CONFIG = "english"
+
 
 class Product(Base):
     # Name of the database table
@@ -14,10 +18,67 @@ class Product(Base):
     description = Column(Text, nullable=True)
     price = Column(Numeric(10, 2), nullable=False)
     stock_quantity = Column(Integer, nullable=False, default=0)
-    image_url = Column(String(2048), nullable=True)  # URL can be long
+    image_url = Column(String(2048), nullable=True)  # External image URL; None for uploaded images
+    # Uploaded image in the product image container. Responses carry a signed URL
+    # for it, generated when read, so stored references never expire.
+    image_blob_name = Column(String(1024), nullable=True)
+    # Resized WebP renditions of the uploaded image, variant name -> blob name; filled in the background
+    image_variants = Column(JSONB, nullable=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
+    # Full-text search document kept up to date by PostgreSQL on every insert/update.
+    # Name matches are weighted above description matches when ranking results.
+    search_vector = Column(
+        TSVECTOR,
+        Computed(
+            f"setweight(to_tsvector('{SEARCH_CONFIG}', coalesce(name, '')), 'A') || "
+            f"setweight(to_tsvector('{SEARCH_CONFIG}', coalesce(description, '')), 'B')",
+            persisted=True,
+        ),
+    )
+
+    __table_args__ = (
+        Index(
+            "ix_products_week09_example_02_search_vector",
+            search_vector,
+            postgresql_using="gin",
+        ),
+    )
 
     def __repr__(self):
         # A helpful representation when debugging
-        return f"<Product(id={self.product_id}, name='{self.name}', stock={self.stock_quantity}, image_url='{self.image_url[:30] if self.image_url else 'None'}...')>"
+        return f"<Product(id={self.product_id}, name='{self.name}', stock={self.stock_quantity}, image_url='{self.image_url[:30] if self.image_url else self.image_blob_name}...')>"
+
+
+class StockAdjustment(Base):
+    # One row per applied stock release, keyed by the caller's idempotency key, so a
+    # retried delivery of the same adjustment is recognised and not applied twice.
+    # Rows are purged once expired, long after the caller has stopped retrying.
+    __tablename__ = "stock_adjustments_week09_example_02"
+    idempotency_key = Column(String(100), primary_key=True)
+    product_id = Column(Integer, nullable=False, index=True)
+    quantity = Column(Integer, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    expires_at = Column(DateTime(timezone=True), nullable=False, index=True)
+
+    def __repr__(self):
+        return f"<StockAdjustment(key='{self.idempotency_key}', product_id={self.product_id}, qty={self.quantity})>"
+
+
+class IdempotencyKey(Base):
+    # Completed responses of requests sent with an Idempotency-Key header, so a client
+    # retry is answered from here instead of being run again. The row is inserted
+    # before the request does its work and commits with it, which also makes a
+    # concurrent retry with the same key wait for the first attempt's outcome.
+    __tablename__ = "idempotency_keys_week09_example_02"
+
+    scope = Column(String(100), primary_key=True)  # Route template, e.g. POST /orders/
+    idempotency_key = Column(String(255), primary_key=True)
+    request_hash = Column(String(64), nullable=False)  # SHA-256 of the request parameters
+    status_code = Column(Integer, nullable=True)  # Set when the response is stored
+    response_body = Column(Text, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    expires_at = Column(DateTime(timezone=True), nullable=False, index=True)
+
+    def __repr__(self):
+        return f"<IdempotencyKey(scope='{self.scope}', key='{self.idempotency_key}', status={self.status_code})>"
@@ -1,8 +1,24 @@
 # week09/example-2/backend/product_service/app/schemas.py
 
 from datetime import datetime
-from typing import Optional
-from pydantic import BaseModel, ConfigDict, Field
+from enum import Enum
+from typing import Callable, Dict, List, Optional
+from pydantic import BaseModel, ConfigDict, Field, model_validator
+
+# Turns a stored blob name into a URL clients can fetch, or None if storage is not configured; set by main
+_blob_url_signer: Optional[Callable[[str], Optional[str]]] = None
+
+
+def set_blob_url_signer(signer: Optional[Callable[[str], Optional[str]]]):
+    global _blob_url_signer
+    _blob_url_signer = signer
+
+
+class SearchMode(str, Enum):
+    substring = "substring"  # case-insensitive substring match on name/description (ILIKE)
+    prefix = "prefix"  # every search word matches the start of a word, ranked
+    fulltext = "fulltext"  # web-style full-text query (quotes, OR, -exclusion), ranked
+    fuzzy = "fuzzy"  # trigram similarity, tolerant of typos, ranked (requires pg_trgm)
 
 
 class ProductBase(BaseModel):
@@ -30,13 +46,99 @@ class ProductUpdate(ProductBase):
 
 class ProductResponse(ProductBase):
     product_id: int
+    image_variants: Optional[Dict[str, str]] = Field(
+        None,
+        description="Resized WebP versions of the uploaded image by variant name (e.g. thumbnail), once generated.",
+    )
+    # Read from the model to sign the image URLs; not part of the response
+    image_blob_name: Optional[str] = Field(None, exclude=True)
     created_at: datetime
     updated_at: Optional[datetime] = None
 
     model_config = ConfigDict(from_attributes=True)
 
+    @model_validator(mode="after")
+    def _sign_image_urls(self):
+        # Uploaded images are stored as blob names; variants are only kept for those
+        if not self.image_blob_name:
+            return self
+        self.image_url = _blob_url_signer(self.image_blob_name) if _blob_url_signer else None
+        if self.image_url is None:
+            self.image_variants = None
+        elif self.image_variants:
+            self.image_variants = {name: _blob_url_signer(blob) for name, blob in self.image_variants.items()}
+        return self
+
+
+class ExportFormat(str, Enum):
+    ndjson = "ndjson"  # one JSON object per line (application/x-ndjson)
+    csv = "csv"  # header row, then one row per product (text/csv)
+
+
+class BulkImportError(BaseModel):
+    line: int = Field(..., description="Line of the upload where the rejected row starts (1-based).")
+    error: str
+
+
+class BulkImportResponse(BaseModel):
+    imported: int = Field(..., description="Products created.")
+    rejected: int = Field(..., description="Rows skipped because they were invalid.")
+    errors: List[BulkImportError] = Field(..., description="Why rows were rejected, in upload order.")
+    errors_truncated: bool = Field(
+        False, description="True if more rows were rejected than are listed in errors."
+    )
+
+
+class ProductBatchResponse(BaseModel):
+    products: List[ProductResponse] = Field(
+        ..., description="Found products, in the order their IDs were requested."
+    )
+    missing_ids: List[int] = Field(
+        ..., description="Requested IDs with no matching product, in request order."
+    )
+
 
 class StockDeductRequest(BaseModel):
     quantity_to_deduct: int = Field(
         ..., gt=0, description="Quantity of product to deduct from stock."
     )
+
+
+class StockReserveItem(BaseModel):
+    product_id: int = Field(..., ge=1, description="ID of the product to reserve.")
+    quantity: int = Field(
+        ..., gt=0, description="Quantity of product to deduct from stock."
+    )
+
+
+class StockReserveRequest(BaseModel):
+    items: List[StockReserveItem] = Field(
+        ...,
+        min_length=1,
+        description="Items to deduct from stock together in a single transaction.",
+    )
+
+
+class StockReleaseItem(BaseModel):
+    idempotency_key: str = Field(
+        ...,
+        min_length=1,
+        max_length=100,
+        description="Caller-chosen key; an item whose key was already applied is skipped.",
+    )
+    product_id: int = Field(..., ge=1, description="ID of the product to restock.")
+    quantity: int = Field(..., gt=0, description="Quantity of product to add back to stock.")
+
+
+class StockReleaseRequest(BaseModel):
+    items: List[StockReleaseItem] = Field(
+        ...,
+        min_length=1,
+        description="Stock adjustments to apply together in a single transaction.",
+    )
+
+
+class StockReleaseResponse(BaseModel):
+    applied: List[str] = Field(..., description="Keys applied by this request.")
+    duplicates: List[str] = Field(..., description="Keys applied by an earlier request and skipped.")
+    missing: List[str] = Field(..., description="Keys whose product does not exist; nothing was applied.")
@@ -0,0 +1,104 @@
+# week09/example-2/backend/product_service/app/search.py
+
+import logging
+import re
+
+from sqlalchemy import false, func, literal, literal_column, text
+
+from .models import SEARCH_CONFIG, Product
+from .schemas import SearchMode
+
+logger = logging.getLogger(__name__)
+
+PRODUCTS_TABLE = Product.__tablename__
+TRIGRAM_INDEXED_COLUMNS = ("name", "description")
+# Created by migration 0003 when pg_trgm is available; gin_trgm_ops serves similarity (%)
+# operators and ILIKE '%term%' alike
+TRIGRAM_INDEXES = {column: f"ix_{PRODUCTS_TABLE}_{column}_trgm" for column in TRIGRAM_INDEXED_COLUMNS}
+
+# Set at startup once the pg_trgm extension and indexes are confirmed to exist
+_trigram_available = False
+
+
+def trigram_search_available() -> bool:
+    return _trigram_available
+
+
+async def check_trigram_indexes(conn) -> bool:
+    """
+    Enables fuzzy search if the trigram indexes exist. Migration 0003 creates them along
+    with the pg_trgm extension; returns False if it could not, as pg_trgm was not available.
+    """
+    global _trigram_available
+
+    found = await conn.scalar(
+        text("SELECT count(*) FROM pg_indexes WHERE tablename = :table AND indexname = ANY(:names)"),
+        {"table": PRODUCTS_TABLE, "names": list(TRIGRAM_INDEXES.values())},
+    )
+    _trigram_available = found == len(TRIGRAM_INDEXES)
+    if not _trigram_available:
+        logger.warning(
+            "Product Service: Trigram indexes are missing (pg_trgm not available), fuzzy search will fall back to substring matching."
+        )
+    return _trigram_available
+
+
+def _prefix_tsquery(term: str):
+    words = re.findall(r"\w+", term)
+    if not words:
+        return None
+    return func.to_tsquery(
+        literal_column(f"'{SEARCH_CONFIG}'::regconfig"),
+        " & ".join(f"{word}:*" for word in words),
+    )
+
+
+def resolve_search_mode(mode: SearchMode) -> SearchMode:
+    """
+    Returns the mode that will actually be used, falling back from fuzzy to substring
+    when pg_trgm is unavailable.
+    """
+    if mode == SearchMode.fuzzy and not _trigram_available:
+        logger.warning(
+            "Product Service: Fuzzy search requested but pg_trgm is unavailable; using substring search."
+        )
+        return SearchMode.substring
+    return mode
+
+
+def is_ranked(mode: SearchMode) -> bool:
+    return mode != SearchMode.substring
+
+
+def apply_search(query, term: str, mode: SearchMode):
+    """
+    Filters a select(Product) by a search term using a mode from resolve_search_mode.
+    Ranked modes also order the results by relevance, best match first, with
+    product_id as a stable tie-breaker.
+    """
+    if mode == SearchMode.substring:
+        search_pattern = f"%{term}%"
+        return query.filter(
+            (Product.name.ilike(search_pattern))
+            | (Product.description.ilike(search_pattern))
+        )
+
+    if mode == SearchMode.fuzzy:
+        condition = Product.name.op("%")(term) | literal(term).op("<%")(Product.description)
+        rank = func.greatest(
+            func.similarity(Product.name, term),
+            func.word_similarity(term, Product.description),
+        )
+    else:
+        if mode == SearchMode.prefix:
+            tsquery = _prefix_tsquery(term)
+            if tsquery is None:
+                return query.filter(false())  # Nothing searchable in the term
+        else:
+            tsquery = func.websearch_to_tsquery(
+                literal_column(f"'{SEARCH_CONFIG}'::regconfig"), term
+            )
+        condition = Product.search_vector.op("@@")(tsquery)
+        rank = func.ts_rank_cd(Product.search_vector, tsquery)
+
+    return query.filter(condition).order_by(rank.desc(), Product.product_id)
@@ -0,0 +1,155 @@
+# week09/example-2/backend/product_service/app/shared_cache.py
+
+import asyncio
+import logging
+import time
+from typing import Callable, Iterable, Optional, Tuple
+
+from redis.exceptions import RedisError
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = "product_service"
+INVALIDATION_CHANNEL = f"{KEY_PREFIX}:invalidations"
+LIST_VERSION_KEY = f"{KEY_PREFIX}:products:version"
+
+# Errors that mean "the cache is unavailable"; callers then fall back to the database
+CACHE_ERRORS = (RedisError, OSError, asyncio.TimeoutError)
+
+
+def _product_key(product_id: int) -> str:
+    return f"{KEY_PREFIX}:product:{product_id}"
+
+
+def _product_version_key(product_id: int) -> str:
+    return f"{KEY_PREFIX}:product:{product_id}:version"
+
+
+def _list_key(query_key: str) -> str:
+    return f"{KEY_PREFIX}:products:list:{query_key}"
+
+
+class SharedProductCache:
+    """
+    Product response cache shared by every replica through a Redis-protocol server.
+
+    Entries are stored as "<version>\\n<body>". Writers bump the version (per product
+    for detail bodies, one version for all list bodies) and publish the product IDs on
+    INVALIDATION_CHANNEL so replicas can drop their in-process copies. A lookup fetches
+    the entry and the current version in one round trip and ignores entries written
+    under an older version, so a read that raced with a write is never served.
+
+    Any cache error is logged and treated as a miss; after an error the cache is
+    skipped for retry_after_seconds so requests do not keep waiting on a dead server.
+    """
+
+    def __init__(
+        self,
+        client,
+        ttl_seconds: float,
+        retry_after_seconds: float = 5.0,
+        on_operation: Optional[Callable[[str, str, float], None]] = None,
+    ):
+        self.client = client
+        self.ttl_seconds = ttl_seconds
+        self.retry_after_seconds = retry_after_seconds
+        self._on_operation = on_operation
+        self._unavailable_until = 0.0
+
+    @property
+    def available(self) -> bool:
+        return time.monotonic() >= self._unavailable_until
+
+    async def get_product(self, product_id: int) -> Tuple[Optional[bytes], Optional[bytes]]:
+        """Returns (body or None, version to pass to set_product)."""
+        return await self._get(_product_key(product_id), _product_version_key(product_id), "get_product")
+
+    async def set_product(self, product_id: int, body: bytes, version: Optional[bytes]):
+        await self._set(_product_key(product_id), body, version, "set_product")
+
+    async def get_list(self, query_key: str) -> Tuple[Optional[bytes], Optional[bytes]]:
+        return await self._get(_list_key(query_key), LIST_VERSION_KEY, "get_list")
+
+    async def set_list(self, query_key: str, body: bytes, version: Optional[bytes]):
+        await self._set(_list_key(query_key), body, version, "set_list")
+
+    async def invalidate(self, product_ids: Iterable[int]):
+        """Bumps the versions of the given products and of every list, then notifies replicas."""
+        product_ids = list(product_ids)
+
+        async def run():
+            async with self.client.pipeline(transaction=False) as pipe:
+                for product_id in product_ids:
+                    pipe.incr(_product_version_key(product_id))
+                    pipe.delete(_product_key(product_id))
+                pipe.incr(LIST_VERSION_KEY)
+                if product_ids:
+                    pipe.publish(INVALIDATION_CHANNEL, ",".join(str(p) for p in product_ids))
+                await pipe.execute()
+
+        # Invalidation is attempted even while lookups are being skipped
+        await self._run("invalidate", run, force=True)
+
+    async def listen_for_invalidations(self, on_invalidate: Callable[[int], None]):
+        """
+        Calls on_invalidate(product_id) for every product invalidated by any replica.
+        Runs until cancelled, resubscribing after connection errors.
+        """
+        while True:
+            try:
+                async with self.client.pubsub() as pubsub:
+                    await pubsub.subscribe(INVALIDATION_CHANNEL)
+                    async for message in pubsub.listen():
+                        if message.get("type") != "message":
+                            continue
+                        for product_id in message["data"].split(b","):
+                            on_invalidate(int(product_id))
+            except CACHE_ERRORS as e:
+                logger.warning(
+                    f"Product Service: Cache invalidation subscription failed, retrying in {self.retry_after_seconds}s. Error: {e}"
+                )
+                await asyncio.sleep(self.retry_after_seconds)
+
+    async def close(self):
+        await self.client.aclose()
+
+    async def _get(self, key: str, version_key: str, operation: str):
+        values = await self._run(operation, lambda: self.client.mget(key, version_key))
+        if values is None:
+            return None, None
+        entry, version = values
+        version = version or b"0"
+        if entry is None:
+            return None, version
+        entry_version, _, body = entry.partition(b"\n")
+        if entry_version != version:
+            return None, version
+        return body, version
+
+    async def _set(self, key: str, body: bytes, version: Optional[bytes], operation: str):
+        if version is None:  # The lookup failed; don't write blind
+            return
+        await self._run(
+            operation,
+            lambda: self.client.set(key, version + b"\n" + body, ex=int(self.ttl_seconds)),
+        )
+
+    async def _run(self, operation: str, call, force: bool = False):
+        if not force and not self.available:
+            return None
+        started = time.perf_counter()
+        try:
+            result = await call()
+        except CACHE_ERRORS as e:
+            self._unavailable_until = time.monotonic() + self.retry_after_seconds
+            self._observe(operation, "error", started)
+            logger.warning(
+                f"Product Service: Shared cache {operation} failed, falling back to the database for {self.retry_after_seconds}s. Error: {e}"
+            )
+            return None
+        self._observe(operation, "success", started)
+        return result
+
+    def _observe(self, operation: str, result: str, started: float):
+        if self._on_operation:
+            self._on_operation(operation, result, time.perf_counter() - started)
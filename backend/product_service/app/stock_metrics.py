@@ -0,0 +1,95 @@
+# week09/example-2/backend/product_service/app/stock_metrics.py
+
+import logging
+import time
+
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.registry import Collector
+from sqlalchemy import func, select
+
+from .models import Product
+
+logger = logging.getLogger(__name__)
+
+
+class StockCollector(Collector):
+    """
+    Exposes stock metrics computed from the database instead of per-product gauges
+    that request handlers keep up to date.
+
+    collect() runs synchronously inside generate_latest, so it only reads a snapshot.
+    The /metrics endpoint calls refresh() first, which re-queries the database when the
+    snapshot is older than max_staleness_seconds: one aggregate query over the catalog
+    plus, if low_stock_limit > 0, the low_stock_limit products with the least stock
+    below the threshold, which keep a per-product series.
+    """
+
+    def __init__(
+        self,
+        app_name: str,
+        threshold: int,
+        low_stock_limit: int,
+        max_staleness_seconds: float,
+    ):
+        self.app_name = app_name
+        self.threshold = threshold
+        self.low_stock_limit = low_stock_limit
+        self.max_staleness_seconds = max_staleness_seconds
+        self._snapshot = None
+        self._refreshed_at = None
+
+    async def refresh(self, db, force: bool = False):
+        if (
+            not force
+            and self._refreshed_at is not None
+            and time.monotonic() - self._refreshed_at < self.max_staleness_seconds
+        ):
+            return
+        totals = (
+            await db.execute(
+                select(
+                    func.count(),
+                    func.coalesce(func.sum(Product.stock_quantity), 0),
+                    func.count().filter(Product.stock_quantity == 0),
+                    func.count().filter(Product.stock_quantity < self.threshold),
+                )
+            )
+        ).one()
+        low_stock = []
+        if self.low_stock_limit > 0:
+            low_stock = (
+                await db.execute(
+                    select(Product.product_id, Product.name, Product.stock_quantity)
+                    .filter(Product.stock_quantity < self.threshold)
+                    .order_by(Product.stock_quantity, Product.product_id)
+                    .limit(self.low_stock_limit)
+                )
+            ).all()
+        self._snapshot = (totals, low_stock)
+        self._refreshed_at = time.monotonic()
+
+    def collect(self):
+        if self._snapshot is None:
+            return
+        (products, units, out_of_stock, low_stock_count), low_stock = self._snapshot
+        labels = [self.app_name]
+
+        for name, documentation, value in (
+            ("product_catalog_products", "Number of products in the catalog", products),
+            ("product_stock_units", "Total units in stock across all products", units),
+            ("product_out_of_stock_products", "Number of products with no stock", out_of_stock),
+            ("product_low_stock_products", f"Number of products with fewer than {self.threshold} units", low_stock_count),
+            ("product_stock_metrics_age_seconds", "Seconds since the stock metrics were read from the database", time.monotonic() - self._refreshed_at),
+        ):
+            family = GaugeMetricFamily(name, documentation, labels=["app_name"])
+            family.add_metric(labels, value)
+            yield family
+
+        stock_levels = GaugeMetricFamily(
+            "product_stock_quantity",
+            f"Current stock quantity of the {self.low_stock_limit} products with the least stock below {self.threshold} units",
+            labels=["app_name", "product_id", "product_name"],
+        )
+        for product_id, product_name, stock_quantity in low_stock:
+            stock_levels.add_metric([self.app_name, str(product_id), product_name], stock_quantity)
+        yield stock_levels
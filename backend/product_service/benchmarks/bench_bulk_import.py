@@ -0,0 +1,108 @@
+# backend/product_service/benchmarks/bench_bulk_import.py
+"""
+Bulk import and export throughput: POST /products/bulk and GET /products/export.
+
+Streams --rows generated products to the import endpoint in each format, then streams
+the whole catalog back out, and reports rows per second for each step along with the
+peak memory of this process. Imports go through the app in-process (httpx
+ASGITransport), so generating the upload and parsing it share one core. httpx's ASGI
+transport buffers whole response bodies, so the export is read from the generator that
+GET /products/export streams. Imported products are deleted afterwards.
+
+Run from backend/product_service against the service database, e.g.:
+    python -m benchmarks.bench_bulk_import --rows 1000000
+    python -m benchmarks.bench_bulk_import --rows 200000 --formats csv
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import resource
+import time
+
+import httpx
+from sqlalchemy import delete
+
+from app.db import SessionLocal, engine
+from app.bulk import export_products
+from app.main import BULK_EXPORT_BATCH_SIZE, app, sign_image_blob
+from app.migrate import upgrade_schema
+from app.models import Product
+
+BENCH_PREFIX = "bench-bulk-"
+LINES_PER_CHUNK = 1000
+
+
+async def generate(rows: int, import_format: str):
+    if import_format == "csv":
+        yield b"name,description,price,stock_quantity\n"
+    for start in range(0, rows, LINES_PER_CHUNK):
+        lines = []
+        for i in range(start, min(start + LINES_PER_CHUNK, rows)):
+            name = f"{BENCH_PREFIX}{import_format}-{i}"
+            description = f"Generated product {i} for the bulk import benchmark"
+            price, stock = f"{1 + i % 500}.99", i % 1000
+            if import_format == "csv":
+                lines.append(f"{name},{description},{price},{stock}\n")
+            else:
+                lines.append(
+                    json.dumps({"name": name, "description": description, "price": float(price), "stock_quantity": stock})
+                    + "\n"
+                )
+        yield "".join(lines).encode()
+
+
+def peak_memory_mib() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1_000_000, help="Products per import")
+    parser.add_argument("--formats", default="ndjson,csv", help="Comma-separated: ndjson, csv")
+    args = parser.parse_args()
+
+    logging.getLogger("app.main").setLevel(logging.ERROR)
+    async with engine.begin() as conn:
+        await conn.run_sync(upgrade_schema)
+
+    content_types = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+    transport = httpx.ASGITransport(app=app)
+    try:
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            for import_format in args.formats.split(","):
+                started = time.perf_counter()
+                response = await client.post(
+                    "/products/bulk",
+                    content=generate(args.rows, import_format),
+                    headers={"Content-Type": content_types[import_format]},
+                )
+                response.raise_for_status()
+                elapsed = time.perf_counter() - started
+                result = response.json()
+                print(
+                    f"import {import_format:>6}: {result['imported']} rows in {elapsed:6.1f}s "
+                    f"({result['imported'] / elapsed:9.0f} rows/s, {result['rejected']} rejected)  "
+                    f"peak memory {peak_memory_mib():.0f} MiB"
+                )
+
+            for export_format in ("ndjson", "csv"):
+                started = time.perf_counter()
+                exported = 0
+                async for chunk in export_products(SessionLocal, export_format, BULK_EXPORT_BATCH_SIZE, sign_image_blob):
+                    exported += chunk.count(b"\n")
+                elapsed = time.perf_counter() - started
+                print(
+                    f"export {export_format:>6}: {exported} lines in {elapsed:6.1f}s "
+                    f"({exported / elapsed:9.0f} rows/s)  peak memory {peak_memory_mib():.0f} MiB"
+                )
+    finally:
+        async with SessionLocal() as db:
+            await db.execute(delete(Product).where(Product.name.startswith(BENCH_PREFIX)))
+            await db.commit()
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
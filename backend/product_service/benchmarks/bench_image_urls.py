@@ -0,0 +1,109 @@
+# backend/product_service/benchmarks/bench_image_urls.py
+"""
+list_products with signed image URLs: cached vs uncached SAS signing.
+
+Seeds --page-size products, each with an uploaded image and three variant blobs, then
+renders a page of all of them (list_products plus ProductResponse serialization, as
+FastAPI does) --requests times per mode and reports requests per second, p50/p99
+latency and SAS signatures computed per request. "uncached" signs every URL on every
+request (the cache is disabled); "cached" reuses each URL until its refresh time.
+
+Run from backend/product_service (needs the database, as for the tests):
+    python -m benchmarks.bench_image_urls --requests 500
+"""
+
+import argparse
+import asyncio
+import base64
+import logging
+import os
+import statistics
+import time
+from unittest.mock import patch
+
+from fastapi import Response
+from sqlalchemy import delete
+
+import app.blob_storage as blob_storage
+import app.main as main_module
+from app.blob_storage import BlobUrlSigner
+from app.db import SessionLocal, engine
+from app.main import _product_list_adapter, list_products
+from app.migrate import upgrade_schema
+from app.models import Product
+from app.schemas import SearchMode
+
+BENCH_PREFIX = "bench-image-urls-"
+VARIANTS = ("thumbnail", "small", "medium")
+
+
+def make_signer(max_entries: int) -> BlobUrlSigner:
+    return BlobUrlSigner(
+        "https://benchaccount.blob.core.windows.net",
+        "benchaccount",
+        base64.b64encode(os.urandom(64)).decode(),
+        "product-images",
+        expiry_seconds=24 * 3600,
+        refresh_before_expiry_seconds=3600,
+        max_entries=max_entries,
+    )
+
+
+async def time_mode(mode: str, signer: BlobUrlSigner, args):
+    main_module.blob_url_signer = signer
+    latencies = []
+    with patch.object(blob_storage, "generate_blob_sas", wraps=blob_storage.generate_blob_sas) as sign:
+        async with SessionLocal() as db:
+            for _ in range(args.requests):
+                started = time.perf_counter()
+                products = await list_products(
+                    Response(), db, skip=0, limit=args.page_size, search=BENCH_PREFIX,
+                    search_mode=SearchMode.substring, cursor=None,
+                )
+                body = _product_list_adapter.dump_json(
+                    _product_list_adapter.validate_python(products, from_attributes=True)
+                )
+                latencies.append((time.perf_counter() - started) * 1000)
+    assert body.count(b"sig=") == args.page_size * (1 + len(VARIANTS)), "every image URL should be signed"
+    percentiles = statistics.quantiles(latencies, n=100)
+    print(
+        f"{mode:>8}: {1000 * len(latencies) / sum(latencies):7.0f} req/s  p50={percentiles[49]:7.2f} ms  "
+        f"p99={percentiles[98]:7.2f} ms  signatures/request={sign.call_count / args.requests:6.1f}"
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--page-size", type=int, default=100, help="Products per page, each with an image")
+    parser.add_argument("--requests", type=int, default=300, help="Requests per mode")
+    args = parser.parse_args()
+
+    logging.getLogger("app.main").setLevel(logging.ERROR)
+    async with engine.begin() as conn:
+        await conn.run_sync(upgrade_schema)
+    async with SessionLocal() as db:
+        db.add_all(
+            Product(
+                name=f"{BENCH_PREFIX}{i}",
+                price=1.0,
+                stock_quantity=10,
+                image_blob_name=f"product-{i}-20240101120000.jpg",
+                image_variants={variant: f"product-{i}-20240101120000-{variant}.webp" for variant in VARIANTS},
+            )
+            for i in range(args.page_size)
+        )
+        await db.commit()
+
+    print(f"{args.page_size} products per page, {1 + len(VARIANTS)} image URLs each, {args.requests} requests per mode")
+    try:
+        await time_mode("uncached", make_signer(max_entries=0), args)
+        await time_mode("cached", make_signer(max_entries=10_000), args)
+    finally:
+        async with SessionLocal() as db:
+            await db.execute(delete(Product).where(Product.name.startswith(BENCH_PREFIX)))
+            await db.commit()
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,92 @@
+# backend/product_service/benchmarks/bench_image_variants.py
+"""
+Throughput of image variant generation (app.image_variants) per pool process.
+
+Renders the configured variants (IMAGE_VARIANT_SIZES, as in the service) of synthetic
+photos of --width x --height for --duration seconds with a process pool of each size
+in --workers, keeping two jobs per process queued, and reports images per second and
+per process. Throughput should grow close to linearly up to the number of free cores.
+No database or blob storage is needed.
+
+Run from backend/product_service:
+    python -m benchmarks.bench_image_variants --workers 1,2,4
+    python -m benchmarks.bench_image_variants --format PNG --width 1200 --height 1200
+"""
+
+import argparse
+import asyncio
+import io
+import multiprocessing
+import os
+import random
+import time
+
+from PIL import Image, ImageFilter
+
+from app.image_variants import create_image_variant_pool, generate_image_variants, parse_variant_sizes
+
+
+def synthetic_photo(width: int, height: int, image_format: str) -> bytes:
+    """Smoothed noise, which compresses about as badly as a real photo."""
+    noise = Image.frombytes("RGB", (width // 8, height // 8), os.urandom(width // 8 * (height // 8) * 3))
+    image = noise.resize((width, height), Image.Resampling.BICUBIC).filter(ImageFilter.GaussianBlur(2))
+    out = io.BytesIO()
+    image.save(out, image_format, **({"quality": 90} if image_format == "JPEG" else {}))
+    return out.getvalue()
+
+
+async def run(workers: int, images, sizes, quality: int, duration: float):
+    """Returns the number of images rendered and the seconds it took."""
+    pool = create_image_variant_pool(workers)
+    loop = asyncio.get_running_loop()
+    try:
+        # Start every process before timing
+        await asyncio.gather(
+            *(loop.run_in_executor(pool, generate_image_variants, images[0], sizes, quality) for _ in range(workers))
+        )
+        completed = 0
+        deadline = time.monotonic() + duration
+
+        async def job_loop():
+            nonlocal completed
+            while time.monotonic() < deadline:
+                await loop.run_in_executor(pool, generate_image_variants, random.choice(images), sizes, quality)
+                completed += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(job_loop() for _ in range(2 * workers)))
+        return completed, time.perf_counter() - started
+    finally:
+        pool.shutdown()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--workers", default="1,2,4", help="Comma-separated pool sizes to test")
+    parser.add_argument("--width", type=int, default=3000)
+    parser.add_argument("--height", type=int, default=2000)
+    parser.add_argument("--format", default="JPEG", help="JPEG or PNG originals")
+    parser.add_argument("--sizes", default=os.getenv("IMAGE_VARIANT_SIZES", "thumbnail:160,small:480,medium:960"))
+    parser.add_argument("--quality", type=int, default=int(os.getenv("IMAGE_VARIANT_QUALITY", "80")))
+    parser.add_argument("--duration", type=float, default=10, help="Seconds per pool size")
+    args = parser.parse_args()
+
+    sizes = parse_variant_sizes(args.sizes)
+    images = [synthetic_photo(args.width, args.height, args.format) for _ in range(4)]
+    print(
+        f"{multiprocessing.cpu_count()} cores, {args.width}x{args.height} {args.format} originals "
+        f"(~{sum(map(len, images)) // len(images) // 1024} KiB), variants {args.sizes}, quality {args.quality}"
+    )
+    baseline = None
+    for workers in (int(w) for w in args.workers.split(",")):
+        completed, elapsed = await run(workers, images, sizes, args.quality, args.duration)
+        throughput = completed / elapsed
+        baseline = baseline or throughput / workers
+        print(
+            f"workers={workers:>2}: {throughput:7.1f} images/s  per process={throughput / workers:6.1f}  "
+            f"speedup={throughput / baseline:5.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
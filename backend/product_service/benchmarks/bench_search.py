@@ -0,0 +1,112 @@
+# backend/product_service/benchmarks/bench_search.py
+"""
+Product search latency benchmark over a large seeded catalog.
+
+Seeds the products table up to --rows synthetic products (once; re-runs reuse them),
+ensures the search indexes, then times list_products for every search mode and reports
+p50/p99 latency for three kinds of term: a common catalog word, a rare term (one
+product's number) and a term that matches nothing. "substring" is the original
+ILIKE '%term%' path; it only gets an index when pg_trgm is installed.
+
+Run from backend/product_service against a dedicated database, e.g.:
+    POSTGRES_DB=products_bench python -m benchmarks.bench_search --rows 1000000
+"""
+
+import argparse
+import asyncio
+import logging
+import random
+import statistics
+import string
+import time
+
+from fastapi import Response
+from sqlalchemy import func, select, text
+
+from app.db import SessionLocal, engine
+from app.main import list_products
+from app.migrate import upgrade_schema
+from app.models import Product
+from app.schemas import SearchMode
+from app.search import check_trigram_indexes
+
+WORDS = (
+    "oak walnut maple steel glass leather cotton wool linen bamboo copper brass "
+    "desk chair lamp sofa table shelf cabinet mirror rug blanket pillow kettle mug "
+    "plate bowl knife spoon pan pot grill fan heater speaker headphone keyboard mouse "
+    "monitor cable charger backpack wallet watch jacket boot sneaker scarf glove hat "
+    "compact portable deluxe classic modern vintage rustic premium eco smart wireless"
+).split()
+
+
+async def seed(rows: int):
+    async with engine.begin() as conn:
+        await conn.run_sync(upgrade_schema)
+        existing = (await conn.execute(select(func.count()).select_from(Product))).scalar()
+        if existing < rows:
+            print(f"Seeding {rows - existing:,} products...")
+            started = time.perf_counter()
+            await conn.execute(
+                text(
+                    f"""
+                    INSERT INTO {Product.__tablename__} (name, description, price, stock_quantity)
+                    SELECT
+                        initcap(w[1 + floor(random() * :n)::int]) || ' ' || initcap(w[1 + floor(random() * :n)::int]) || ' ' || g,
+                        'A ' || w[1 + floor(random() * :n)::int] || ' ' || w[1 + floor(random() * :n)::int] || ' for everyday use',
+                        round((random() * 100 + 1)::numeric, 2),
+                        floor(random() * 100)::int
+                    FROM generate_series(1, :count) AS g, (SELECT CAST(:words AS text[]) AS w) AS vocabulary
+                    """
+                ),
+                {"n": len(WORDS), "count": rows - existing, "words": WORDS},
+            )
+            print(f"Seeded in {time.perf_counter() - started:.1f}s")
+        trigram_available = await check_trigram_indexes(conn)
+        await conn.execute(text(f"ANALYZE {Product.__tablename__}"))
+    return trigram_available
+
+
+async def time_mode(mode: SearchMode, term_kind: str, terms):
+    latencies = []
+    async with SessionLocal() as db:
+        for term in terms:
+            started = time.perf_counter()
+            await list_products(
+                Response(), db, skip=0, limit=20, search=term, search_mode=mode, cursor=None
+            )
+            latencies.append((time.perf_counter() - started) * 1000)
+    percentiles = statistics.quantiles(latencies, n=100)
+    print(
+        f"{mode.value:>9} / {term_kind:<6}: "
+        f"p50={percentiles[49]:8.2f} ms  p99={percentiles[98]:8.2f} ms"
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1_000_000, help="Products to seed")
+    parser.add_argument("--queries", type=int, default=100, help="Queries per search mode")
+    args = parser.parse_args()
+
+    logging.getLogger("app.main").setLevel(logging.ERROR)
+    logging.getLogger("app.search").setLevel(logging.ERROR)
+    trigram_available = await seed(args.rows)
+
+    terms_by_kind = {
+        "common": [random.choice(WORDS) for _ in range(args.queries)],
+        "rare": [str(random.randint(1, args.rows)) for _ in range(args.queries)],
+        "miss": ["".join(random.choices(string.ascii_lowercase, k=8)) for _ in range(args.queries)],
+    }
+    modes = [SearchMode.substring, SearchMode.prefix, SearchMode.fulltext]
+    if trigram_available:
+        modes.append(SearchMode.fuzzy)
+    else:
+        print("pg_trgm not installed: substring search is unindexed and fuzzy is skipped.")
+    for mode in modes:
+        for term_kind, terms in terms_by_kind.items():
+            await time_mode(mode, term_kind, terms)
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
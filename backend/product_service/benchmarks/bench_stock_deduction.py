@@ -0,0 +1,91 @@
+# backend/product_service/benchmarks/bench_stock_deduction.py
+"""
+Concurrent stock deduction benchmark for a single hot product.
+
+Compares the previous read-modify-write deduction (SELECT, check in Python, UPDATE)
+with deduct_product_stock, which uses one conditional UPDATE ... RETURNING. Every
+task deducts one unit in its own session. Reports successful deductions, oversold
+units and deductions per second.
+
+Run from backend/product_service against a disposable database:
+    python -m benchmarks.bench_stock_deduction --tasks 500 --stock 250
+"""
+
+import argparse
+import asyncio
+import logging
+import time
+
+from fastapi import HTTPException
+from sqlalchemy import delete, select
+
+from app.db import SessionLocal, engine
+from app.main import deduct_product_stock
+from app.migrate import upgrade_schema
+from app.models import Product
+from app.schemas import StockDeductRequest
+
+
+async def legacy_deduct(product_id: int) -> bool:
+    async with SessionLocal() as db:
+        product = await db.scalar(select(Product).filter(Product.product_id == product_id))
+        if product.stock_quantity < 1:
+            return False
+        product.stock_quantity -= 1
+        await db.commit()
+        return True
+
+
+async def atomic_deduct(product_id: int) -> bool:
+    async with SessionLocal() as db:
+        try:
+            await deduct_product_stock(
+                product_id, StockDeductRequest(quantity_to_deduct=1), db, idempotency_key=None
+            )
+            return True
+        except HTTPException:
+            return False
+
+
+async def run(name, deduct, tasks: int, stock: int):
+    async with SessionLocal() as db:
+        product = Product(name=f"bench-{name}", price=1.0, stock_quantity=stock)
+        db.add(product)
+        await db.commit()
+        product_id = product.product_id
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*(deduct(product_id) for _ in range(tasks)))
+    elapsed = time.perf_counter() - started
+
+    async with SessionLocal() as db:
+        remaining = await db.scalar(
+            select(Product.stock_quantity).filter(Product.product_id == product_id)
+        )
+        await db.execute(delete(Product).where(Product.product_id == product_id))
+        await db.commit()
+
+    sold = sum(results)
+    print(
+        f"{name:>8}: {sold} sold of {stock} in stock, remaining={remaining}, "
+        f"oversold={max(sold - stock, 0)}, {tasks / elapsed:,.0f} deductions/s"
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--tasks", type=int, default=500, help="Concurrent deduction attempts")
+    parser.add_argument("--stock", type=int, default=250, help="Initial stock of the hot product")
+    args = parser.parse_args()
+
+    logging.getLogger("app.main").setLevel(logging.ERROR)
+    async with engine.begin() as conn:
+        await conn.run_sync(upgrade_schema)
+
+    await run("legacy", legacy_deduct, args.tasks, args.stock)
+    await run("atomic", atomic_deduct, args.tasks, args.stock)
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,150 @@
+# backend/product_service/benchmarks/bench_workers.py
+"""
+Load test of the production server (gunicorn.conf.py) at increasing worker counts.
+
+For each worker count, starts gunicorn on a free port, drives it for a fixed time from
+several load-generator processes with a fixed number of open connections each, and
+reports requests per second and the speedup over one worker. Afterwards it checks
+that /metrics, which aggregates every worker in Prometheus multiprocess mode, counted
+every request that was sent.
+
+Throughput should grow close to linearly while there are free cores for both the
+workers and the load generators. The service needs its database, as for the tests.
+
+Run from backend/product_service:
+    python -m benchmarks.bench_workers --workers 1,2,4 --duration 10
+    python -m benchmarks.bench_workers --path "/products/?limit=20"
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+from prometheus_client.parser import text_string_to_metric_families
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(workers: int, port: int, multiproc_dir: str) -> subprocess.Popen:
+    env = {
+        **os.environ,
+        "WEB_CONCURRENCY": str(workers),
+        "PORT": str(port),
+        "PROMETHEUS_MULTIPROC_DIR": multiproc_dir,
+        "GUNICORN_LOG_LEVEL": "warning",
+    }
+    return subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "app.main:app"],
+        env=env,
+        stdout=subprocess.DEVNULL,
+    )
+
+
+def wait_until_ready(base_url: str, workers: int, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(f"{base_url}/health", timeout=1).status_code == 200:
+                # Give every worker time to finish its startup handlers
+                time.sleep(1 + 0.25 * workers)
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"Server at {base_url} did not become ready")
+
+
+async def drive(url: str, connections: int, duration: float) -> int:
+    """Keeps `connections` requests in flight until `duration` elapses; returns completed requests."""
+    completed = 0
+    deadline = time.monotonic() + duration
+    limits = httpx.Limits(max_connections=connections, max_keepalive_connections=connections)
+    async with httpx.AsyncClient(limits=limits, timeout=30) as client:
+
+        async def connection_loop():
+            nonlocal completed
+            while time.monotonic() < deadline:
+                response = await client.get(url)
+                response.raise_for_status()
+                completed += 1
+
+        await asyncio.gather(*(connection_loop() for _ in range(connections)))
+    return completed
+
+
+def run_load_generator(args) -> int:
+    url, connections, duration = args
+    return asyncio.run(drive(url, connections, duration))
+
+
+def requests_counted(base_url: str, path: str) -> float:
+    """Sum of http_requests_total over the benchmarked endpoint, from the aggregated /metrics."""
+    endpoint = path.split("?")[0]
+    text = httpx.get(f"{base_url}/metrics", timeout=10).text
+    return sum(
+        sample.value
+        for family in text_string_to_metric_families(text)
+        if family.name == "http_requests"
+        for sample in family.samples
+        if sample.name == "http_requests_total" and sample.labels.get("endpoint") == endpoint
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--workers", default="1,2,4", help="Comma-separated worker counts to test")
+    parser.add_argument("--path", default="/health", help="Endpoint to load")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds of load per worker count")
+    parser.add_argument("--load-processes", type=int, default=multiprocessing.cpu_count(), help="Load-generator processes")
+    parser.add_argument("--connections", type=int, default=32, help="Open connections per load-generator process")
+    args = parser.parse_args()
+
+    print(
+        f"{multiprocessing.cpu_count()} cores, {args.load_processes} load processes x "
+        f"{args.connections} connections, {args.duration:.0f}s per run, GET {args.path}"
+    )
+    baseline = None
+    for workers in (int(w) for w in args.workers.split(",")):
+        port = free_port()
+        base_url = f"http://127.0.0.1:{port}"
+        with tempfile.TemporaryDirectory() as multiproc_dir:
+            server = start_server(workers, port, multiproc_dir)
+            try:
+                wait_until_ready(base_url, workers)
+                counted_before = requests_counted(base_url, args.path)
+                with multiprocessing.Pool(args.load_processes) as pool:
+                    started = time.perf_counter()
+                    completed = sum(
+                        pool.map(
+                            run_load_generator,
+                            [(f"{base_url}{args.path}", args.connections, args.duration)] * args.load_processes,
+                        )
+                    )
+                    elapsed = time.perf_counter() - started
+                counted = requests_counted(base_url, args.path) - counted_before
+            finally:
+                server.terminate()
+                server.wait(timeout=30)
+
+        throughput = completed / elapsed
+        baseline = baseline or throughput / workers
+        speedup = throughput / baseline
+        print(
+            f"workers={workers:>2}: {throughput:9.0f} req/s  speedup={speedup:5.2f}x  "
+            f"efficiency={speedup / workers:4.0%}  /metrics counted {counted:.0f} of {completed} requests"
+        )
+
+
+if __name__ == "__main__":
+    main()
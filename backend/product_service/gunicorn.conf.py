@@ -0,0 +1,50 @@
+# week09/example-2/backend/product_service/gunicorn.conf.py
+#
+# Production server: gunicorn managing several uvicorn worker processes, so a pod uses
+# as many cores as it has workers. Run from backend/product_service:
+#     gunicorn -c gunicorn.conf.py app.main:app
+# Every setting can be overridden through the environment variables below.
+
+import multiprocessing
+import os
+import shutil
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+
+# One worker per core by default; set WEB_CONCURRENCY to match the container's CPU limit
+workers = int(os.getenv("WEB_CONCURRENCY", str(multiprocessing.cpu_count())))
+# Uvicorn's worker picks uvloop and httptools when they are installed (see requirements.txt)
+worker_class = "uvicorn.workers.UvicornWorker"
+
+# Seconds a worker may stay silent before it is killed and replaced
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "60"))
+# Seconds workers get to finish in-flight requests on shutdown or restart
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+# Seconds to hold idle keep-alive connections; keep above the load balancer's idle timeout
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", "75"))
+# Restart a worker after this many requests (0 disables), jittered so they don't all restart at once
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", "0"))
+max_requests_jitter = int(os.getenv("GUNICORN_MAX_REQUESTS_JITTER", "0"))
+backlog = int(os.getenv("GUNICORN_BACKLOG", "2048"))
+
+loglevel = os.getenv("GUNICORN_LOG_LEVEL", "info")
+accesslog = None  # The app logs requests itself
+
+# Prometheus multiprocess mode: set before the workers are forked so prometheus_client
+# in each worker writes its values to files that /metrics aggregates
+prometheus_multiproc_dir = os.environ.setdefault(
+    "PROMETHEUS_MULTIPROC_DIR", "/tmp/prometheus_multiproc_product_service"
+)
+
+
+def on_starting(server):
+    # Files left by a previous run would be added to this run's counters
+    shutil.rmtree(prometheus_multiproc_dir, ignore_errors=True)
+    os.makedirs(prometheus_multiproc_dir, exist_ok=True)
+
+
+def child_exit(server, worker):
+    # Drop the exited worker's live gauges (e.g. http_requests_in_progress)
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,48 @@
+"""baseline schema
+
+The products table as Base.metadata.create_all created it before migrations were
+introduced. It is created only if missing, so databases set up by create_all are adopted
+as they are; the revisions after this one likewise skip what the startup code of earlier
+versions already added.
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-17 09:12:05.418236
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0001'
+down_revision: Union[str, Sequence[str], None] = None
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('products_week09_example_02',
+    sa.Column('product_id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('name', sa.String(length=255), nullable=False),
+    sa.Column('description', sa.Text(), nullable=True),
+    sa.Column('price', sa.Numeric(precision=10, scale=2), nullable=False),
+    sa.Column('stock_quantity', sa.Integer(), nullable=False),
+    sa.Column('image_url', sa.String(length=2048), nullable=True),
+    sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=True),
+    sa.Column('updated_at', sa.DateTime(timezone=True), nullable=True),
+    sa.PrimaryKeyConstraint('product_id'),
+    if_not_exists=True,
+    )
+    op.create_index(op.f('ix_products_week09_example_02_name'), 'products_week09_example_02', ['name'], unique=False, if_not_exists=True)
+    op.create_index(op.f('ix_products_week09_example_02_product_id'), 'products_week09_example_02', ['product_id'], unique=False, if_not_exists=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_products_week09_example_02_product_id'), table_name='products_week09_example_02')
+    op.drop_index(op.f('ix_products_week09_example_02_name'), table_name='products_week09_example_02')
+    op.drop_table('products_week09_example_02')
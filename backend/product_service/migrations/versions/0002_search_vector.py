@@ -0,0 +1,45 @@
+"""search vector
+
+Adds the generated full-text document products are searched by, and its GIN index.
+Formerly added at startup by app.search.ensure_search_indexes.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-17 09:12:31.705114
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0002'
+down_revision: Union[str, Sequence[str], None] = '0001'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('products_week09_example_02', sa.Column(
+        'search_vector', postgresql.TSVECTOR(),
+        sa.Computed(
+            "setweight(to_tsvector('english', coalesce(name, '')), 'A') || "
+            "setweight(to_tsvector('english', coalesce(description, '')), 'B')",
+            persisted=True,
+        ),
+        nullable=True,
+    ), if_not_exists=True)
+    op.create_index(
+        'ix_products_week09_example_02_search_vector', 'products_week09_example_02', ['search_vector'],
+        unique=False, postgresql_using='gin', if_not_exists=True,
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_products_week09_example_02_search_vector', table_name='products_week09_example_02', postgresql_using='gin')
+    op.drop_column('products_week09_example_02', 'search_vector')
@@ -0,0 +1,56 @@
+"""trigram indexes
+
+Installs pg_trgm and indexes name and description with gin_trgm_ops, which serves fuzzy
+search and ILIKE '%term%' alike. Servers without pg_trgm skip both and fuzzy search falls
+back to substring matching; once pg_trgm is installed there, create the indexes with
+alembic downgrade 0002 && alembic upgrade head. The models do not declare these indexes
+(app.migrate.include_object keeps them out of autogenerate).
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-17 09:12:58.260447
+
+"""
+import logging
+from typing import Sequence, Union
+
+from alembic import op
+from sqlalchemy.exc import DBAPIError
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0003'
+down_revision: Union[str, Sequence[str], None] = '0002'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+logger = logging.getLogger(__name__)
+
+TRIGRAM_INDEXED_COLUMNS = ('name', 'description')
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    if op.get_context().as_sql:
+        _create_trigram_indexes()
+        return
+    try:
+        with op.get_bind().begin_nested():
+            _create_trigram_indexes()
+    except DBAPIError as e:
+        logger.warning(f"Product Service: pg_trgm is not available, trigram indexes not created. Error: {e}")
+
+
+def _create_trigram_indexes():
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    for column in TRIGRAM_INDEXED_COLUMNS:
+        op.create_index(
+            f'ix_products_week09_example_02_{column}_trgm', 'products_week09_example_02', [column],
+            unique=False, postgresql_using='gin', postgresql_ops={column: 'gin_trgm_ops'}, if_not_exists=True,
+        )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    for column in TRIGRAM_INDEXED_COLUMNS:
+        op.drop_index(f'ix_products_week09_example_02_{column}_trgm', table_name='products_week09_example_02', if_exists=True)
@@ -0,0 +1,40 @@
+"""stock adjustments
+
+Records applied stock releases by idempotency key, so a redelivered release is not
+applied twice.
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-17 09:13:20.913562
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0004'
+down_revision: Union[str, Sequence[str], None] = '0003'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('stock_adjustments_week09_example_02',
+    sa.Column('idempotency_key', sa.String(length=100), nullable=False),
+    sa.Column('product_id', sa.Integer(), nullable=False),
+    sa.Column('quantity', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=True),
+    sa.PrimaryKeyConstraint('idempotency_key'),
+    if_not_exists=True,
+    )
+    op.create_index(op.f('ix_stock_adjustments_week09_example_02_product_id'), 'stock_adjustments_week09_example_02', ['product_id'], unique=False, if_not_exists=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_stock_adjustments_week09_example_02_product_id'), table_name='stock_adjustments_week09_example_02')
+    op.drop_table('stock_adjustments_week09_example_02')
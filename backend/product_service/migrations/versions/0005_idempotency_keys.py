@@ -0,0 +1,42 @@
+"""idempotency keys
+
+Stores the responses of requests sent with an Idempotency-Key header.
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-17 09:13:44.337805
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0005'
+down_revision: Union[str, Sequence[str], None] = '0004'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('idempotency_keys_week09_example_02',
+    sa.Column('scope', sa.String(length=100), nullable=False),
+    sa.Column('idempotency_key', sa.String(length=255), nullable=False),
+    sa.Column('request_hash', sa.String(length=64), nullable=False),
+    sa.Column('status_code', sa.Integer(), nullable=True),
+    sa.Column('response_body', sa.Text(), nullable=True),
+    sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=True),
+    sa.Column('expires_at', sa.DateTime(timezone=True), nullable=False),
+    sa.PrimaryKeyConstraint('scope', 'idempotency_key'),
+    if_not_exists=True,
+    )
+    op.create_index(op.f('ix_idempotency_keys_week09_example_02_expires_at'), 'idempotency_keys_week09_example_02', ['expires_at'], unique=False, if_not_exists=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_idempotency_keys_week09_example_02_expires_at'), table_name='idempotency_keys_week09_example_02')
+    op.drop_table('idempotency_keys_week09_example_02')
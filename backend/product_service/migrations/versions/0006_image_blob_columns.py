@@ -0,0 +1,68 @@
+"""image blob columns
+
+Products store the blob name of an uploaded image, signed when read, and the blob names
+of its resized variants. Images uploaded by earlier versions have a signed URL into the
+image container in image_url, which expires; those are converted to blob names.
+
+The conversion needs the container URL (e.g.
+https://<account>.blob.core.windows.net/<container>/). The service passes its own; on the
+command line give it as alembic -x image_container_url=<url> upgrade head. Without it the
+upgrade stops if any product still has a signed image URL.
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-17 09:14:09.652170
+
+"""
+from typing import Sequence, Union
+
+from alembic import context, op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0006'
+down_revision: Union[str, Sequence[str], None] = '0005'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('products_week09_example_02', sa.Column('image_blob_name', sa.String(length=1024), nullable=True), if_not_exists=True)
+    op.add_column('products_week09_example_02', sa.Column('image_variants', postgresql.JSONB(astext_type=sa.Text()), nullable=True), if_not_exists=True)
+
+    container_url = (
+        context.config.attributes.get("image_container_url")
+        or context.get_x_argument(as_dictionary=True).get("image_container_url")
+    )
+    if container_url is None:
+        if context.is_offline_mode():
+            return
+        signed = op.get_bind().scalar(sa.text(
+            "SELECT count(*) FROM products_week09_example_02 "
+            "WHERE image_blob_name IS NULL AND image_url LIKE '%?%sig=%'"
+        ))
+        if signed:
+            raise RuntimeError(
+                f"{signed} products have signed image URLs to convert; "
+                "run alembic -x image_container_url=<container url> upgrade head"
+            )
+        return
+    op.execute(
+        sa.text(
+            "UPDATE products_week09_example_02 SET "
+            "image_blob_name = split_part(substr(image_url, length(:prefix) + 1), '?', 1), "
+            "image_url = NULL, "
+            "image_variants = (SELECT jsonb_object_agg(key, split_part(substr(value, length(:prefix) + 1), '?', 1)) "
+            "FROM jsonb_each_text(image_variants)) "
+            "WHERE image_blob_name IS NULL AND starts_with(image_url, :prefix)"
+        ).bindparams(prefix=container_url)
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('products_week09_example_02', 'image_variants')
+    op.drop_column('products_week09_example_02', 'image_blob_name')
@@ -0,0 +1,38 @@
+"""stock adjustment expiry
+
+Stock adjustments expire so they can be purged. Rows recorded before this revision
+expire 7 days (the default STOCK_ADJUSTMENT_TTL_SECONDS) after they were created.
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-17 09:14:37.028841
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0007'
+down_revision: Union[str, Sequence[str], None] = '0006'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('stock_adjustments_week09_example_02', sa.Column('expires_at', sa.DateTime(timezone=True), nullable=True), if_not_exists=True)
+    op.execute(
+        "UPDATE stock_adjustments_week09_example_02 "
+        "SET expires_at = coalesce(created_at, now()) + interval '7 days' WHERE expires_at IS NULL"
+    )
+    op.alter_column('stock_adjustments_week09_example_02', 'expires_at', existing_type=sa.DateTime(timezone=True), nullable=False)
+    op.create_index(op.f('ix_stock_adjustments_week09_example_02_expires_at'), 'stock_adjustments_week09_example_02', ['expires_at'], unique=False, if_not_exists=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_stock_adjustments_week09_example_02_expires_at'), table_name='stock_adjustments_week09_example_02')
+    op.drop_column('stock_adjustments_week09_example_02', 'expires_at')
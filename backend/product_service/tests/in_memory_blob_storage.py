@@ -0,0 +1,86 @@
+# week09/example-2/backend/product_service/tests/in_memory_blob_storage.py
+"""In-memory stand-in for the Azure Blob Storage client, for the tests."""
+
+from typing import Dict, Optional
+
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
+from azure.storage.blob import ContentSettings
+
+
+class _InMemoryDownload:
+    def __init__(self, content: bytes):
+        self._content = content
+
+    async def readall(self) -> bytes:
+        return self._content
+
+
+class InMemoryBlobClient:
+    """Block blob kept in memory; the parts of azure.storage.blob.aio.BlobClient the service uses."""
+
+    def __init__(self, service: "InMemoryBlobServiceClient", container: str, blob: str):
+        self._service = service
+        self.container_name = container
+        self.blob_name = blob
+        self.url = f"{service.url}/{container}/{blob}"
+        self._staged: Dict[str, bytes] = {}
+
+    async def stage_block(self, block_id: str, data: bytes, length: Optional[int] = None, **kwargs):
+        self._staged[str(block_id)] = bytes(data)
+        self._service.largest_block = max(self._service.largest_block, len(data))
+
+    async def commit_block_list(self, block_list, content_settings: Optional[ContentSettings] = None, **kwargs):
+        self._service.blobs[(self.container_name, self.blob_name)] = b"".join(
+            self._staged.pop(str(block_id)) for block_id in block_list
+        )
+        self._service.content_types[(self.container_name, self.blob_name)] = (
+            content_settings.content_type if content_settings else None
+        )
+
+    async def upload_blob(self, data: bytes, overwrite: bool = False, content_settings: Optional[ContentSettings] = None, **kwargs):
+        key = (self.container_name, self.blob_name)
+        if key in self._service.blobs and not overwrite:
+            raise ResourceExistsError("The specified blob already exists.")
+        self._service.blobs[key] = bytes(data)
+        self._service.content_types[key] = content_settings.content_type if content_settings else None
+
+    async def download_blob(self, **kwargs) -> _InMemoryDownload:
+        key = (self.container_name, self.blob_name)
+        if key not in self._service.blobs:
+            raise ResourceNotFoundError("The specified blob does not exist.")
+        return _InMemoryDownload(self._service.blobs[key])
+
+
+class InMemoryContainerClient:
+    def __init__(self, service: "InMemoryBlobServiceClient", container: str):
+        self._service = service
+        self.container_name = container
+
+    async def create_container(self, **kwargs):
+        if self.container_name in self._service.containers:
+            raise ResourceExistsError("The specified container already exists.")
+        self._service.containers.add(self.container_name)
+
+
+class InMemoryBlobServiceClient:
+    """
+    Stand-in for azure.storage.blob.aio.BlobServiceClient: committed
+    blobs are kept in `blobs`, keyed by (container, blob name).
+    """
+
+    def __init__(self, url: str = "https://testaccount.blob.core.windows.net"):
+        self.url = url
+        self.containers = set()
+        self.blobs: Dict[tuple, bytes] = {}
+        self.content_types: Dict[tuple, Optional[str]] = {}
+        # Size of the biggest block staged so far, to check that uploads are chunked
+        self.largest_block = 0
+
+    def get_container_client(self, container: str) -> InMemoryContainerClient:
+        return InMemoryContainerClient(self, container)
+
+    def get_blob_client(self, container: str, blob: str) -> InMemoryBlobClient:
+        return InMemoryBlobClient(self, container, blob)
+
+    async def close(self):
+        pass
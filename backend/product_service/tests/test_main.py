@@ -1,19 +1,41 @@
 # week07/example-2/backend/product_service/tests/test_main.py
 
+import asyncio
+import io
+import json
 import logging
 import os
 import time
-from unittest.mock import MagicMock, patch
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import AsyncMock, patch
 
+import fakeredis
+from fastapi import HTTPException
+import httpx
 import pytest
-from app.db import SessionLocal, engine, get_db
-from app.main import app
-from app.models import Base, Product
+from app.blob_storage import BlobUrlSigner
+from app.image_variants import generate_image_variants
+from app.db import PoolStats, SessionLocal, engine, get_db
+import app.main as main_module
+from app.main import app, product_cache, registry
+from app.metrics_labels import OTHER_ENDPOINT, LabelGuard
+from app.migrate import alembic_config, include_object, upgrade_schema
+from app.idempotency import purge_expired_idempotency_keys, purge_expired_stock_adjustments
+from app.models import Base, IdempotencyKey, Product, StockAdjustment
+from app.shared_cache import SharedProductCache
+from PIL import Image
+from redis.exceptions import ConnectionError as RedisConnectionError
 
-from fastapi.testclient import TestClient
-from sqlalchemy.exc import OperationalError
+from alembic import command
+from alembic.autogenerate import compare_metadata
+from alembic.migration import MigrationContext
+from sqlalchemy import delete, event, select, text
+from sqlalchemy.exc import OperationalError, TimeoutError as SATimeoutError
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import Session
 
+from .in_memory_blob_storage import InMemoryBlobServiceClient
+
 # Suppress noisy logs from SQLAlchemy/FastAPI during tests for cleaner output
 logging.getLogger("sqlalchemy.engine").setLevel(logging.WARNING)
 logging.getLogger("uvicorn.access").setLevel(logging.WARNING)
@@ -22,7 +44,28 @@ logging.getLogger("fastapi").setLevel(logging.WARNING)
 logging.getLogger("app.main").setLevel(logging.WARNING)  # Suppress app's own info logs
 
 
+# All tests run on the asyncio backend of the anyio pytest plugin, sharing one event loop
+# per module so pooled asyncpg connections are never reused across loops.
+pytestmark = pytest.mark.anyio
+
+
 # --- Pytest Fixtures ---
+@pytest.fixture(scope="module")
+def anyio_backend():
+    return "asyncio"
+
+
+async def _recreate_tables():
+    async with engine.begin() as conn:
+        # Explicitly drop all tables first to ensure a clean slate for the session
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.execute(text("DROP TABLE IF EXISTS alembic_version"))
+        # Then create them with the migrations, as the service does at startup
+        await conn.run_sync(upgrade_schema)
+    # Connections opened here belong to a throwaway event loop; don't keep them pooled
+    await engine.dispose()
+
+
 @pytest.fixture(scope="session", autouse=True)
 def setup_database_for_tests():
     max_retries = 10
@@ -32,19 +75,12 @@ def setup_database_for_tests():
             logging.info(
                 f"Product Service Tests: Attempting to connect to PostgreSQL for test setup (attempt {i+1}/{max_retries})..."
             )
-            # Explicitly drop all tables first to ensure a clean slate for the session
-            Base.metadata.drop_all(bind=engine)
+            asyncio.run(_recreate_tables())
             logging.info(
-                "Product Service Tests: Successfully dropped all tables in PostgreSQL for test setup."
-            )
-
-            # Then create all tables required by the application
-            Base.metadata.create_all(bind=engine)
-            logging.info(
-                "Product Service Tests: Successfully created all tables in PostgreSQL for test setup."
+                "Product Service Tests: Successfully recreated all tables in PostgreSQL for test setup."
             )
             break
-        except OperationalError as e:
+        except (OperationalError, OSError) as e:
             logging.warning(
                 f"Product Service Tests: Test setup DB connection failed: {e}. Retrying in {retry_delay_seconds} seconds..."
             )
@@ -63,12 +99,12 @@ def setup_database_for_tests():
 
 
 @pytest.fixture(scope="function")
-def db_session_for_test():
-    connection = engine.connect()
-    transaction = connection.begin()
+async def db_session_for_test():
+    connection = await engine.connect()
+    transaction = await connection.begin()
     db = SessionLocal(bind=connection)
 
-    def override_get_db():
+    async def override_get_db():
         yield db
 
     app.dependency_overrides[get_db] = override_get_db
@@ -76,20 +112,23 @@ def db_session_for_test():
     try:
         yield db
     finally:
-        transaction.rollback()
-        db.close()
-        connection.close()
+        await transaction.rollback()
+        await db.close()
+        await connection.close()
         app.dependency_overrides.pop(get_db, None)
+        # Cached products may refer to rows the rollback just removed
+        product_cache.clear()
 
 
 @pytest.fixture(scope="module")
-def client():
+async def client():
     os.environ["AZURE_STORAGE_ACCOUNT_NAME"] = "testaccount"
     os.environ["AZURE_STORAGE_ACCOUNT_KEY"] = "testkey"
     os.environ["AZURE_STORAGE_CONTAINER_NAME"] = "test-images"
     os.environ["AZURE_SAS_TOKEN_EXPIRY_HOURS"] = "1"  # Short expiry for tests
 
-    with TestClient(app) as test_client:
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as test_client:
         yield test_client
 
     # Clean up environment variables after tests
@@ -100,57 +139,46 @@ def client():
 
 
 @pytest.fixture(scope="function", autouse=True)
-def mock_azure_blob_storage():
+def mock_azure_blob_storage(monkeypatch):
     """
-    Mocks the Azure Blob Storage client to prevent actual uploads during tests.
+    Replaces Azure Blob Storage with an in-memory stand-in to prevent actual uploads during tests.
     """
-    with patch("app.main.BlobServiceClient") as mock_blob_service_client:
-        mock_instance = MagicMock()
-        mock_blob_service_client.return_value = mock_instance
-
-        # Mock the get_container_client method
-        mock_container_client = MagicMock()
-        mock_instance.get_container_client.return_value = mock_container_client
-
-        # Mock the create_container method
-        mock_container_client.create_container.return_value = None
-
-        # Mock the get_blob_client method
-        mock_blob_client = MagicMock()
-        mock_instance.get_blob_client.return_value = mock_blob_client
-
-        # Mock the upload_blob method
-        mock_blob_client.upload_blob.return_value = None
-
-        # Mock the blob_client.url attribute
-        mock_blob_client.url = (
-            "https://testaccount.blob.core.windows.net/test-images/mock_blob.jpg"
-        )
+    blob_service = InMemoryBlobServiceClient("https://testaccount.blob.core.windows.net")
+    monkeypatch.setattr(main_module, "blob_service_client", blob_service)
+    monkeypatch.setattr(main_module, "AZURE_STORAGE_CONTAINER_NAME", "test-images")
+    monkeypatch.setattr(
+        main_module,
+        "blob_url_signer",
+        BlobUrlSigner(
+            blob_service.url, "testaccount", "testkey", "test-images",
+            expiry_seconds=3600, refresh_before_expiry_seconds=600, max_entries=100,
+        ),
+    )
 
-        # Mock generate_blob_sas
-        with patch("app.main.generate_blob_sas") as mock_generate_blob_sas:
-            mock_generate_blob_sas.return_value = "sv=2021-08-01&st=2024-01-01T00%3A00%3A00Z&se=2024-01-01T01%3A00%3A00Z&sr=b&sp=r&sig=mock_sas_token"
-            yield mock_blob_service_client  # Yield the mock object for potential assertions
+    # Mock generate_blob_sas
+    with patch("app.blob_storage.generate_blob_sas") as mock_generate_blob_sas:
+        mock_generate_blob_sas.return_value = "sv=2021-08-01&st=2024-01-01T00%3A00%3A00Z&se=2024-01-01T01%3A00%3A00Z&sr=b&sp=r&sig=mock_sas_token"
+        yield blob_service  # Yield the stand-in for assertions on uploaded blobs
 
 
 # --- Product Service Tests ---
 
 
-def test_read_root(client: TestClient):
+async def test_read_root(client: httpx.AsyncClient):
     """Test the root endpoint."""
-    response = client.get("/")
+    response = await client.get("/")
     assert response.status_code == 200
     assert response.json() == {"message": "Welcome to the Product Service!"}
 
 
-def test_health_check(client: TestClient):
+async def test_health_check(client: httpx.AsyncClient):
     """Test the health check endpoint."""
-    response = client.get("/health")
+    response = await client.get("/health")
     assert response.status_code == 200
     assert response.json() == {"status": "ok", "service": "product-service"}
 
 
-def test_create_product_success(client: TestClient, db_session_for_test: Session):
+async def test_create_product_success(client: httpx.AsyncClient, db_session_for_test: AsyncSession):
     """
     Tests successful creation of a product via POST /products/.
     Verifies status code, response data, and database entry, including optional image_url.
@@ -162,7 +190,7 @@ def test_create_product_success(client: TestClient, db_session_for_test: Session
         "stock_quantity": 100,
         "image_url": "http://example.com/test_image.jpg",
     }
-    response = client.post("/products/", json=test_data)
+    response = await client.post("/products/", json=test_data)
 
     assert response.status_code == 201
     response_data = response.json()
@@ -181,26 +209,24 @@ def test_create_product_success(client: TestClient, db_session_for_test: Session
     assert "updated_at" in response_data
 
     # Verify the product exists in the database using the test session
-    db_product = (
-        db_session_for_test.query(Product)
-        .filter(Product.product_id == response_data["product_id"])
-        .first()
+    db_product = await db_session_for_test.scalar(
+        select(Product).filter(Product.product_id == response_data["product_id"])
     )
     assert db_product is not None
     assert db_product.name == test_data["name"]
     assert db_product.image_url == test_data["image_url"]
 
 
-def test_list_products_empty(client: TestClient):
+async def test_list_products_empty(client: httpx.AsyncClient):
     """
     Tests listing products when no products exist, expecting an empty list.
     """
-    response = client.get("/products/")
+    response = await client.get("/products/")
     assert response.status_code == 200
     assert response.json() == []
 
 
-def test_list_products_with_data(client: TestClient, db_session_for_test: Session):
+async def test_list_products_with_data(client: httpx.AsyncClient, db_session_for_test: AsyncSession):
     """
     Tests listing products when products exist, verifying the list structure.
     A product is created via API to ensure it's present.
@@ -213,20 +239,20 @@ def test_list_products_with_data(client: TestClient, db_session_for_test: Sessio
         "stock_quantity": 10,
         "image_url": "http://example.com/list_test.png",
     }
-    client.post("/products/", json=product_data)
+    await client.post("/products/", json=product_data)
 
-    response = client.get("/products/")
+    response = await client.get("/products/")
     assert response.status_code == 200
     assert isinstance(response.json(), list)
     assert len(response.json()) >= 1  # Should contain the product we just added
 
 
-def test_delete_product_success(client: TestClient, db_session_for_test: Session):
+async def test_delete_product_success(client: httpx.AsyncClient, db_session_for_test: AsyncSession):
     """
     Tests successful deletion of a product.
     """
     # Create a product specifically for deletion
-    create_resp = client.post(
+    create_resp = await client.post(
         "/products/",
         json={
             "name": "Product to Delete",
@@ -238,17 +264,966 @@ def test_delete_product_success(client: TestClient, db_session_for_test: Session
     )
     product_id = create_resp.json()["product_id"]
 
-    response = client.delete(f"/products/{product_id}")
+    response = await client.delete(f"/products/{product_id}")
     assert response.status_code == 204  # No content on successful delete
 
     # Verify product is no longer in DB via GET attempt
-    get_response = client.get(f"/products/{product_id}")
+    get_response = await client.get(f"/products/{product_id}")
     assert get_response.status_code == 404
 
     # Verify directly with DB session (cleaner for confirming actual deletion)
-    deleted_product_in_db = (
-        db_session_for_test.query(Product)
-        .filter(Product.product_id == product_id)
-        .first()
+    deleted_product_in_db = await db_session_for_test.scalar(
+        select(Product).filter(Product.product_id == product_id)
     )
     assert deleted_product_in_db is None
+
+
+async def test_reserve_stock_success(
+    client: httpx.AsyncClient, db_session_for_test: AsyncSession
+):
+    """
+    Tests that POST /products/stock/reserve deducts every item in one call and one
+    UPDATE, merging repeated lines for the same product.
+    """
+    first_response = await client.post(
+        "/products/",
+        json={"name": "Reserve A", "price": 3.0, "stock_quantity": 10},
+    )
+    first = first_response.json()
+    second_response = await client.post(
+        "/products/",
+        json={"name": "Reserve B", "price": 4.0, "stock_quantity": 5},
+    )
+    second = second_response.json()
+
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine.sync_engine, "before_cursor_execute", record)
+    try:
+        response = await client.post(
+            "/products/stock/reserve",
+            json={
+                "items": [
+                    {"product_id": second["product_id"], "quantity": 2},
+                    {"product_id": first["product_id"], "quantity": 3},
+                    {"product_id": second["product_id"], "quantity": 1},
+                ]
+            },
+        )
+    finally:
+        event.remove(engine.sync_engine, "before_cursor_execute", record)
+    assert response.status_code == 200
+    # The row lock, then every deduction in one UPDATE whose RETURNING rows make the response
+    assert len(statements) == 2
+    response_data = response.json()
+    assert [p["product_id"] for p in response_data] == [
+        second["product_id"],
+        first["product_id"],
+    ]
+    assert response_data[0]["stock_quantity"] == 2
+    assert response_data[1]["stock_quantity"] == 7
+    assert float(response_data[1]["price"]) == 3.0
+
+
+async def test_reserve_stock_with_idempotency_key_runs_once(
+    client: httpx.AsyncClient, db_session_for_test: AsyncSession
+):
+    """
+    Tests that retrying a reservation with the same Idempotency-Key replays the stored
+    response instead of reserving again, and that the key cannot be reused for other items.
+    """
+    create_response = await client.post(
+        "/products/",
+        json={"name": "Reserve Retry", "price": 2.0, "stock_quantity": 4},
+    )
+    product_id = create_response.json()["product_id"]
+    headers = {"Idempotency-Key": "order-key-1:reserve"}
+    reserve = {"items": [{"product_id": product_id, "quantity": 3}]}
+
+    first = await client.post("/products/stock/reserve", json=reserve, headers=headers)
+    retry = await client.post("/products/stock/reserve", json=reserve, headers=headers)
+    assert first.status_code == retry.status_code == 200
+    assert first.json() == retry.json()
+    assert first.json()[0]["stock_quantity"] == 1
+    assert retry.headers["Idempotent-Replayed"] == "true"
+
+    other = await client.post(
+        "/products/stock/reserve", json={"items": [{"product_id": product_id, "quantity": 1}]},
+        headers={"Idempotency-Key": "order-key-2:reserve"},
+    )
+    assert other.json()[0]["stock_quantity"] == 0
+    reused = await client.post(
+        "/products/stock/reserve", json={"items": [{"product_id": product_id, "quantity": 1}]}, headers=headers
+    )
+    assert reused.status_code == 422
+
+
+async def test_reserve_stock_is_all_or_nothing(
+    client: httpx.AsyncClient, db_session_for_test: AsyncSession
+):
+    """
+    Tests that a reservation with one insufficient or unknown item deducts nothing.
+    """
+    plenty_response = await client.post(
+        "/products/",
+        json={"name": "Reserve Plenty", "price": 1.0, "stock_quantity": 50},
+    )
+    plenty = plenty_response.json()
+    scarce_response = await client.post(
+        "/products/",
+        json={"name": "Reserve Scarce", "price": 1.0, "stock_quantity": 1},
+    )
+    scarce = scarce_response.json()
+
+    response = await client.post(
+        "/products/stock/reserve",
+        json={
+            "items": [
+                {"product_id": plenty["product_id"], "quantity": 5},
+                {"product_id": scarce["product_id"], "quantity": 2},
+            ]
+        },
+    )
+    assert response.status_code == 400
+    assert "Reserve Scarce" in response.json()["detail"]
+
+    response = await client.post(
+        "/products/stock/reserve",
+        json={
+            "items": [
+                {"product_id": plenty["product_id"], "quantity": 5},
+                {"product_id": 999999, "quantity": 1},
+            ]
+        },
+    )
+    assert response.status_code == 404
+
+    plenty_response = await client.get(f"/products/{plenty['product_id']}")
+    scarce_response = await client.get(f"/products/{scarce['product_id']}")
+    assert plenty_response.json()["stock_quantity"] == 50
+    assert scarce_response.json()["stock_quantity"] == 1
+
+
+async def test_concurrent_deductions_never_oversell(client: httpx.AsyncClient):
+    """
+    Hammers one hot product with concurrent deductions, each handled in its own
+    database session, and checks that exactly the available stock is sold.
+    """
+    stock = 20
+    attempts = 60
+    async with SessionLocal() as db:
+        hot_product = Product(name="Hot SKU", price=1.0, stock_quantity=stock)
+        db.add(hot_product)
+        await db.commit()
+        product_id = hot_product.product_id
+
+    try:
+        responses = await asyncio.gather(
+            *(
+                client.patch(
+                    f"/products/{product_id}/deduct-stock",
+                    json={"quantity_to_deduct": 1},
+                )
+                for _ in range(attempts)
+            )
+        )
+        status_codes = [response.status_code for response in responses]
+        assert status_codes.count(200) == stock
+        assert status_codes.count(400) == attempts - stock
+
+        async with SessionLocal() as db:
+            remaining = await db.scalar(
+                select(Product.stock_quantity).filter(Product.product_id == product_id)
+            )
+        assert remaining == 0
+    finally:
+        async with SessionLocal() as db:
+            await db.execute(delete(Product).where(Product.product_id == product_id))
+            await db.commit()
+
+
+async def test_list_products_prefix_and_fulltext_search(
+    client: httpx.AsyncClient, db_session_for_test: AsyncSession
+):
+    """
+    Tests the index-backed search modes: prefix matches the start of words and
+    fulltext ranks name matches above description-only matches.
+    """
+    for product_data in [
+        {"name": "Walnut Desk", "description": "Solid wood desk", "price": 250.0, "stock_quantity": 3},
+        {"name": "Desk Lamp", "description": "LED lamp", "price": 30.0, "stock_quantity": 8},
+        {"name": "Office Chair", "description": "Pairs well with any desk", "price": 120.0, "stock_quantity": 5},
+    ]:
+        await client.post("/products/", json=product_data)
+
+    response = await client.get("/products/", params={"search": "lam", "search_mode": "prefix"})
+    assert response.status_code == 200
+    assert [p["name"] for p in response.json()] == ["Desk Lamp"]
+
+    response = await client.get("/products/", params={"search": "desks", "search_mode": "fulltext"})
+    assert response.status_code == 200
+    names = [p["name"] for p in response.json()]
+    assert set(names) == {"Walnut Desk", "Desk Lamp", "Office Chair"}
+    assert names[-1] == "Office Chair"  # Description-only match ranks last
+
+    response = await client.get("/products/", params={"search": "desk", "search_mode": "bogus"})
+    assert response.status_code == 422
+
+
+async def test_list_products_cursor_pagination(
+    client: httpx.AsyncClient, db_session_for_test: AsyncSession
+):
+    """
+    Tests that following X-Next-Cursor walks every product exactly once, in
+    product_id order, and that the last page carries no cursor.
+    """
+    created_ids = []
+    for i in range(3):
+        response = await client.post(
+            "/products/",
+            json={"name": f"Paged {i}", "description": "Paging", "price": 1.0, "stock_quantity": 1},
+        )
+        created_ids.append(response.json()["product_id"])
+
+    first_page = await client.get("/products/", params={"limit": 2})
+    assert first_page.status_code == 200
+    assert [p["product_id"] for p in first_page.json()] == created_ids[:2]
+    cursor = first_page.headers["X-Next-Cursor"]
+
+    second_page = await client.get("/products/", params={"limit": 2, "cursor": cursor})
+    assert second_page.status_code == 200
+    assert [p["product_id"] for p in second_page.json()] == created_ids[2:]
+    assert "X-Next-Cursor" not in second_page.headers
+
+    response = await client.get("/products/", params={"cursor": "not-a-cursor"})
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Invalid cursor."
+
+    response = await client.get(
+        "/products/", params={"cursor": cursor, "search": "paged", "search_mode": "fulltext"}
+    )
+    assert response.status_code == 400
+
+    response = await client.get("/products/", params={"cursor": cursor, "skip": 1})
+    assert response.status_code == 400
+    assert response.json()["detail"] == "skip cannot be combined with cursor."
+
+
+def cache_lookups(result: str, tier: str = "local", resource: str = "product") -> float:
+    return registry.get_sample_value(
+        "product_cache_requests_total",
+        {"app_name": "product_service", "tier": tier, "resource": resource, "result": result},
+    ) or 0.0
+
+
+async def test_get_product_is_cached_and_invalidated_by_writes(
+    client: httpx.AsyncClient, db_session_for_test: AsyncSession
+):
+    """
+    Tests that repeated reads of a product are served from the cache and that
+    updates and stock changes are visible on the next read.
+    """
+    create_response = await client.post(
+        "/products/",
+        json={"name": "Cached Mug", "description": "Ceramic", "price": 9.5, "stock_quantity": 10},
+    )
+    product_id = create_response.json()["product_id"]
+
+    hits, misses = cache_lookups("hit"), cache_lookups("miss")
+    first = await client.get(f"/products/{product_id}")
+    second = await client.get(f"/products/{product_id}")
+    assert first.status_code == second.status_code == 200
+    assert first.json() == second.json()
+    assert first.json()["name"] == "Cached Mug"
+    assert cache_lookups("miss") == misses + 1
+    assert cache_lookups("hit") == hits + 1
+
+    await client.put(f"/products/{product_id}", json={"name": "Renamed Mug"})
+    assert (await client.get(f"/products/{product_id}")).json()["name"] == "Renamed Mug"
+
+    await client.patch(f"/products/{product_id}/deduct-stock", json={"quantity_to_deduct": 4})
+    assert (await client.get(f"/products/{product_id}")).json()["stock_quantity"] == 6
+
+    await client.delete(f"/products/{product_id}")
+    assert (await client.get(f"/products/{product_id}")).status_code == 404
+
+
+@pytest.fixture(scope="function")
+def shared_cache(monkeypatch):
+    """Enables the shared cache tier against an in-memory Redis stand-in."""
+    cache = SharedProductCache(fakeredis.FakeAsyncRedis(), ttl_seconds=60)
+    monkeypatch.setattr(main_module, "shared_product_cache", cache)
+    return cache
+
+
+async def test_shared_cache_serves_products_and_lists_across_replicas(
+    client: httpx.AsyncClient, db_session_for_test: AsyncSession, shared_cache
+):
+    """
+    Tests that product and list responses are served from the shared tier once the
+    local tier has nothing (as on another replica) and that writes invalidate both.
+    """
+    create_response = await client.post(
+        "/products/",
+        json={"name": "Shared Lamp", "description": "Brass", "price": 40.0, "stock_quantity": 5},
+    )
+    product_id = create_response.json()["product_id"]
+
+    await client.get(f"/products/{product_id}")
+    product_cache.clear()  # Another replica starts with an empty in-process cache
+    shared_hits = cache_lookups("hit", tier="shared")
+    response = await client.get(f"/products/{product_id}")
+    assert response.json()["name"] == "Shared Lamp"
+    assert cache_lookups("hit", tier="shared") == shared_hits + 1
+
+    await client.put(f"/products/{product_id}", json={"name": "Shared Desk Lamp"})
+    product_cache.clear()
+    assert (await client.get(f"/products/{product_id}")).json()["name"] == "Shared Desk Lamp"
+
+    list_hits = cache_lookups("hit", tier="shared", resource="list")
+    first_list = await client.get("/products/", params={"limit": 1})
+    second_list = await client.get("/products/", params={"limit": 1})
+    assert second_list.json() == first_list.json()
+    assert second_list.headers["X-Next-Cursor"] == first_list.headers["X-Next-Cursor"]
+    assert cache_lookups("hit", tier="shared", resource="list") == list_hits + 1
+
+    await client.post(
+        "/products/",
+        json={"name": "Shared Rug", "description": "Wool", "price": 80.0, "stock_quantity": 2},
+    )
+    names = [p["name"] for p in (await client.get("/products/")).json()]
+    assert "Shared Rug" in names
+
+
+async def test_shared_cache_outage_falls_back_to_database(
+    client: httpx.AsyncClient, db_session_for_test: AsyncSession, monkeypatch
+):
+    """
+    Tests that an unreachable shared cache is skipped rather than failing reads.
+    """
+    broken_client = fakeredis.FakeAsyncRedis()
+    monkeypatch.setattr(
+        broken_client, "mget", AsyncMock(side_effect=RedisConnectionError("connection refused"))
+    )
+    monkeypatch.setattr(
+        main_module, "shared_product_cache", SharedProductCache(broken_client, ttl_seconds=60)
+    )
+
+    create_response = await client.post(
+        "/products/",
+        json={"name": "Offline Kettle", "description": "Steel", "price": 25.0, "stock_quantity": 3},
+    )
+    product_id = create_response.json()["product_id"]
+
+    unavailable = cache_lookups("unavailable", tier="shared")
+    response = await client.get(f"/products/{product_id}")
+    assert response.status_code == 200
+    assert response.json()["name"] == "Offline Kettle"
+    assert cache_lookups("unavailable", tier="shared") == unavailable + 1
+    assert not main_module.shared_product_cache.available
+    assert (await client.get("/products/")).status_code == 200
+
+
+async def test_shared_cache_invalidations_reach_other_replicas():
+    """
+    Tests that an invalidation published by one replica is delivered to the
+    subscribers of every replica.
+    """
+    server = fakeredis.FakeServer()
+    publisher = SharedProductCache(fakeredis.FakeAsyncRedis(server=server), ttl_seconds=60)
+    subscriber = SharedProductCache(fakeredis.FakeAsyncRedis(server=server), ttl_seconds=60)
+    received = asyncio.Queue()
+    listener = asyncio.create_task(subscriber.listen_for_invalidations(received.put_nowait))
+    try:
+        for _ in range(50):  # Wait for the subscription to be registered
+            if (await publisher.client.pubsub_numsub("product_service:invalidations"))[0][1]:
+                break
+            await asyncio.sleep(0.01)
+        await publisher.invalidate([7, 9])
+        assert [await asyncio.wait_for(received.get(), 1) for _ in range(2)] == [7, 9]
+    finally:
+        listener.cancel()
+
+
+def count_series(sample_name: str) -> int:
+    return sum(
+        1
+        for metric in registry.collect()
+        for sample in metric.samples
+        if sample.name == sample_name
+    )
+
+
+async def test_http_metrics_label_by_route_template(
+    client: httpx.AsyncClient, db_session_for_test: AsyncSession
+):
+    """
+    Tests that requests for 10k distinct product IDs add a constant number of
+    HTTP metric series, labelled with the route template.
+    """
+    # A malformed body is rejected with 422 before the handler runs, keeping 10k requests fast
+    async def put_invalid(product_id):
+        return await client.put(
+            f"/products/{product_id}", content=b"not json", headers={"Content-Type": "application/json"}
+        )
+
+    assert (await put_invalid(1)).status_code == 422
+    series_before = count_series("http_requests_total")
+
+    for product_id in range(100_000, 110_000):
+        await put_invalid(product_id)
+
+    assert count_series("http_requests_total") == series_before
+    labels = {"app_name": "product_service", "method": "PUT", "status_code": "422"}
+    assert registry.get_sample_value(
+        "http_requests_total", {**labels, "endpoint": "/products/{product_id}"}
+    ) >= 10_001
+    assert registry.get_sample_value(
+        "http_requests_total", {**labels, "endpoint": "/products/100000"}
+    ) is None
+    response = await client.get("/no/such/path")
+    assert response.status_code == 404
+    assert registry.get_sample_value(
+        "http_requests_total",
+        {"app_name": "product_service", "method": "GET", "endpoint": "__unmatched__", "status_code": "404"},
+    ) >= 1
+
+
+def test_label_guard_collapses_values_beyond_its_cap():
+    guard = LabelGuard(max_values=2)
+    assert [guard(v) for v in ("/a", "/b", "/c", "/a")] == ["/a", "/b", OTHER_ENDPOINT, "/a"]
+
+
+async def test_stock_metrics_are_computed_at_scrape_time(
+    client: httpx.AsyncClient, db_session_for_test: AsyncSession, monkeypatch
+):
+    """
+    Tests that stock metrics come from the database when /metrics is scraped,
+    with per-product series only for low-stock products, and that reads do not
+    create stock series.
+    """
+    monkeypatch.setattr(main_module.stock_collector, "max_staleness_seconds", 0)
+    product_ids = {}
+    for name, stock in (("Sold Out Vase", 0), ("Scarce Bowl", 3), ("Plenty Plate", 40)):
+        response = await client.post(
+            "/products/",
+            json={"name": name, "description": "Stock metrics", "price": 5.0, "stock_quantity": stock},
+        )
+        product_ids[name] = response.json()["product_id"]
+        await client.get(f"/products/{product_ids[name]}")
+
+    assert (await client.get("/metrics")).status_code == 200
+
+    def stock_sample(name, **labels):
+        return registry.get_sample_value(name, {"app_name": "product_service", **labels})
+
+    assert stock_sample("product_catalog_products") == 3
+    assert stock_sample("product_stock_units") == 43
+    assert stock_sample("product_out_of_stock_products") == 1
+    assert stock_sample("product_low_stock_products") == 2
+    assert stock_sample(
+        "product_stock_quantity", product_id=str(product_ids["Scarce Bowl"]), product_name="Scarce Bowl"
+    ) == 3
+    assert stock_sample(
+        "product_stock_quantity", product_id=str(product_ids["Plenty Plate"]), product_name="Plenty Plate"
+    ) is None
+
+    await client.patch(
+        f"/products/{product_ids['Plenty Plate']}/deduct-stock", json={"quantity_to_deduct": 38}
+    )
+    await client.get("/metrics")
+    assert stock_sample("product_low_stock_products") == 3
+    assert stock_sample("product_stock_units") == 5
+
+
+async def test_get_products_batch(client: httpx.AsyncClient, db_session_for_test: AsyncSession):
+    """
+    Tests that a batch lookup returns products in request order, reports missing IDs
+    and validates its input.
+    """
+    product_ids = []
+    for name in ("Batch A", "Batch B", "Batch C"):
+        response = await client.post(
+            "/products/",
+            json={"name": name, "description": "Batch", "price": 2.0, "stock_quantity": 4},
+        )
+        product_ids.append(response.json()["product_id"])
+    missing_id = product_ids[-1] + 1000
+
+    response = await client.get(
+        "/products/batch",
+        params=[("ids", f"{product_ids[2]},{missing_id}"), ("ids", product_ids[0]), ("ids", product_ids[2])],
+    )
+    assert response.status_code == 200
+    data = response.json()
+    assert [p["name"] for p in data["products"]] == ["Batch C", "Batch A"]
+    assert data["missing_ids"] == [missing_id]
+
+    assert (await client.get("/products/batch", params={"ids": "1,abc"})).status_code == 400
+    too_many = ",".join(str(i) for i in range(1, main_module.PRODUCT_BATCH_MAX_IDS + 2))
+    assert (await client.get("/products/batch", params={"ids": too_many})).status_code == 400
+    assert (await client.get("/products/batch")).status_code == 422
+
+
+async def test_release_stock_applies_each_key_once(
+    client: httpx.AsyncClient, db_session_for_test: AsyncSession, monkeypatch
+):
+    """
+    Tests that a stock release is applied once per idempotency key, so a retried
+    delivery does not add stock twice, that unknown products are reported, and that
+    expired release keys are purged.
+    """
+    create_response = await client.post(
+        "/products/",
+        json={"name": "Release Jar", "description": "Glass", "price": 3.0, "stock_quantity": 1},
+    )
+    product_id = create_response.json()["product_id"]
+    release = {
+        "items": [
+            {"idempotency_key": "order-1-a", "product_id": product_id, "quantity": 2},
+            {"idempotency_key": "order-1-b", "product_id": product_id, "quantity": 3},
+            {"idempotency_key": "order-1-c", "product_id": product_id + 1000, "quantity": 1},
+        ]
+    }
+
+    response = await client.post("/products/stock/release", json=release)
+    assert response.status_code == 200
+    assert response.json() == {
+        "applied": ["order-1-a", "order-1-b"],
+        "duplicates": [],
+        "missing": ["order-1-c"],
+    }
+
+    retry_response = await client.post("/products/stock/release", json=release)
+    assert retry_response.json()["applied"] == []
+    assert retry_response.json()["duplicates"] == ["order-1-a", "order-1-b"]
+
+    product = (await client.get(f"/products/{product_id}")).json()
+    assert product["stock_quantity"] == 6
+
+    monkeypatch.setattr(main_module, "STOCK_ADJUSTMENT_TTL_SECONDS", 0)
+    short_lived = {"items": [{"idempotency_key": "order-2-a", "product_id": product_id, "quantity": 1}]}
+    assert (await client.post("/products/stock/release", json=short_lived)).json()["applied"] == ["order-2-a"]
+    assert await purge_expired_stock_adjustments(db_session_for_test, batch_size=100) == 1
+    remaining = await db_session_for_test.scalars(
+        select(StockAdjustment.idempotency_key).order_by(StockAdjustment.idempotency_key)
+    )
+    assert list(remaining) == ["order-1-a", "order-1-b"]
+
+
+async def test_stock_requests_with_idempotency_key_run_once(
+    client: httpx.AsyncClient, db_session_for_test: AsyncSession, monkeypatch
+):
+    """
+    Tests that retrying a stock deduction with the same Idempotency-Key replays the
+    stored response instead of deducting again, that reusing the key for a different
+    request is rejected, and that expired keys are purged.
+    """
+    create_response = await client.post(
+        "/products/",
+        json={"name": "Retry Bowl", "description": "Stoneware", "price": 9.0, "stock_quantity": 10},
+    )
+    product_id = create_response.json()["product_id"]
+    headers = {"Idempotency-Key": "checkout-42"}
+
+    first = await client.patch(
+        f"/products/{product_id}/deduct-stock", json={"quantity_to_deduct": 3}, headers=headers
+    )
+    retry = await client.patch(
+        f"/products/{product_id}/deduct-stock", json={"quantity_to_deduct": 3}, headers=headers
+    )
+    assert first.status_code == retry.status_code == 200
+    assert first.json() == retry.json()
+    assert first.json()["stock_quantity"] == 7
+    assert "Idempotent-Replayed" not in first.headers
+    assert retry.headers["Idempotent-Replayed"] == "true"
+
+    reused = await client.patch(
+        f"/products/{product_id}/deduct-stock", json={"quantity_to_deduct": 5}, headers=headers
+    )
+    assert reused.status_code == 422
+    # Keys are scoped per endpoint
+    added = await client.patch(
+        f"/products/{product_id}/add-stock", json={"quantity_to_deduct": 1}, headers=headers
+    )
+    assert added.json()["stock_quantity"] == 8
+    assert (await client.get(f"/products/{product_id}")).json()["stock_quantity"] == 8
+
+    monkeypatch.setattr(main_module, "IDEMPOTENCY_KEY_TTL_SECONDS", 0)
+    await client.patch(
+        f"/products/{product_id}/add-stock", json={"quantity_to_deduct": 1}, headers={"Idempotency-Key": "short-lived"}
+    )
+    assert await purge_expired_idempotency_keys(db_session_for_test, batch_size=100) == 1
+    remaining = await db_session_for_test.scalars(
+        select(IdempotencyKey.idempotency_key).filter(IdempotencyKey.idempotency_key.in_(["checkout-42", "short-lived"]))
+    )
+    assert sorted(remaining) == ["checkout-42", "checkout-42"]
+
+
+async def test_db_pool_metrics_report_checkouts_and_timeouts():
+    """
+    Tests that pool stats report checked-out connections and session checkout time
+    from the pool and session events, and count requests that failed because the
+    pool timed out, also when the timeout caused the error they raised.
+    """
+    small_engine = create_async_engine(engine.url, pool_size=1, max_overflow=0, pool_timeout=0.1)
+
+    class SmallPoolSession(Session):
+        pass
+
+    small_sessions = async_sessionmaker(small_engine, sync_session_class=SmallPoolSession)
+    stats = PoolStats(small_engine.sync_engine.pool, SmallPoolSession)
+    stats.on_change = main_module._observe_db_pool
+    stats.on_checkout = main_module._observe_db_pool_checkout
+    stats.on_timeout = main_module._observe_db_pool_timeout
+
+    def sample(name, **labels):
+        return registry.get_sample_value(name, {"app_name": "product_service", **labels}) or 0
+
+    checkouts_before = sample("db_pool_checkout_duration_seconds_count")
+    timeouts_before = sample("db_pool_checkout_timeouts_total")
+    try:
+        async with small_sessions() as db:
+            await db.execute(select(1))
+            assert sample("db_pool_connections", state="checked_out") == 1
+            async with small_sessions() as waiting:
+                with pytest.raises(SATimeoutError) as timeout:
+                    await waiting.execute(select(1))
+        assert sample("db_pool_connections", state="checked_out") == 0
+        assert sample("db_pool_connections", state="idle") == 1
+    finally:
+        await small_engine.dispose()
+    assert sample("db_pool_connections", state="idle") == 0
+
+    try:
+        try:
+            raise timeout.value
+        except SATimeoutError:
+            raise HTTPException(status_code=500, detail="Could not deduct stock.")
+    except HTTPException as error:
+        stats.record_error(error)
+    stats.record_error(HTTPException(status_code=404))
+
+    assert sample("db_pool_checkout_duration_seconds_count") == checkouts_before + 1
+    assert sample("db_pool_checkout_timeouts_total") == timeouts_before + 1
+
+
+def _png(width: int, height: int) -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", (width, height), (200, 30, 30)).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+async def test_upload_image_streams_in_chunks(
+    client: httpx.AsyncClient, db_session_for_test: AsyncSession, mock_azure_blob_storage, monkeypatch
+):
+    """The image is staged as blocks no bigger than the chunk size and committed whole."""
+    monkeypatch.setattr(main_module, "IMAGE_UPLOAD_CHUNK_BYTES", 64 * 1024)
+    product = Product(name="Image Product", price=5.0, stock_quantity=1)
+    db_session_for_test.add(product)
+    await db_session_for_test.commit()
+    image = os.urandom(300 * 1024)
+
+    response = await client.post(
+        f"/products/{product.product_id}/upload-image",
+        files={"file": ("photo.png", image, "image/png")},
+    )
+
+    assert response.status_code == 200
+    ((container, blob_name), stored), = mock_azure_blob_storage.blobs.items()
+    assert container == "test-images"
+    assert blob_name.startswith(f"product-{product.product_id}-") and blob_name.endswith(".png")
+    assert stored == image
+    assert mock_azure_blob_storage.content_types[(container, blob_name)] == "image/png"
+    assert mock_azure_blob_storage.largest_block == 64 * 1024
+    assert response.json()["image_url"].startswith(f"https://testaccount.blob.core.windows.net/test-images/{blob_name}?")
+
+
+async def test_upload_image_over_size_limit_is_rejected(
+    client: httpx.AsyncClient, db_session_for_test: AsyncSession, mock_azure_blob_storage, monkeypatch
+):
+    """Uploads over IMAGE_UPLOAD_MAX_BYTES get a 413 and leave no blob and no image_url behind."""
+    monkeypatch.setattr(main_module, "IMAGE_UPLOAD_MAX_BYTES", 100 * 1024)
+    product = Product(name="Big Image Product", price=5.0, stock_quantity=1)
+    db_session_for_test.add(product)
+    await db_session_for_test.commit()
+
+    response = await client.post(
+        f"/products/{product.product_id}/upload-image",
+        files={"file": ("photo.jpg", os.urandom(100 * 1024 + 1), "image/jpeg")},
+    )
+
+    assert response.status_code == 413
+    assert mock_azure_blob_storage.blobs == {}
+    await db_session_for_test.refresh(product)
+    assert product.image_url is None
+
+
+async def test_upload_image_with_oversized_content_length_is_rejected_before_reading_body(
+    client: httpx.AsyncClient, mock_azure_blob_storage, monkeypatch
+):
+    """A Content-Length over the limit gets a 413 without the request body being received."""
+    monkeypatch.setattr(main_module, "IMAGE_UPLOAD_MAX_BYTES", 100 * 1024)
+    body_read = False
+
+    async def body():
+        nonlocal body_read
+        body_read = True
+        yield b"x" * (200 * 1024)
+
+    response = await client.post(
+        "/products/1/upload-image",
+        content=body(),
+        headers={"Content-Type": "multipart/form-data; boundary=b", "Content-Length": str(200 * 1024)},
+    )
+
+    assert response.status_code == 413
+    assert not body_read
+    assert mock_azure_blob_storage.blobs == {}
+
+
+def test_generate_image_variants_fits_each_size_without_upscaling():
+    """Each variant is WebP and fits within its longest edge; small images keep their size."""
+    variants = generate_image_variants(_png(1200, 600), {"thumbnail": 160, "huge": 4000}, quality=80)
+
+    with Image.open(io.BytesIO(variants["thumbnail"])) as thumbnail:
+        assert thumbnail.format == "WEBP"
+        assert thumbnail.size == (160, 80)
+    with Image.open(io.BytesIO(variants["huge"])) as huge:
+        assert huge.size == (1200, 600)
+
+
+async def test_upload_image_generates_variants_in_background(
+    client: httpx.AsyncClient, db_session_for_test: AsyncSession, mock_azure_blob_storage, monkeypatch
+):
+    """
+    After an upload the variants are rendered off the event loop, stored as sibling
+    blobs and exposed in ProductResponse.image_variants.
+    """
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        monkeypatch.setattr(main_module, "image_variant_pool", pool)
+        monkeypatch.setattr(main_module, "image_variant_slots", asyncio.Semaphore(1))
+        monkeypatch.setattr(main_module, "IMAGE_VARIANT_SIZES", {"thumbnail": 160, "small": 480})
+        # The background job opens its own session; keep it inside the test's transaction
+        monkeypatch.setattr(main_module, "SessionLocal", lambda: SessionLocal(bind=db_session_for_test.bind))
+        product = Product(name="Variant Product", price=5.0, stock_quantity=1)
+        db_session_for_test.add(product)
+        await db_session_for_test.commit()
+
+        response = await client.post(
+            f"/products/{product.product_id}/upload-image",
+            files={"file": ("photo.png", _png(1000, 800), "image/png")},
+        )
+        assert response.status_code == 200
+        assert response.json()["image_variants"] is None
+        await asyncio.gather(*main_module._image_variant_tasks)
+
+    blob_name = response.json()["image_url"].split("/test-images/")[1].split("?")[0]
+    stem = blob_name.rsplit(".", 1)[0]
+    for variant, size in (("thumbnail", (160, 128)), ("small", (480, 384))):
+        key = ("test-images", f"{stem}-{variant}.webp")
+        assert mock_azure_blob_storage.content_types[key] == "image/webp"
+        with Image.open(io.BytesIO(mock_azure_blob_storage.blobs[key])) as image:
+            assert image.size == size
+
+    # The job wrote through its own session; drop the test session's copy of the row
+    await db_session_for_test.refresh(product)
+    response = await client.get(f"/products/{product.product_id}")
+    variants = response.json()["image_variants"]
+    assert sorted(variants) == ["small", "thumbnail"]
+    assert variants["thumbnail"].startswith(f"https://testaccount.blob.core.windows.net/test-images/{stem}-thumbnail.webp?")
+
+
+async def test_image_variant_jobs_wait_for_a_pool_slot(db_session_for_test: AsyncSession, monkeypatch):
+    """Scheduled jobs start downloading only once one of the pool's worker slots is free."""
+    in_flight = 0
+    peak = 0
+
+    async def fake_build_image_variants(*args):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        return {}
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        monkeypatch.setattr(main_module, "image_variant_pool", pool)
+        monkeypatch.setattr(main_module, "image_variant_slots", asyncio.Semaphore(2))
+        monkeypatch.setattr(main_module, "build_image_variants", fake_build_image_variants)
+        monkeypatch.setattr(main_module, "SessionLocal", lambda: SessionLocal(bind=db_session_for_test.bind))
+        for blob_name in range(6):
+            main_module.schedule_image_variants(1, f"{blob_name}.png")
+        await asyncio.gather(*main_module._image_variant_tasks)
+
+    assert peak == 2
+
+
+def test_blob_url_signer_reuses_urls_until_refresh(monkeypatch):
+    """A blob is signed once per refresh window, not on every read."""
+    signer = BlobUrlSigner(
+        "https://testaccount.blob.core.windows.net", "testaccount", "testkey", "test-images",
+        expiry_seconds=3600, refresh_before_expiry_seconds=600, max_entries=100,
+    )
+    now = [1000.0]
+    monkeypatch.setattr("app.cache.time.monotonic", lambda: now[0])
+    with patch("app.blob_storage.generate_blob_sas", side_effect=["sig=1", "sig=2"]) as sign:
+        first = signer.url("product-1 photo.jpg")
+        assert signer.url("product-1 photo.jpg") == first
+        now[0] += 3000 - 1
+        assert signer.url("product-1 photo.jpg") == first
+        now[0] += 1
+        assert signer.url("product-1 photo.jpg").endswith("?sig=2")
+
+    assert sign.call_count == 2
+    assert first == "https://testaccount.blob.core.windows.net/test-images/product-1%20photo.jpg?sig=1"
+    assert signer.blob_name(first) == "product-1 photo.jpg"
+    assert signer.blob_name("https://example.com/test-images/product-1.jpg") is None
+
+
+async def test_uploaded_image_is_stored_as_blob_name(
+    client: httpx.AsyncClient, db_session_for_test: AsyncSession
+):
+    """
+    The database keeps the blob name, not an expiring URL. Sending a signed URL back
+    in an update keeps the blob reference; an external URL replaces it.
+    """
+    product = Product(name="Signed Product", price=5.0, stock_quantity=1)
+    db_session_for_test.add(product)
+    await db_session_for_test.commit()
+    response = await client.post(
+        f"/products/{product.product_id}/upload-image",
+        files={"file": ("photo.jpg", _png(20, 20), "image/jpeg")},
+    )
+    signed_url = response.json()["image_url"]
+    await db_session_for_test.refresh(product)
+    assert product.image_url is None
+    assert signed_url.startswith(f"https://testaccount.blob.core.windows.net/test-images/{product.image_blob_name}?")
+
+    response = await client.put(f"/products/{product.product_id}", json={"image_url": signed_url, "price": 6.0})
+    assert response.json()["image_url"] == signed_url
+    await db_session_for_test.refresh(product)
+    assert product.image_url is None and product.image_blob_name is not None
+
+    response = await client.put(f"/products/{product.product_id}", json={"image_url": "https://cdn.example.com/a.jpg"})
+    assert response.json()["image_url"] == "https://cdn.example.com/a.jpg"
+    await db_session_for_test.refresh(product)
+    assert product.image_blob_name is None
+
+
+async def test_image_blob_columns_migration_converts_stored_signed_urls(db_session_for_test: AsyncSession):
+    """
+    Signed URLs saved by earlier versions become blob names; other URLs are left alone.
+    Without the container URL the migration refuses to run rather than skip them.
+    """
+    prefix = "https://testaccount.blob.core.windows.net/test-images/"
+    legacy = Product(
+        name="Legacy Image Product", price=5.0, stock_quantity=1,
+        image_url=f"{prefix}product-9-1.jpg?sv=2021&sig=old",
+        image_variants={"thumbnail": f"{prefix}product-9-1-thumbnail.webp?sv=2021&sig=old"},
+    )
+    external = Product(name="External Image Product", price=5.0, stock_quantity=1, image_url="https://cdn.example.com/a.jpg")
+    db_session_for_test.add_all([legacy, external])
+    await db_session_for_test.commit()
+
+    # Run 0006 again on the existing columns, as on a database the old startup code set up
+    connection = await db_session_for_test.connection()
+    await connection.run_sync(lambda sync_connection: command.stamp(alembic_config(sync_connection), "0005"))
+    with pytest.raises(RuntimeError):
+        await connection.run_sync(upgrade_schema)
+    await connection.run_sync(upgrade_schema, image_container_url=prefix)
+
+    await db_session_for_test.refresh(legacy)
+    await db_session_for_test.refresh(external)
+    assert (legacy.image_url, legacy.image_blob_name) == (None, "product-9-1.jpg")
+    assert legacy.image_variants == {"thumbnail": "product-9-1-thumbnail.webp"}
+    assert (external.image_url, external.image_blob_name) == ("https://cdn.example.com/a.jpg", None)
+
+
+async def test_migrations_match_models(db_session_for_test: AsyncSession):
+    """
+    Tests that the schema built by the Alembic migrations is the one the models declare,
+    so a model change without a migration fails here.
+    """
+    connection = await db_session_for_test.connection()
+    differences = await connection.run_sync(
+        lambda sync_connection: compare_metadata(
+            MigrationContext.configure(sync_connection, opts={"include_object": include_object}), Base.metadata
+        )
+    )
+    assert differences == []
+
+
+async def test_bulk_import_ndjson_reports_rejected_rows(client: httpx.AsyncClient, db_session_for_test: AsyncSession):
+    """Valid NDJSON rows are created; invalid ones are skipped and reported by line."""
+    body = "\n".join(
+        [
+            '{"name": "Bulk A", "price": 1.5, "stock_quantity": 3}',
+            '{"name": "Bulk B", "price": -1, "stock_quantity": 3}',
+            "",
+            "not json",
+            '{"name": "Bulk C", "description": "third", "price": 2, "stock_quantity": 0}',
+        ]
+    )
+
+    async def chunks():
+        # Split mid-line, as a network stream would
+        for start in range(0, len(body), 7):
+            yield body[start:start + 7].encode()
+
+    response = await client.post(
+        "/products/bulk", content=chunks(), headers={"Content-Type": "application/x-ndjson"}
+    )
+
+    assert response.status_code == 200
+    result = response.json()
+    assert (result["imported"], result["rejected"], result["errors_truncated"]) == (2, 2, False)
+    assert [error["line"] for error in result["errors"]] == [2, 4]
+    assert result["errors"][0]["error"].startswith("price:")
+    names = await db_session_for_test.scalars(
+        select(Product.name).filter(Product.name.startswith("Bulk ")).order_by(Product.name)
+    )
+    assert list(names) == ["Bulk A", "Bulk C"]
+
+
+async def test_bulk_import_csv(client: httpx.AsyncClient, db_session_for_test: AsyncSession):
+    """CSV rows may quote commas and line breaks; a header with unknown columns is refused."""
+    body = 'name,price,stock_quantity,description\r\n"Desk, oak",120.00,4,"Two\nlines"\r\nLamp,abc,1,\r\n'
+    response = await client.post("/products/bulk", content=body, headers={"Content-Type": "text/csv"})
+
+    assert response.status_code == 200
+    assert response.json()["imported"] == 1
+    assert response.json()["errors"][0]["line"] == 4
+    desk = await db_session_for_test.scalar(select(Product).filter(Product.name == "Desk, oak"))
+    assert (desk.description, desk.stock_quantity, float(desk.price)) == ("Two\nlines", 4, 120.0)
+
+    response = await client.post("/products/bulk", content="name,colour\r\nx,red\r\n", headers={"Content-Type": "text/csv"})
+    assert response.status_code == 400
+    response = await client.post("/products/bulk", content="{}", headers={"Content-Type": "application/json"})
+    assert response.status_code == 415
+
+
+async def test_export_streams_catalog(client: httpx.AsyncClient, db_session_for_test: AsyncSession, monkeypatch):
+    """The export lists every product in product_id order, in either format."""
+    # The export opens its own session; keep it inside the test's transaction
+    monkeypatch.setattr(main_module, "SessionLocal", lambda: SessionLocal(bind=db_session_for_test.bind))
+    monkeypatch.setattr(main_module, "BULK_EXPORT_BATCH_SIZE", 2)
+    products = [Product(name=f"Export {i}", price=i + 0.5, stock_quantity=i) for i in range(5)]
+    db_session_for_test.add_all(products)
+    await db_session_for_test.commit()
+
+    response = await client.get("/products/export")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    exported = [row for row in rows if row["name"].startswith("Export ")]
+    assert [row["product_id"] for row in exported] == [product.product_id for product in products]
+    assert exported[1]["price"] == 1.5 and exported[1]["stock_quantity"] == 1
+
+    response = await client.get("/products/export", params={"format": "csv"})
+    lines = response.text.splitlines()
+    assert lines[0] == "product_id,name,description,price,stock_quantity,image_url,created_at,updated_at"
+    assert len(lines) == len(rows) + 1
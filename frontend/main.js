@@ -70,7 +70,7 @@ document.addEventListener('DOMContentLoaded', () => {
                 // console.log(`Product ID: ${product.product_id}, Image URL received:`, product.image_url); // Diagnostic log from previous iteration
 
                 productCard.innerHTML = `
-                    <img src="${product.image_url || 'https://placehold.co/300x200/cccccc/333333?text=No+Image'}" alt="${product.name}" onerror="this.onerror=null;this.src='https://placehold.co/300x200/cccccc/333333?text=Image+Error';" />
+                    <img src="${(product.image_variants && product.image_variants.small) || product.image_url || 'https://placehold.co/300x200/cccccc/333333?text=No+Image'}" alt="${product.name}" onerror="this.onerror=null;this.src='https://placehold.co/300x200/cccccc/333333?text=Image+Error';" />
                     <h3>${product.name} (ID: ${product.product_id})</h3>
                     <p>${product.description || 'No description available.'}</p>
                     <p class="price">${formatCurrency(product.price)}</p>